@@ -20,6 +20,8 @@ import appdaemon.conf as conf
 from fuzzywuzzy.process import extractOne
 import paramiko
 
+from power_charts import DEFAULT_KWH_PRICE, PowerChartRenderer
+
 
 LOG_LEVEL = 'DEBUG'
 
@@ -201,6 +203,13 @@ TELEGRAM_KEYBOARD_ENERPI = ['/lucesoff, /luceson',
 ENERPI_TILES = ['enerpi_tile_kwh', 'enerpi_tile_power', 'enerpi_tile_ldr']
 ENERPI_TILES_DESC = ['Consumo en kWh y € (24h)', 'Potencia eléctrica, W (24h)',
                      'Iluminación']
+ENERPI_APP = 'EnerpiPeakNotifier'
+ENERPI_SUMMARY_WINDOWS = [(3600, 'Última hora'), (86400, 'Últimas 24h')]
+MASK_ENERPI_SUMMARY = '- {}: media *{:.0f} W*, máx. {:.0f} W ({:%H:%M}), ' \
+                      'mín. {:.0f} W, {:.2f} kWh'
+# Local charts of the enerPI tiles (None -> HA camera, for the LDR tile)
+ENERPI_TILES_CHARTS = ['kwh', 'power', None]
+PATH_ENERPI_CHARTS = '/home/homeassistant/.homeassistant/www/snapshot_cameras'
 
 HASSWIZ_MENU_ACTIONS = [("Anterior ⬅︎", "op:back"),
                         ("Inicio ▲", "op:reset"), ("Salir ✕", "op:exit")]
@@ -378,6 +387,8 @@ class EventListener(appapi.AppDaemon):
     _lights_notif_state = None
     _lights_notif_st_attr = None
     _notifier = None
+    _enerpi_app = None
+    _enerpi_charts = None
 
     _bot_notifier = 'telegram_bot'
     _bot_name = None
@@ -406,6 +417,10 @@ class EventListener(appapi.AppDaemon):
         self._bot_chatids = _chatids
         self._bot_users = {c: u for c, u in zip(self._bot_chatids, _nicknames)}
         self._lights_notif = self.args.get('lights_notif', 'light.cuenco')
+        self._enerpi_app = self.args.get('enerpi_app', ENERPI_APP)
+        self._enerpi_charts = PowerChartRenderer(
+            self.args.get('charts_path', PATH_ENERPI_CHARTS),
+            kwh_price=float(self.args.get('kwh_price', DEFAULT_KWH_PRICE)))
         self._bot_wizstack = {user: [] for user in self._bot_users.keys()}
 
         # iOS app notification actions
@@ -532,6 +547,36 @@ class EventListener(appapi.AppDaemon):
             self.log('HASS CAM BAD PIC {} -> {}'.format(cam_entity_id, file))
         return PIC_STATIC_URL.format(self._config['base_url'], file)
 
+    def _enerpi_local_summary(self):
+        """Power summary from the local history of the enerPI app
+        (without querying HA)."""
+        enerpi = self.get_app(self._enerpi_app)
+        if enerpi is None:
+            return ''
+        lines = []
+        for seconds, label in ENERPI_SUMMARY_WINDOWS:
+            summary = enerpi.power_summary(seconds)
+            if summary is not None:
+                lines.append(MASK_ENERPI_SUMMARY.format(
+                    label, summary['mean'], summary['max'],
+                    dt.datetime.fromtimestamp(summary['ts_max']),
+                    summary['min'], summary['kwh']))
+        return '\n'.join(lines)
+
+    def _enerpi_tile(self, idx):
+        """Photo data of an enerPI tile: local chart rendered from the
+        power history (`file`), or HA camera pic (`url`) as fallback."""
+        chart = ENERPI_TILES_CHARTS[idx]
+        enerpi = self.get_app(self._enerpi_app)
+        if chart is not None and enerpi is not None:
+            if chart == 'kwh':
+                file_png = self._enerpi_charts.energy_chart(enerpi.history)
+            else:
+                file_png = self._enerpi_charts.power_chart(enerpi.history)
+            if file_png is not None:
+                return {'file': file_png}
+        return {'url': self._gen_hass_cam_pics(ENERPI_TILES[idx])}
+
     def _exec_bot_shell_command(self, command, args, timeout=20, **kwargs):
         self.log('in shell_command_output with "{}", "{}"'
                  .format(command, args), LOG_LEVEL)
@@ -855,42 +900,46 @@ class EventListener(appapi.AppDaemon):
                 self.call_service(serv, url=static_url, caption=cap, **msg)
             prefix = 'SEND CAMERA PICS'
         elif command == '/enerpitiles':
-            # TODO Solve for SVG cameras (not working now!)
+            # Local PNG charts (HA camera tiles are SVG) + LDR camera tile
             serv = self._bot_notifier + '/send_photo'
             msg = {"target": user_id,
                    'keyboard': TELEGRAM_KEYBOARD_ENERPI}
-            for i, (cam, cap) in enumerate(
-                    zip(ENERPI_TILES, ENERPI_TILES_DESC)):
-                static_url = self._gen_hass_cam_pics(cam)
+            for i, cap in enumerate(ENERPI_TILES_DESC):
+                photo = self._enerpi_tile(i)
                 if i + 1 == len(ENERPI_TILES):
                     msg.pop("keyboard")
                     msg["inline_keyboard"] = TELEGRAM_INLINE_KEYBOARD_ENERPI
-                    msg["url"] = static_url
                     msg["caption"] = cap
+                    msg.update(photo)
                     break
-                self.call_service(serv, url=static_url, caption=cap, **msg)
+                self.call_service(serv, caption=cap, **photo, **msg)
             prefix = 'SEND ENERPI TILES'
         elif command == '/enerpikwh':
-            cam, cap = ENERPI_TILES[0], ENERPI_TILES_DESC[0]
-            static_url = self._gen_hass_cam_pics(cam)
             serv = self._bot_notifier + '/send_photo'
-            msg = {"target": user_id,
-                   'url': static_url, 'caption': cap,
+            msg = {"target": user_id, 'caption': ENERPI_TILES_DESC[0],
                    'inline_keyboard': TELEGRAM_INLINE_KEYBOARD_ENERPI}
+            msg.update(self._enerpi_tile(0))
             prefix = 'SEND ENERPI TILE KWH'
         elif command == '/enerpipower':
-            cam, cap = ENERPI_TILES[1], ENERPI_TILES_DESC[1]
-            static_url = self._gen_hass_cam_pics(cam)
             serv = self._bot_notifier + '/send_photo'
-            msg = {"target": user_id,
-                   'url': static_url, 'caption': cap,
+            msg = {"target": user_id, 'caption': ENERPI_TILES_DESC[1],
                    'inline_keyboard': TELEGRAM_INLINE_KEYBOARD_ENERPI}
+            msg.update(self._enerpi_tile(1))
             prefix = 'SEND ENERPI TILE POWER'
         elif command == '/enerpi':
-            cam, cap = ENERPI_TILES[1], ENERPI_TILES_DESC[1]
-            static_url = self._gen_hass_cam_pics(cam)
-            message = '{}\n\n{}\n'.format(CMD_STATUS_TEMPL_ENERPI,
-                                          static_url.replace('_', '\_'))
+            summary = self._enerpi_local_summary()
+            if summary:
+                # Local power history & chart (without querying HA)
+                self.call_service(self._bot_notifier + '/send_photo',
+                                  target=user_id, disable_notification=True,
+                                  caption=ENERPI_TILES_DESC[1],
+                                  **self._enerpi_tile(1))
+                message = summary
+            else:
+                # HA template & camera tile (without the enerPI app/history)
+                static_url = self._gen_hass_cam_pics(ENERPI_TILES[1])
+                message = '{}\n\n{}\n'.format(
+                    CMD_STATUS_TEMPL_ENERPI, static_url.replace('_', '\_'))
             msg = {'title': "*Power status*:", 'message': message,
                    "target": user_id,
                    'inline_keyboard': TELEGRAM_INLINE_KEYBOARD_ENERPI}
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: expiry of keys at a given deadline.
+
+A min-heap of deadlines (with lazy invalidation of re-scheduled keys) is
+driven by only one AppDaemon timer, always armed at the earliest deadline,
+so each key expires at its own `last_change + timeout` (with the resolution
+of the AppDaemon scheduler), and the cost of each tick is O(expiring keys),
+not O(all keys).
+
+Deadlines are timestamps in seconds of the `clock` used (`time.time`).
+AppDaemon drops the timer callbacks of an app out of its constraints, so a
+timer whose deadline has passed is not trusted (it is armed again), and
+`poll` (from a repeating timer) fires the keys left expired.
+Usage in an app:
+
+```
+    self._expiry = ExpiryTimer(self, self._turn_off_raw_sensor)
+    ...
+    self._expiry.set(entity, time() + self._timeout)
+    ...
+    self._expiry.poll()  # in a repeating minutely timer
+```
+
+"""
+import heapq
+from itertools import count
+from math import ceil
+from threading import RLock
+from time import time
+
+
+# AppDaemon scheduler runs with 1 second resolution
+DEFAULT_TOLERANCE = .5
+# Secs late to consider an armed timer as dropped (by the app constraints)
+DROPPED_TIMER_GRACE = 5
+
+
+class DeadlineScheduler(object):
+    """Min-heap of (deadline, key), with lazy deletion of stale entries."""
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline of a key.
+
+        Returns True if the new deadline is now the earliest one."""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if len(self._heap) > 4 * len(self._deadlines) + 64:
+            self._compact()
+        return self._heap[0][2] == key and self._heap[0][0] == deadline
+
+    def cancel(self, key):
+        """Remove the deadline of a key (the heap entry becomes stale)."""
+        return self._deadlines.pop(key, None) is not None
+
+    def next_deadline(self):
+        """Earliest valid deadline, or None if empty."""
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_expired(self, now):
+        """Remove and return the keys with deadline <= now."""
+        heap, expired = self._heap, []
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                expired.append(key)
+        return expired
+
+    def _compact(self):
+        self._heap = [(d, i, k) for d, i, k in self._heap
+                      if self._deadlines.get(k) == d]
+        heapq.heapify(self._heap)
+
+
+class ExpiryTimer(object):
+    """Run `callback(key)` when each scheduled key reaches its deadline.
+
+    Only one AppDaemon timer (`run_in`) is armed at any time."""
+
+    def __init__(self, app, callback, tolerance=DEFAULT_TOLERANCE,
+                 clock=time):
+        self._app = app
+        self._callback = callback
+        self._tolerance = tolerance
+        self._clock = clock
+        self._scheduler = DeadlineScheduler()
+        self._lock = RLock()
+        self._handle = None
+        self._armed_at = None
+
+    def __len__(self):
+        return len(self._scheduler)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._scheduler
+
+    def set(self, key, deadline):
+        """Schedule the expiry of `key` at `deadline` (`clock` time)."""
+        with self._lock:
+            if self._scheduler.schedule(key, deadline) \
+                    or not self._timer_alive():
+                self._rearm()
+
+    def cancel(self, key):
+        """Cancel the expiry of `key`."""
+        with self._lock:
+            self._scheduler.cancel(key)
+
+    def cancel_all(self):
+        """Cancel all expiries and the armed timer."""
+        with self._lock:
+            self._scheduler = DeadlineScheduler()
+            self._cancel_handle()
+
+    def _cancel_handle(self):
+        if self._handle is not None:
+            self._app.cancel_timer(self._handle)
+        self._handle = self._armed_at = None
+
+    def poll(self):
+        """Fire the expired keys and arm the timer again, if the armed
+        timer has been dropped (watchdog, cheap when it is alive)."""
+        with self._lock:
+            if self._scheduler.next_deadline() is None or self._timer_alive():
+                return
+            self._cancel_handle()
+        self._fire(None)
+
+    def _timer_alive(self):
+        # (an armed timer past its deadline may have been dropped)
+        return (self._handle is not None
+                and self._armed_at + DROPPED_TIMER_GRACE > self._clock())
+
+    def _rearm(self):
+        next_deadline = self._scheduler.next_deadline()
+        if next_deadline == self._armed_at and self._timer_alive():
+            return
+        self._cancel_handle()
+        if next_deadline is not None:
+            delta = next_deadline - self._clock()
+            self._handle = self._app.run_in(self._fire, max(0, ceil(delta)))
+            self._armed_at = next_deadline
+
+    # noinspection PyUnusedLocal
+    def _fire(self, kwargs):
+        with self._lock:
+            self._handle = self._armed_at = None
+            expired = self._scheduler.pop_expired(
+                self._clock() + self._tolerance)
+            self._rearm()
+        for key in expired:
+            # (re-scheduled keys while processing are not expired)
+            if key not in self:
+                self._callback(key)
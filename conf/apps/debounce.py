@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: debounce & rate limiting for noisy binary sensors.
+
+Raw binary sensors like vibration or sound detectors can flap many times per
+second. The `DebounceFilter` decides, for each raw change, if it has to be
+processed, before doing any other callback work:
+
+- `min_on`: minimum time (s) in 'on' for the derived sensor,
+- `min_off`: minimum time (s) in 'off' before turning on again (hysteresis),
+- `max_rate`: max number of processed events per second (token bucket, with
+  a burst capacity of `max(1, max_rate)`, so rates < 1 ev/s also work).
+
+Per-sensor counters of raw vs emitted transitions are available to publish
+them as attributes of the derived sensors.
+
+"""
+from time import time
+
+
+EVENT_ON = 1
+EVENT_REFRESH = 2
+
+
+class _SensorState(object):
+    """Compact state of one raw sensor."""
+
+    __slots__ = ('is_on', 'last_event', 'on_since', 'off_since',
+                 'tokens', 'last_refill', 'raw', 'emitted', 'suppressed')
+
+    def __init__(self, now, max_rate):
+        self.is_on = False
+        self.last_event = self.on_since = 0.
+        self.off_since = float('-inf')
+        self.tokens = max(1., max_rate) if max_rate else 0.
+        self.last_refill = now
+        self.raw = self.emitted = self.suppressed = 0
+
+
+class DebounceFilter(object):
+    """Debounce, hysteresis and max-rate filter for raw binary sensors."""
+
+    def __init__(self, min_on=0., min_off=0., max_rate=None, clock=time):
+        self.min_on = float(min_on or 0.)
+        self.min_off = float(min_off or 0.)
+        self.max_rate = float(max_rate) if max_rate else None
+        self._burst = max(1., self.max_rate) if max_rate else None
+        self._clock = clock
+        self._sensors = {}
+
+    def __contains__(self, key):
+        return key in self._sensors
+
+    def add(self, key):
+        """Register a raw sensor."""
+        self._sensors[key] = _SensorState(self._clock(), self.max_rate)
+
+    def event(self, key, now=None):
+        """Process a raw change.
+
+        Returns `EVENT_ON` if the derived sensor has to be turned on,
+        `EVENT_REFRESH` if it is already on (and its deadline has to be
+        extended), or None if the event has been filtered."""
+        if now is None:
+            now = self._clock()
+        st = self._sensors[key]
+        st.raw += 1
+        if not st.is_on and now - st.off_since < self.min_off:
+            st.suppressed += 1
+            return None
+        if self.max_rate is not None:
+            st.tokens = min(self._burst, st.tokens
+                            + (now - st.last_refill) * self.max_rate)
+            st.last_refill = now
+            if st.tokens < 1:
+                st.suppressed += 1
+                return None
+            st.tokens -= 1
+        st.last_event = now
+        if st.is_on:
+            return EVENT_REFRESH
+        st.is_on = True
+        st.on_since = now
+        st.emitted += 1
+        return EVENT_ON
+
+    def deadline(self, key, timeout):
+        """Time (in `clock` units) to turn off the derived sensor."""
+        st = self._sensors[key]
+        return max(st.last_event + timeout, st.on_since + self.min_on)
+
+    def turn_off(self, key):
+        """Register the 'off' transition of the derived sensor."""
+        st = self._sensors[key]
+        if st.is_on:
+            st.is_on = False
+            st.off_since = self._clock()
+            st.emitted += 1
+
+    def is_on(self, key):
+        """State of the derived sensor."""
+        return self._sensors[key].is_on
+
+    def attributes(self, key, attributes=None):
+        """Attributes for the derived sensor, with the transition counters."""
+        st = self._sensors[key]
+        attrs = dict(attributes or {})
+        attrs.update(raw_transitions=st.raw,
+                     emitted_transitions=st.emitted,
+                     suppressed_transitions=st.suppressed)
+        return attrs
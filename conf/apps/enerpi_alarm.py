@@ -59,32 +59,82 @@ Automation task as a AppDaemon App for Home Assistant - enerPI PEAK POWER notifi
           message: "Potencia eléctrica actual: {{ states.sensor.enerpi_power.state }} W.
                     Ya no hay peligro de corte por sobre-consumo."
 ```
+
+* The power samples feed a streaming statistics engine (EWMA, rolling mean/max/min, kWh and percentiles),
+published as attributes of a `stats_sensor` (`sensor.enerpi_power_stats` by default), and the peak detection
+works on the smoothed power (EWMA with `smoothing_sec` time constant), so single spikes don't trigger alarms.
+
+* The samples are also kept in a high resolution history (ring buffer of ~24h at 1 Hz, over NumPy arrays), used
+for the analysis of the power peaks and, from other apps (`get_app`), for the `/enerpi` bot replies.
+With `path_base_data` defined, the history is saved periodically in a memory-mapped file and restored at start.
+
+* The alarms are threshold rules (see `threshold_rules`), compiled into per-sensor state machines: any number of
+numeric sensors, each one with any number of named thresholds (`above`/`below` limits as numbers or `input_number`
+entities, `duration`, `reset_duration` & `cooldown`), defined in a `rules` arg:
+
+```yaml
+  rules:
+    sensor.enerpi_power:
+      - name: max_power
+        above: input_number.enerpi_max_power
+        below: input_number.enerpi_max_power_reset
+        scale: 1000
+        duration: 15
+        reset_duration: 60
+      - name: very_high_power
+        title: "Consumo eléctrico muy alto!"
+        above: 5500
+        below: 4000
+        duration: 2
+        reset_duration: 30
+        cooldown: 600
+```
+
+Without `rules`, the old args (`max_power_kw`, `max_power_kw_reset`, `min_time_high`, `min_time_low`) define
+one rule (`max_power`) over the `control` sensor.
 """
 import datetime as dt
+import os
+from time import time
 import appdaemon.appapi as appapi
 
+from power_history import PowerHistory
+from power_stats import Ewma, PowerStats
+from threshold_rules import CANCEL, RESET, RulesEngine, START, TRIGGER
+
 
 LOG_LEVEL = 'INFO'
 DEFAULT_UPPER_LIMIT_KW = 4
 DEFAULT_LOWER_LIMIT_KW = 2
 DEFAULT_MIN_TIME_UPPER_SEC = 3
 DEFAULT_MIN_TIME_LOWER_SEC = 60
+DEFAULT_RULE_NAME = 'max_power'
+DEFAULT_SMOOTHING_SEC = 5
+DEFAULT_STATS_PUBLISH_SEC = 10
+DEFAULT_HISTORY_HOURS = 24
+DEFAULT_HISTORY_SNAPSHOT_SEC = 300
+FILE_HISTORY = 'enerpi_power_history.mmap'
 MASK_MSG_MAX_POWER = {"title": "Alto consumo eléctrico!",
                       "message": "Pico de potencia: {} W en {}"}
 MASK_MSG_MAX_POWER_RESET = {"title": "Consumo eléctrico: Normal",
                             "message": "Potencia normal desde {}, Pico de potencia: {} W."}
+MASK_MSG_PEAK_EVENT = " Duración: {:.0f} min, media de {:.0f} W, consumo de {:.2f} kWh."
+
+
+def _is_entity(value):
+    if not isinstance(value, str):
+        return False
+    try:
+        float(value)
+        return False
+    except ValueError:
+        return True
 
 
 # noinspection PyClassHasNoInit
 class EnerpiPeakNotifier(appapi.AppDaemon):
     """App for Notifying the power peaks when they are greater than a certain limit, and after that,
-    notify when back to normal (lower than another user defined limit)."""
-
-    # Limit Values
-    _upper_limit = None
-    _min_time_upper = None
-    _lower_limit = None
-    _min_time_lower = None
+    notify when back to normal (lower than another user defined limit), for any number of threshold rules."""
 
     # App user inputs
     # _switch_on_off_app = None --> `constrain_input_boolean`
@@ -92,12 +142,22 @@ class EnerpiPeakNotifier(appapi.AppDaemon):
     _notifier = None
     _target_sensor = None
     _camera = None
-    _slider_upper_limit = None
-    _slider_lower_limit = None
 
-    _alarm_state = False
-    _last_trigger = None
-    _current_peak = 0
+    # Threshold rules
+    _rules = None
+    _sliders = None
+    _ewmas = None
+
+    # Streaming stats
+    _stats = None
+    _stats_sensor = None
+    _stats_interval = None
+    _last_stats_publish = 0
+
+    # Power history
+    _history = None
+    _snapshot_interval = None
+    _last_snapshot = 0
 
     def initialize(self):
         """AppDaemon required method for app init."""
@@ -106,65 +166,112 @@ class EnerpiPeakNotifier(appapi.AppDaemon):
         self._notifier = conf_data.get('notifier').replace('.', '/')
         self._target_sensor = conf_data.get('chatid_sensor')
         self._camera = self.args.get('camera')
-        self._min_time_upper = int(self.args.get('min_time_high', DEFAULT_MIN_TIME_UPPER_SEC))
-        self._min_time_lower = int(self.args.get('min_time_low', DEFAULT_MIN_TIME_LOWER_SEC))
-
-        # App user inputs
-        self._slider_upper_limit = self.args.get('max_power_kw', '')
-        self._slider_lower_limit = self.args.get('max_power_kw_reset', '')
-        self._upper_limit = DEFAULT_UPPER_LIMIT_KW * 1000
-        self._lower_limit = DEFAULT_LOWER_LIMIT_KW * 1000
-        if self._slider_upper_limit:
-            try:
-                self._upper_limit = int(1000 * float(self._slider_upper_limit))
-            except ValueError:
-                state = self.get_state(self._slider_lower_limit)
-                if state:
-                    self._upper_limit = int(1000 * float(self.get_state(self._slider_upper_limit)))
-                    self.listen_state(self._slider_limit_change, self._slider_upper_limit)
-        if self._slider_lower_limit:
-            try:
-                self._lower_limit = int(1000 * float(self._slider_lower_limit))
-            except ValueError:
-                state = self.get_state(self._slider_lower_limit)
-                if state:
-                    self._lower_limit = int(1000 * float(self.get_state(self._slider_lower_limit)))
-                    self.listen_state(self._slider_limit_change, self._slider_lower_limit)
-        elif self._slider_upper_limit:
-            self._lower_limit = self._upper_limit // 2
-
-        # Listen for Main Power changes:
-        self.listen_state(self._main_power_change, self._main_power)
-
-        self.log('EnerpiPeakNotifier Initialized. P={}, with P>{} W for {} secs, (low={} W for {} secs). Notify: {}'
-                 .format(self._main_power, self._upper_limit, self._min_time_upper,
-                         self._lower_limit, self._min_time_lower, self._notifier))
-
-    def _get_notif_data(self, reset_alarm=False):
-        time_now = '{:%H:%M:%S}'.format(self._last_trigger) if self._last_trigger is not None else '???'
+
+        # Threshold rules, with the limits from numbers or input_number sliders:
+        rules_config = self.args.get('rules') or {self._main_power: [self._legacy_rule_config()]}
+        self._sliders = {}
+        for entity, rules in rules_config.items():
+            for i, params in enumerate(rules):
+                params.setdefault('name', '{}_{}'.format(entity, i))
+                for key in ('above', 'below'):
+                    if _is_entity(params.get(key)):
+                        self._sliders.setdefault(params[key], []).append(
+                            (params['name'], key, float(params.get('scale', 1))))
+        self._rules = RulesEngine.from_config(rules_config, resolve=self._get_slider_value)
+        legacy = self._rules.get(DEFAULT_RULE_NAME)
+        if (legacy is not None and not self.args.get('rules')
+                and 'max_power_kw' in self.args and 'max_power_kw_reset' not in self.args):
+            legacy.below = legacy.above / 2
+        for slider in self._sliders:
+            self.listen_state(self._slider_limit_change, slider)
+
+        # Streaming stats & smoothing for peak detection:
+        smoothing = max(float(self.args.get('smoothing_sec', DEFAULT_SMOOTHING_SEC)), .1)
+        self._stats = PowerStats(ewma_taus=(smoothing, 60))
+        self._ewmas = {entity: Ewma(smoothing) for entity in self._rules.entities if entity != self._main_power}
+        self._stats_sensor = self.args.get('stats_sensor', self._main_power + '_stats')
+        self._stats_interval = int(self.args.get('stats_publish_sec', DEFAULT_STATS_PUBLISH_SEC))
+
+        # High resolution power history (with memmap snapshot for crash recovery):
+        path_base_data = self.args.get('path_base_data', conf_data.get('path_base_data'))
+        self._history = PowerHistory(
+            capacity=int(float(self.args.get('history_hours', DEFAULT_HISTORY_HOURS)) * 3600),
+            path=os.path.join(path_base_data, FILE_HISTORY) if path_base_data is not None else None)
+        self._snapshot_interval = int(self.args.get('history_snapshot_sec', DEFAULT_HISTORY_SNAPSHOT_SEC))
+        self._last_snapshot = time()
+
+        # Listen for Main Power & rule sensors changes:
+        for entity in set([self._main_power] + self._rules.entities):
+            self.listen_state(self._sensor_change, entity)
+
+        self.log('EnerpiPeakNotifier Initialized. P={}, Notify: {}, with {} rules:\n{}'
+                 .format(self._main_power, self._notifier, len(self._rules),
+                         '\n'.join('- {}: {} > {} for {} secs (< {} for {} secs)'
+                                   .format(r.name, r.entity, r.above, r.duration, r.below, r.reset_duration)
+                                   for r in self._rules.rules())))
+        if len(self._history):
+            self.log('Power history restored: {}'.format(self._history))
+
+    def _legacy_rule_config(self):
+        """Rule for the `control` sensor from the old args (kW limits)."""
+        return {'name': DEFAULT_RULE_NAME,
+                'above': self.args.get('max_power_kw', DEFAULT_UPPER_LIMIT_KW),
+                'below': self.args.get('max_power_kw_reset', DEFAULT_LOWER_LIMIT_KW),
+                'scale': 1000,
+                'duration': int(self.args.get('min_time_high', DEFAULT_MIN_TIME_UPPER_SEC)),
+                'reset_duration': int(self.args.get('min_time_low', DEFAULT_MIN_TIME_LOWER_SEC))}
+
+    def _get_slider_value(self, entity):
+        """Limit value from an entity (NaN, so the rule is disabled, if it has no valid state yet)."""
+        try:
+            return float(self.get_state(entity))
+        except (TypeError, ValueError):
+            self.log('Bad limit value in {}, rule disabled until it changes'.format(entity), 'WARNING')
+            return float('nan')
+
+    def power_summary(self, seconds=3600):
+        """Power stats of the last `seconds` from the local history (None without samples)."""
+        return self._history.summary(since=time() - seconds)
+
+    @property
+    def history(self):
+        """High resolution power history (`PowerHistory`)."""
+        return self._history
+
+    def _get_notif_data(self, rule, reset_alarm=False):
+        ts = rule.ts_last_high if reset_alarm else rule.ts_trigger
+        time_now = '{:%H:%M:%S}'.format(dt.datetime.fromtimestamp(ts)) if ts is not None else '???'
         if reset_alarm:
             data_msg = MASK_MSG_MAX_POWER_RESET.copy()
-            data_msg["message"] = data_msg["message"].format(time_now, self._current_peak)
+            data_msg["message"] = data_msg["message"].format(time_now, int(rule.peak))
+            if rule.entity == self._main_power:
+                peak = self._history.summary(since=rule.ts_start)
+                if peak is not None:
+                    data_msg["message"] += MASK_MSG_PEAK_EVENT.format(
+                        (peak['ts_last'] - peak['ts_first']) / 60, peak['mean'], peak['kwh'])
         else:
             data_msg = MASK_MSG_MAX_POWER.copy()
-            data_msg["message"] = data_msg["message"].format(self._current_peak, time_now)
+            data_msg["message"] = data_msg["message"].format(int(rule.peak), time_now)
+            if 'title' in rule.options:
+                data_msg["title"] = rule.options['title']
         return data_msg
 
-    def _make_ios_message(self, reset_alarm=False):
-        data_msg = self._get_notif_data(reset_alarm)
+    def _make_ios_message(self, rule, reset_alarm=False):
+        data_msg = self._get_notif_data(rule, reset_alarm)
+        camera = rule.options.get('camera', self._camera)
         if reset_alarm:
             data_msg["data"] = {"push": {"category": "camera", "badge": 0},
-                                "entity_id": self._camera}
+                                "entity_id": camera}
         else:
             data_msg["data"] = {
                 "push": {
                     "category": "camera", "badge": 1,
                     "sound": "US-EN-Morgan-Freeman-Vacate-The-Premises.wav"},
-                "entity_id": self._camera}
+                "entity_id": camera}
         return data_msg
 
-    def _make_telegram_message(self, reset_alarm=False):
-        data_msg = self._get_notif_data(reset_alarm)
+    def _make_telegram_message(self, rule, reset_alarm=False):
+        data_msg = self._get_notif_data(rule, reset_alarm)
         data_msg["target"] = self.get_state(self._target_sensor)
         data_msg["inline_keyboard"] = [[('Luces ON', '/luceson'),
                                  ('Luces OFF', '/lucesoff')],
@@ -175,57 +282,60 @@ class EnerpiPeakNotifier(appapi.AppDaemon):
 
     # noinspection PyUnusedLocal
     def _slider_limit_change(self, entity, attribute, old, new, kwargs):
-        if entity == self._slider_upper_limit:
-            self._upper_limit = int(1000 * float(new))
-        elif entity == self._slider_lower_limit:
-            self._lower_limit = int(1000 * float(new))
-        self.log('LIMIT CHANGE FROM "{}" TO "{}" --> upper_limit={} W, lower_limit={} W'
-                 .format(old, new, self._upper_limit, self._lower_limit))
+        try:
+            value = float(new)
+        except (TypeError, ValueError):
+            return
+        for name, key, scale in self._sliders[entity]:
+            rule = self._rules.get(name)
+            setattr(rule, key, value * scale)
+            self.log('LIMIT CHANGE FROM "{}" TO "{}" --> {}: upper_limit={} W, lower_limit={} W'
+                     .format(old, new, name, rule.above, rule.below))
+
+    def _publish_stats(self, now):
+        if now - self._last_stats_publish >= self._stats_interval:
+            self._last_stats_publish = now
+            attrs = self._stats.attributes(now)
+            attrs.update(unit_of_measurement='W', friendly_name='enerPI power stats', icon='mdi:chart-line')
+            self.set_state(self._stats_sensor, state=round(self._stats.ewma()), attributes=attrs)
 
     # noinspection PyUnusedLocal
-    def _main_power_change(self, entity, attribute, old, new, kwargs):
-        """Power Peak ALARM logic control."""
-        now = dt.datetime.now()
-        new = int(new)
-        # self.log('DEBUG main_power_change in {}: attr={}; from "{}" to "{}"'.format(entity, attribute, old, new))
-        # Update peak
-        if new > self._current_peak:
-            self._current_peak = new
-        if not self._alarm_state and (new > self._upper_limit):  # Pre-Alarm state, before trigger
-            # Prealarm
-            if self._last_trigger is None:  # Start power peak event
-                self.log('New power peak event at {} with P={} W'.format(now, new), level=LOG_LEVEL)
-                self._last_trigger = now
-            elif (now - self._last_trigger).total_seconds() > self._min_time_upper:
-                # TRIGGER ALARM
-                alarm_msg = self._make_ios_message()
-                self.log('TRIGGER ALARM with msg={}'
-                         .format(alarm_msg), level=LOG_LEVEL)
-                self.call_service(self._notifier, **alarm_msg)
-                self.call_service('telegram_bot/send_message',
-                                  **self._make_telegram_message())
-                self._alarm_state = True
-                self._last_trigger = now
-            # else:  # wait some more time (this is the same power peak event, waiting min time to trigger alarm)
-            #     pass
-        elif self._alarm_state:  # Alarm state, waiting for reset
-            if new < self._lower_limit:
-                # self.log('IN ALARM MODE!!')
-                if (now - self._last_trigger).total_seconds() > self._min_time_lower:
-                    self.log('RESET ALARM MODE at {}'.format(now), level=LOG_LEVEL)
-                    # RESET ALARM
-                    self.call_service(
-                        self._notifier,
-                        **self._make_ios_message(reset_alarm=True))
-                    self.call_service(
-                        'telegram_bot/send_message',
-                        **self._make_telegram_message(reset_alarm=True))
-                    self._alarm_state = False
-                    self._last_trigger = None
-                    self._current_peak = 0
-            else:
-                self._last_trigger = now
-        else:  # Normal operation, reset last trigger if no more in min_time_lower
-            if (self._last_trigger is not None) and ((now - self._last_trigger).total_seconds() > self._min_time_lower):
-                self.log('RESET LAST TRIGGER (was in {})'.format(self._last_trigger), level=LOG_LEVEL)
-                self._last_trigger = None
+    def _sensor_change(self, entity, attribute, old, new, kwargs):
+        """Power Peak ALARM logic control: evaluation of the threshold rules of the sensor."""
+        now = time()
+        try:
+            new = float(new)
+        except (TypeError, ValueError):
+            return
+        # self.log('DEBUG sensor_change in {}: attr={}; from "{}" to "{}"'.format(entity, attribute, old, new))
+        if entity == self._main_power:
+            self._stats.add(now, new)
+            self._history.add(now, new)
+            self._publish_stats(now)
+            if now - self._last_snapshot >= self._snapshot_interval:
+                self._last_snapshot = now
+                self._history.snapshot()
+            smoothed = self._stats.ewma()
+        else:
+            smoothed = self._ewmas[entity].add(now, new)
+        for event, rule in self._rules.evaluate(entity, now, smoothed, raw=new):
+            self._rule_event(event, rule, now, new, smoothed)
+
+    def _rule_event(self, event, rule, now, value, smoothed):
+        if event == START:  # Pre-Alarm state, before trigger
+            self.log('New peak event ({}) at {:%H:%M:%S} with {}={:.0f} (smoothed: {:.0f})'
+                     .format(rule.name, dt.datetime.fromtimestamp(now), rule.entity, value, smoothed),
+                     level=LOG_LEVEL)
+        elif event == TRIGGER:
+            alarm_msg = self._make_ios_message(rule)
+            self.log('TRIGGER ALARM {} with msg={}'.format(rule.name, alarm_msg), level=LOG_LEVEL)
+            self.call_service(self._notifier, **alarm_msg)
+            self.call_service('telegram_bot/send_message', **self._make_telegram_message(rule))
+        elif event == RESET:
+            self.log('RESET ALARM MODE ({}) at {:%H:%M:%S}'
+                     .format(rule.name, dt.datetime.fromtimestamp(now)), level=LOG_LEVEL)
+            self.call_service(self._notifier, **self._make_ios_message(rule, reset_alarm=True))
+            self.call_service('telegram_bot/send_message', **self._make_telegram_message(rule, reset_alarm=True))
+        elif event == CANCEL:  # Normal operation, the peak event hasn't triggered the alarm
+            self.log('RESET LAST TRIGGER ({}, was in {:%H:%M:%S})'
+                     .format(rule.name, dt.datetime.fromtimestamp(rule.ts_start)), level=LOG_LEVEL)
@@ -7,29 +7,61 @@ or from iOS notification actions.
 
 Harcoded custom logic for controlling HA with feedback from these actions.
 
+The presence of each person is aggregated from the count of its devices at
+home (`presence.PresenceModel`), so each tracker change is O(1), and the
+Telegram target & notifications are only processed in real person
+transitions (arrival / departure).
+
+The person transitions are saved in a compact binary history (appended in
+batches, in `path_base_data`), and learned in weekday / time of day
+histograms, to predict the arrivals: the probability of any arrival in the
+next `prediction_minutes` and the likely arrival time of each person away
+are published in a `prediction_sensor` (for pre-warming the heater or
+pre-arming the alarm), and are available to other apps with
+`arrival_probability` and `expected_arrival`.
+
 """
 from datetime import datetime as dt
+import os
+from time import time
 from dateutil.parser import parse
 
 import appdaemon.appapi as appapi
 import appdaemon.conf as conf
 
+from presence import ARRIVAL, DEPARTURE, PresenceModel, select_target
+from presence_history import PresenceHistory, PresencePredictor
+
 
 # DELAY_TO_SET_DEFAULT_TARGET = 1800  # sec
 DELAY_TO_SET_DEFAULT_TARGET = 120  # sec
+FILE_PRESENCE_HISTORY = 'presence_history.bin'
+DELAY_FLUSH_HISTORY = 600  # sec
+PREDICTION_UPDATE_SEC = 900
+DEFAULT_PREDICTION_MINUTES = 30
+DEFAULT_PREDICTION_SENSOR = 'sensor.family_arrival_prediction'
 
 
 # noinspection PyClassHasNoInit
 class FamilyTracker(appapi.AppDaemon):
     """Family Tracker."""
 
-    _tracking_state = None
+    _presence = None
     _telegram_targets = None
+    _person_targets = None
+    _current_target = None
     _notifier = None
     _timer_update_target = None
     _base_url = None
     _anybody_home = None
 
+    # Presence history & prediction
+    _history = None
+    _predictor = None
+    _timer_flush = None
+    _prediction_sensor = None
+    _prediction_minutes = None
+
     def initialize(self):
         """AppDaemon required method for app init."""
         config = dict(self.config['AppDaemon'])
@@ -53,14 +85,15 @@ class FamilyTracker(appapi.AppDaemon):
             home_group, attribute='attributes')['entity_id']
 
         # Get tracking states:
-        self._tracking_state = {}
+        self._presence = PresenceModel()
+        self._person_targets = {}
         for dev in _devs_track:
             target = None
             name = self.friendly_name(dev)
-            tracking_st = [self.get_state(dev),
-                           parse(self.get_state(dev, attribute='last_changed')
-                                 ).astimezone(conf.tz)]
-            self._tracking_state[dev] = tracking_st
+            self._presence.add(
+                dev, name, self.get_state(dev),
+                parse(self.get_state(dev, attribute='last_changed')
+                      ).astimezone(conf.tz))
 
             # Listen for state changes:
             self.listen_state(self.track_zone_ch, dev, old="home", duration=60)
@@ -74,17 +107,83 @@ class FamilyTracker(appapi.AppDaemon):
                 # Listen for extra devices (input_booleans):
                 if 'extra_tracker' in people_track[dev]:
                     dev_extra = people_track[dev]['extra_tracker']
-                    extra_tracking_st = [
-                        self.get_state(dev_extra),
+                    self._presence.add(
+                        dev_extra, name, self.get_state(dev_extra),
                         parse(self.get_state(dev, attribute='last_changed')
-                              ).astimezone(conf.tz)]
+                              ).astimezone(conf.tz))
                     self._telegram_targets[dev_extra] = (name, target)
-                    self._tracking_state[dev_extra] = extra_tracking_st
                     self.listen_state(self.track_zone_ch, dev_extra)
             self._telegram_targets[dev] = (name, target)
+            self._person_targets[name] = target
 
         # Process (and write globals) who is at home
-        self._who_is_at_home(False)
+        self._anybody_home = self._presence.anybody_home
+        self._update_target()
+
+        # Presence history & arrival prediction
+        path_base_data = self.args.get(
+            'path_base_data', config.get('path_base_data'))
+        self._history = PresenceHistory(
+            os.path.join(path_base_data, FILE_PRESENCE_HISTORY)
+            if path_base_data is not None else None)
+        self._predictor = PresencePredictor.from_history(
+            self._history, tz=conf.tz)
+        self._prediction_sensor = self.args.get(
+            'prediction_sensor', DEFAULT_PREDICTION_SENSOR)
+        self._prediction_minutes = int(self.args.get(
+            'prediction_minutes', DEFAULT_PREDICTION_MINUTES))
+        self.log('Presence history: {}, {}'
+                 .format(self._history, self._predictor))
+        self._publish_prediction()
+
+    def terminate(self):
+        """AppDaemon method called on app reload: save the pending
+        transitions."""
+        if self._history is not None:
+            self._history.flush()
+
+    def arrival_probability(self, minutes=DEFAULT_PREDICTION_MINUTES):
+        """Probability of an arrival (of anybody away) in the next minutes."""
+        people_away = [p for p in self._presence.people
+                       if p not in self._presence.people_home]
+        return self._predictor.probability_any(
+            people_away, ARRIVAL, time(), 60 * minutes)
+
+    def expected_arrival(self, person):
+        """Likely arrival time (datetime) of a person, or None."""
+        ts = self._predictor.expected_time(person, ARRIVAL, time())
+        return dt.fromtimestamp(ts, conf.tz) if ts is not None else None
+
+    # noinspection PyUnusedLocal
+    def _publish_prediction(self, *args):
+        attrs = {'unit_of_measurement': '%', 'icon': 'mdi:home-import-outline',
+                 'friendly_name': 'Llegada en {} min'
+                                  .format(self._prediction_minutes),
+                 'days_observed': self._predictor.num_days}
+        for person in self._presence.people:
+            if person not in self._presence.people_home:
+                arrival = self.expected_arrival(person)
+                attrs[person] = ('{:%H:%M}'.format(arrival)
+                                 if arrival is not None else '-')
+        p_arrival = self.arrival_probability(self._prediction_minutes)
+        self.set_state(self._prediction_sensor,
+                       state=round(100 * p_arrival), attributes=attrs)
+        self.run_in(self._publish_prediction, PREDICTION_UPDATE_SEC)
+
+    # noinspection PyUnusedLocal
+    def _flush_history(self, *args):
+        self._timer_flush = None
+        self._history.flush()
+
+    def _save_transition(self, person, event, ts):
+        self._predictor.add(person, event, ts)
+        if self._history.append(person, event, ts):
+            if self._timer_flush is not None:
+                self.cancel_timer(self._timer_flush)
+            self._flush_history()
+        elif self._timer_flush is None:
+            self._timer_flush = self.run_in(
+                self._flush_history, DELAY_FLUSH_HISTORY)
 
     def _make_notifications(self, exiting_home, telegram_target):
         if exiting_home:
@@ -120,45 +219,33 @@ class FamilyTracker(appapi.AppDaemon):
         }
         return data_ios, data_telegram
 
-    def _who_is_at_home(self, zone_changed):
-        if self._timer_update_target is not None:
-            self.cancel_timer(self._timer_update_target)
-            self._timer_update_target = None
-
-        people, new_target = {}, None
-        for dev, (st, last_ch) in self._tracking_state.items():
-            at_home = (st == 'home') or (st == 'on')
-            person, target = self._telegram_targets[dev]
-            if person not in people:
-                people[person] = at_home, last_ch, dev
-                if at_home:
-                    new_target = target
-            elif last_ch > people[person][1]:
-                people[person] = at_home, last_ch, dev
-
-        # Set default chat_id and people_home
-        people_home = {k: v for k, v in people.items() if v[0]}
-        new_anybody_home = len(people_home) > 0
-        if not new_anybody_home and zone_changed:
-            # Set last person exiting the house (at least for some time)
-            last_dev = list(sorted(people.values(), key=lambda x: x[2]))[-1][2]
-            _last_person, new_target = self._telegram_targets[last_dev]
-            self._timer_update_target = self.run_in(
-                self._who_is_at_home, DELAY_TO_SET_DEFAULT_TARGET,
-                zone_changed=False)
-        elif not new_anybody_home or len(people_home) > 1:
-            new_target = self._telegram_targets["default"][1]
-        else:
-            self.log("WHO IS AT HOME? people: {}, zone_changed:{}, target:{}"
-                       .format(people, zone_changed, new_target))
+    def _update_target(self, kwargs=None):
+        """Set the Telegram target and notify when anybody_home changes.
 
+        Called only on person transitions (and at init / end of the
+        delay for the last person exiting)."""
+        if kwargs is not None:  # end of delay for the last person exiting
+            self._timer_update_target = None
+        people_home = self._presence.people_home
+        last_person = None
+        if self._timer_update_target is not None:
+            last_person = self._presence.last_departure[0]
+        new_target = select_target(
+            people_home, self._person_targets,
+            self._telegram_targets["default"][1], last_person)
+        if len(people_home) == 1:
+            self.log("WHO IS AT HOME? people: {}, target:{}"
+                     .format(people_home, new_target))
         if new_target is None:
             return
 
-        self.call_service(
-            'python_script/set_telegram_chatid_sensor', chat_id=new_target)
+        if new_target != self._current_target:
+            self.call_service(
+                'python_script/set_telegram_chatid_sensor', chat_id=new_target)
+            self._current_target = new_target
 
         # Todo entradas - salidas de personas individuales
+        new_anybody_home = self._presence.anybody_home
         if new_anybody_home != self._anybody_home:
             data_ios, data_telegram = self._make_notifications(
                 not new_anybody_home, new_target)
@@ -172,11 +259,9 @@ class FamilyTracker(appapi.AppDaemon):
     # noinspection PyUnusedLocal
     def track_zone_ch(self, entity, attribute, old, new, kwargs):
         """State change listener."""
-        last_st, last_ch = self._tracking_state[entity]
-        self._tracking_state[entity] = [new, dt.now(tz=conf.tz)]
-
-        # Process changes
-        self._who_is_at_home(True)
+        last_st, last_ch = self._presence.device(entity)
+        now = dt.now(tz=conf.tz)
+        person, event = self._presence.update(entity, new, now)
 
         if last_st != old:
             self.log('!!BAD TRACKING_STATE_CHANGE "{}" from "{}" [!="{}"'
@@ -185,3 +270,19 @@ class FamilyTracker(appapi.AppDaemon):
         else:
             self.log('TRACKING_STATE_CHANGE "{}" from "{}" [{}] to "{}"'
                      .format(entity, old, last_ch, new))
+
+        # Process person transitions (arrival / departure)
+        if event is None:
+            return
+        self.log('{} of {} ({})'.format(event.upper(), person, entity))
+        self._save_transition(person, event, now.timestamp())
+        if event == DEPARTURE and not self._presence.anybody_home:
+            # Set last person exiting the house (at least for some time)
+            if self._timer_update_target is not None:
+                self.cancel_timer(self._timer_update_target)
+            self._timer_update_target = self.run_in(
+                self._update_target, DELAY_TO_SET_DEFAULT_TARGET)
+        elif event == ARRIVAL and self._timer_update_target is not None:
+            self.cancel_timer(self._timer_update_target)
+            self._timer_update_target = None
+        self._update_target()
@@ -10,13 +10,28 @@ In addition, it also sends notifications when starting the video playback,
 reporting the video info in the message.
 For that, it talks with Kodi through its JSONRPC API by HA service calls.
 
+The media info of the played items (title, message, image url and poster
+file) is cached (LRU, bounded in size), so re-plays or resumed playbacks
+are notified without any new fetch or parsing. With `posters_path`, the
+poster is sent to Telegram as a local file instead of the remote URL: it is
+downloaded in a background worker (out of the play event callback), in a
+file named by the hash of its URL, removed when its entry is evicted from
+the LRU cache.
+
 """
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
+import hashlib
+import os
 from urllib import parse
 import appdaemon.appapi as appapi
 import appdaemon.utils as utils
 from homeassistant.components.media_player.kodi import (
     EVENT_KODI_CALL_METHOD_RESULT)
+import requests
+
+from light_groups import LightGroupController
+from lru_cache import LRUCache
 
 
 LOG_LEVEL = 'DEBUG'
@@ -32,6 +47,11 @@ PARAMS_GET_ITEM = {
                    "thumbnail", "file", "tvshowid", "watchedepisodes",
                    "art", "description", "theme", "dateadded", "runtime",
                    "starttime", "endtime"]}
+MEDIA_CACHE_MAX_ITEMS = 50
+MEDIA_CACHE_MAX_BYTES = 10 * 1024 * 1024
+POSTER_TIMEOUT = 5  # secs
+MASK_POSTER_FILENAME = 'kodi_poster_{}.jpg'
+LIGHTS_TRANSITION = 2  # secs
 TYPE_ITEMS_NOTIFY = ['movie', 'episode']
 TYPE_HA_ITEMS_NOTIFY = ['tvshow', 'movie']
 # TYPE_ITEMS_IGNORE = ['channel', 'unknown']  # grabaciones: 'unknown'
@@ -44,6 +64,15 @@ TELEGRAM_INLINEKEYBOARD_KODI = [
     [('Tª', '/pitemps'), ('Next TvShows', '/tvshowsnext')]]
 
 
+def _item_key(item):
+    """Key of a Kodi item for the media info cache: file, or (type, id)."""
+    if item is None:
+        return None
+    if item.get('file'):
+        return item['file']
+    return item.get('type'), item.get('id')
+
+
 def _get_max_brightness_ambient_lights():
     if utils.now_is_between('09:00:00', '19:00:00'):
         return 200
@@ -60,6 +89,8 @@ class KodiAssistant(appapi.AppDaemon):
 
     _lights = None
     _light_states = {}
+    _light_control = None
+    _ts_playing = None
 
     _media_player = None
     _is_playing_video = False
@@ -70,6 +101,10 @@ class KodiAssistant(appapi.AppDaemon):
     _target_sensor = None
     _ios_notifier = None
 
+    _media_cache = None
+    _posters_path = None
+    _executor = None
+
     def initialize(self):
         """AppDaemon required method for app init."""
         conf_data = dict(self.config['AppDaemon'])
@@ -81,6 +116,7 @@ class KodiAssistant(appapi.AppDaemon):
         self._lights = {"dim": {"on": _lights_dim_on, "off": _lights_dim_off},
                         "off": _lights_off,
                         "state": self.get_state(_switch_dim_group)}
+        self._light_control = LightGroupController(self)
         # Listen for ambilight changes to change light dim group:
         self.listen_state(self.ch_dim_lights_group, _switch_dim_group)
 
@@ -88,6 +124,17 @@ class KodiAssistant(appapi.AppDaemon):
         self._ios_notifier = conf_data.get('notifier').replace('.', '/')
         self._target_sensor = conf_data.get('chatid_sensor')
 
+        # Media info cache (title, message, image url & poster file)
+        self._media_cache = LRUCache(
+            max_items=MEDIA_CACHE_MAX_ITEMS, max_bytes=MEDIA_CACHE_MAX_BYTES,
+            sizeof=lambda info: info['poster_size'],
+            on_evict=self._remove_poster_file)
+        self._posters_path = self.args.get('posters_path', None)
+        if self._posters_path is not None:
+            if not os.path.exists(self._posters_path):
+                os.makedirs(self._posters_path)
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
         # Listen for Kodi changes:
         self._last_play = utils.get_now()
         self.listen_state(self.kodi_state, self._media_player)
@@ -98,6 +145,13 @@ class KodiAssistant(appapi.AppDaemon):
         #          .format(self._lights['dim']['on'], self._lights['dim']['off'],
         #                  self._lights['off']))
 
+    def terminate(self):
+        """AppDaemon method called on app reload."""
+        if self._light_control is not None:
+            self._light_control.shutdown()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
     def _ask_for_playing_item(self):
         self.call_service('media_player/kodi_call_method',
                           entity_id=self._media_player,
@@ -111,8 +165,7 @@ class KodiAssistant(appapi.AppDaemon):
                 and method == METHOD_GET_ITEM:
             if 'item' in result:
                 item = result['item']
-                new_video = (self._item_playing is None
-                             or self._item_playing != item)
+                new_video = _item_key(self._item_playing) != _item_key(item)
                 self._is_playing_video = item['type'] in TYPE_ITEMS_NOTIFY
                 self._item_playing = item
                 delta = utils.get_now() - self._last_play
@@ -121,8 +174,18 @@ class KodiAssistant(appapi.AppDaemon):
                     self._last_play = utils.get_now()
                     self._adjust_kodi_lights(play=True)
                     # Notifications
-                    self._notify_ios_message(self._item_playing)
-                    self._notify_telegram_message(self._item_playing)
+                    media_info = self._get_media_info(self._item_playing)
+                    self._notify_ios_message(media_info)
+                    if (self._executor is not None
+                            and media_info['poster_file'] is None
+                            and self._valid_image_url(media_info['img_url'])):
+                        # Poster download in background, then Telegram msg
+                        future = self._executor.submit(
+                            self._download_poster_and_notify,
+                            _item_key(self._item_playing), media_info)
+                        future.add_done_callback(self._log_future_error)
+                    else:
+                        self._notify_telegram_message(media_info)
             else:
                 self.log('RECEIVED BAD KODI RESULT: {}'
                          .format(result), 'warn')
@@ -180,6 +243,63 @@ class KodiAssistant(appapi.AppDaemon):
             self.log('MESSAGE KeyError: {}; item={}'.format(e, item))
         return title, message, img_url
 
+    def _download_poster(self, img_url):
+        """Download the poster in a local file (named by the URL hash)."""
+        path = os.path.join(self._posters_path, MASK_POSTER_FILENAME.format(
+            hashlib.sha1(img_url.encode()).hexdigest()[:16]))
+        if os.path.exists(path):
+            return path
+        try:
+            r = requests.get(img_url, timeout=POSTER_TIMEOUT)
+            if r.ok:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(r.content)
+                os.rename(path + '.tmp', path)
+                return path
+            self.log('POSTER NOT AVAILABLE ({}): {}'
+                     .format(r.status_code, img_url), 'warn')
+        except (requests.RequestException, OSError) as e:
+            self.log('POSTER DOWNLOAD ERROR: {} [{}]'.format(e, img_url),
+                     'warn')
+        return None
+
+    def _download_poster_and_notify(self, key, media_info):
+        """(In the background worker) poster download + Telegram msg."""
+        path = self._download_poster(media_info['img_url'])
+        if path is not None:
+            media_info = self._media_cache.set(
+                key, dict(media_info, poster_file=path,
+                          poster_size=os.path.getsize(path)))
+        self._notify_telegram_message(media_info)
+
+    def _log_future_error(self, future):
+        if future.exception() is not None:
+            self.log('POSTER WORKER ERROR: {!r}'.format(future.exception()),
+                     'ERROR')
+
+    def _remove_poster_file(self, key, media_info):
+        path = media_info['poster_file']
+        if path is None or any(info['poster_file'] == path
+                               for info in self._media_cache.values()):
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get_media_info(self, item):
+        """Media info of the item, from the LRU cache or resolved now."""
+        key = _item_key(item)
+        media_info = self._media_cache.get(key)
+        if media_info is None:
+            title, message, img_url = self._get_kodi_info_params(item)
+            media_info = self._media_cache.set(
+                key, {"title": title, "message": message,
+                      "img_url": img_url, "poster_file": None,
+                      "poster_size": 0})
+        self.log('MEDIA INFO CACHE: {}'.format(self._media_cache), 'DEBUG')
+        return media_info
+
     def _valid_image_url(self, img_url):
         if (img_url is not None) and img_url.startswith('http'):
             return True
@@ -187,8 +307,9 @@ class KodiAssistant(appapi.AppDaemon):
             self.error('BAD IMAGE URL: {}'.format(img_url), level='ERROR')
         return False
 
-    def _notify_ios_message(self, item):
-        title, message, img_url = self._get_kodi_info_params(item)
+    def _notify_ios_message(self, media_info):
+        title, message = media_info['title'], media_info['message']
+        img_url = media_info['img_url']
         if self._valid_image_url(img_url):
             data_msg = {"title": title, "message": message,
                         "data": {"attachment": {"url": img_url},
@@ -198,14 +319,21 @@ class KodiAssistant(appapi.AppDaemon):
                         "data": {"push": {"category": "kodiplay"}}}
         self.call_service(self._ios_notifier, **data_msg)
 
-    def _notify_telegram_message(self, item):
-        title, message, img_url = self._get_kodi_info_params(item)
+    def _notify_telegram_message(self, media_info):
+        title, message = media_info['title'], media_info['message']
+        img_url = media_info['img_url']
         target = self.get_state(self._target_sensor)
-        if self._valid_image_url(img_url):
+        poster_file = media_info['poster_file']
+        if poster_file is not None and not os.path.exists(poster_file):
+            poster_file = None
+        if poster_file is not None or self._valid_image_url(img_url):
             data_photo = {
-                "url": img_url,
                 "keyboard": TELEGRAM_KEYBOARD_KODI,
                 "disable_notification": True}
+            if poster_file is not None:
+                data_photo["file"] = poster_file
+            else:
+                data_photo["url"] = img_url
             self.call_service('{}/send_photo'.format(self._notifier_bot),
                               target=target, **data_photo)
             message + "\n{}\nEND".format(img_url)
@@ -217,24 +345,26 @@ class KodiAssistant(appapi.AppDaemon):
 
     def _adjust_kodi_lights(self, play=True):
         k_l = self._lights['dim'][self._lights['state']] + self._lights['off']
+        commands = []
+        if play:
+            # Only one bulk read for all the lights
+            self._light_states = self._light_control.snapshot(k_l)
+            max_brightness = _get_max_brightness_ambient_lights()
         for light_id in k_l:
             if play:
-                light_state = self.get_state(light_id)
-                attrs_light = self.get_state(light_id, attribute='attributes')
-                attrs_light.update({"state": light_state})
-                self._light_states[light_id] = attrs_light
-                max_brightness = _get_max_brightness_ambient_lights()
+                attrs_light = self._light_states[light_id]
                 if light_id in self._lights['off']:
                     self.log('Apagando light {} para KODI PLAY'
                              .format(light_id), LOG_LEVEL)
-                    self.call_service(
-                        "light/turn_off", entity_id=light_id, transition=2)
+                    commands.append(("light/turn_off", light_id,
+                                     dict(transition=LIGHTS_TRANSITION)))
                 elif ("brightness" in attrs_light.keys()
                       ) and (attrs_light["brightness"] > max_brightness):
                     self.log('Atenuando light {} para KODI PLAY'
                              .format(light_id), LOG_LEVEL)
-                    self.call_service("light/turn_on", entity_id=light_id,
-                                      transition=2, brightness=max_brightness)
+                    commands.append(("light/turn_on", light_id,
+                                     dict(transition=LIGHTS_TRANSITION,
+                                          brightness=max_brightness)))
             else:
                 try:
                     state_before = self._light_states[light_id]
@@ -252,16 +382,29 @@ class KodiAssistant(appapi.AppDaemon):
                             "brightness": state_before["brightness"]}
                     self.log('Reponiendo light {}, con state_before={}'
                              .format(light_id, state_before), LOG_LEVEL)
-                    self.call_service("light/turn_on", entity_id=light_id,
-                                      transition=2, **new_state_attrs)
+                    new_state_attrs.update(transition=LIGHTS_TRANSITION)
+                    commands.append(("light/turn_on", light_id,
+                                     new_state_attrs))
                 else:
                     self.log('Doing nothing with light {}, state_before={}'
                              .format(light_id, state_before), LOG_LEVEL)
+        if commands:
+            took = self._light_control.apply(commands)
+            since = took
+            if play and self._ts_playing is not None:
+                since = (utils.get_now() - self._ts_playing).total_seconds()
+            self.log('LIGHTS {} ({} lights): commands in {:.2f} s, settled '
+                     '~{:.2f} s after {}'.format(
+                         'DIMMED' if play else 'RESTORED', len(commands),
+                         took, since + LIGHTS_TRANSITION,
+                         'KODI PLAY' if play else 'KODI STOP'), LOG_LEVEL)
+        self._ts_playing = None
 
     # noinspection PyUnusedLocal
     def kodi_state(self, entity, attribute, old, new, kwargs):
         """Kodi state change main control."""
         if new == 'playing':
+            self._ts_playing = utils.get_now()
             kodi_attrs = self.get_state(
                 entity_id=self._media_player, attribute="attributes")
             self._is_playing_video = (
@@ -9,16 +9,53 @@ It reacts to `kodi_call_method_result` events, when the used API method is:
     - VideoLibrary.GetRecentlyAddedMovies
     - VideoLibrary.GetRecentlyAddedEpisodes
     - PVR.GetChannels
+
+The results are kept in a bounded cache per media type, keyed by Kodi id,
+with a cheap fingerprint of each item, so the options of the unchanged
+items are reused, and the `input_select` options are only set when the
+visible options change (a result without differences with the previous
+one does nothing).
 """
 
 import appdaemon.appapi as appapi
 from homeassistant.components.media_player.kodi import (
     EVENT_KODI_CALL_METHOD_RESULT)
 
+from lru_cache import LRUCache
+
 ENTITY = 'input_select.kodi_results'
 MEDIA_PLAYER = 'media_player.kodi'
 DEFAULT_ACTION = "Nada que hacer"
 MAX_RESULTS = 20
+MAX_CACHED_ITEMS = 200
+
+# Kodi method: (result key, id key, media type, friendly_name, icon)
+LIBRARY_METHODS = {
+    'VideoLibrary.GetRecentlyAddedMovies': (
+        'movies', 'movieid', 'MOVIE', 'Recent Movies', 'mdi:movie'),
+    'VideoLibrary.GetRecentlyAddedEpisodes': (
+        'episodes', 'episodeid', 'TVSHOW', 'Recent TvShows',
+        'mdi:play-circle'),
+    'PVR.GetChannels': (
+        'channels', 'channelid', 'CHANNEL', 'TV channels',
+        'mdi:play-box-outline')}
+
+
+def _fingerprint(item):
+    """Fields of a result item used in its option."""
+    return (item.get('label'), item.get('year'), item.get('showtitle'),
+            item.get('file'), item.get('lastplayed'), item.get('channelid'))
+
+
+def _make_option(mediatype, item):
+    """(label, (mediatype, file or channel id, last played)) of a result."""
+    if mediatype == 'MOVIE':
+        return ('{} ({})'.format(item['label'], item['year']),
+                (mediatype, item['file'], None))
+    elif mediatype == 'TVSHOW':
+        return ('{} - {}'.format(item['showtitle'], item['label']),
+                (mediatype, item['file'], item['lastplayed']))
+    return item['label'], (mediatype, item['channelid'], None)
 
 
 # noinspection PyClassHasNoInit
@@ -27,6 +64,9 @@ class DynamicKodiInputSelect(appapi.AppDaemon):
 
     _ids_options = None
     _last_values = None
+    _last_mediatype = None
+    _library = None
+    _library_ids = None
 
     def initialize(self):
         """Set up appdaemon app."""
@@ -37,70 +77,97 @@ class DynamicKodiInputSelect(appapi.AppDaemon):
         # Input select:
         self._ids_options = {DEFAULT_ACTION: None}
         self._last_values = []
+        # Library cache per media type: Kodi id -> (fingerprint, option)
+        self._library = {mediatype: LRUCache(max_items=MAX_CACHED_ITEMS)
+                         for _, _, mediatype, _, _ in LIBRARY_METHODS.values()}
+        self._library_ids = {mediatype: [] for mediatype in self._library}
+
+    def _update_library(self, mediatype, items, id_key):
+        """Apply the differences of a new result to the library cache.
+
+        Returns the list of (label, value) options, in the result order,
+        and True if there are differences with the previous result."""
+        cache = self._library[mediatype]
+        ids, options, num_new, num_changed = [], [], 0, 0
+        for item in items:
+            kodi_id = item.get(id_key, item.get('file'))
+            ids.append(kodi_id)
+            fingerprint = _fingerprint(item)
+            cached = cache.get(kodi_id)
+            if cached is not None and cached[0] == fingerprint:
+                options.append(cached[1])
+                continue
+            if cached is None:
+                num_new += 1
+            else:
+                num_changed += 1
+            option = _make_option(mediatype, item)
+            cache.set(kodi_id, (fingerprint, option))
+            options.append(option)
+        removed = set(self._library_ids[mediatype]) - set(ids)
+        for kodi_id in removed:
+            cache.pop(kodi_id)
+        num_removed = len(removed)
+        changed = ids != self._library_ids[mediatype]
+        self._library_ids[mediatype] = ids
+        if num_new or num_changed or num_removed:
+            changed = True
+            self.log('{} LIBRARY: {} new, {} changed, {} removed ({})'
+                     .format(mediatype, num_new, num_changed, num_removed,
+                             cache), 'DEBUG')
+        return options, changed
+
+    def _set_options(self, mediatype, options, friendly_name, icon):
+        labels = [label for label, _ in options]
+        if mediatype == self._last_mediatype and labels == self._last_values:
+            self.log('SAME {} OPTIONS ({}), no changes'
+                     .format(mediatype, len(labels)), 'DEBUG')
+            return False
+        self._ids_options = {DEFAULT_ACTION: None}
+        self._ids_options.update(options)
+        self._last_values = labels
+        self._last_mediatype = mediatype
+        self.log('{} NEW {} OPTIONS:\n{}'.format(len(labels), mediatype, labels))
+        self.call_service('input_select/set_options', entity_id=ENTITY,
+                          options=[DEFAULT_ACTION] + labels)
+        self.set_state(ENTITY, attributes={"friendly_name": friendly_name,
+                                           "icon": icon})
+        return True
 
     # noinspection PyUnusedLocal
     def _receive_kodi_result(self, event_id, payload_event, *args):
         result = payload_event['result']
         method = payload_event['input']['method']
 
-        if event_id == EVENT_KODI_CALL_METHOD_RESULT:
-            if method == 'VideoLibrary.GetRecentlyAddedMovies':
-                # values = list(filter(lambda r: not r['lastplayed'],
-                #                      result['movies']))[:MAX_RESULTS]
-                values = result['movies'][:MAX_RESULTS]
-                data = [('{} ({})'.format(r['label'], r['year']),
-                         ('MOVIE', r['file'], None)) for r in values]
-                self._ids_options.update(dict(zip(*zip(*data))))
-                labels = list(list(zip(*data))[0])
-                self._last_values = labels
-                self.log('{} NEW MOVIE OPTIONS:\n{}'
-                         .format(len(labels), labels))
-                self.call_service('input_select/set_options', entity_id=ENTITY,
-                                  options=[DEFAULT_ACTION] + labels)
-                self.set_state(ENTITY,
-                               attributes={"friendly_name": 'Recent Movies',
-                                           "icon": 'mdi:movie'})
-            elif method == 'VideoLibrary.GetRecentlyAddedEpisodes':
-                values = result['episodes']
-                data = [('{} - {}'.format(r['showtitle'], r['label']),
-                         ('TVSHOW', r['file'], r['lastplayed']))
-                        for r in values]
-                d_data = dict(zip(*zip(*data)))
-                labels = list(list(zip(*data))[0])
-                if not self._last_values or \
-                        not all(map(lambda x: x in labels, self._last_values)):
+        if event_id == EVENT_KODI_CALL_METHOD_RESULT \
+                and method in LIBRARY_METHODS:
+            key, id_key, mediatype, friendly_name, icon = \
+                LIBRARY_METHODS[method]
+            options, changed = self._update_library(
+                mediatype, result.get(key, []), id_key)
+            if not changed and mediatype == self._last_mediatype \
+                    and mediatype != 'TVSHOW':
+                # (TVSHOW options also depend on the number of presses)
+                self.log('SAME {} RESULT, no changes'.format(mediatype),
+                         'DEBUG')
+                return
+            if mediatype == 'MOVIE':
+                # options = [o for o in options if not o[1][2]]
+                options = options[:MAX_RESULTS]
+            elif mediatype == 'TVSHOW':
+                labels = [label for label, _ in options]
+                if not self._last_values \
+                        or self._last_mediatype != mediatype or not all(
+                        map(lambda x: x in labels, self._last_values)):
                     # First press --> filter non watched episodes
-                    data = filter(lambda x: not x[1][2], data)
-                    labels = list(list(zip(*data))[0])
-                self.log('{} NEW TVSHOW OPTIONS:\n{}'
-                         .format(len(labels), labels))
-                self._ids_options.update(d_data)
-
-                self._last_values = labels
-                self.call_service('input_select/set_options', entity_id=ENTITY,
-                                  options=[DEFAULT_ACTION] + labels)
-                self.set_state(ENTITY,
-                               attributes={"friendly_name": 'Recent TvShows',
-                                           "icon": 'mdi:play-circle'})
-            elif method == 'PVR.GetChannels':
-                values = result['channels']
-                data = [(r['label'], ('CHANNEL', r['channelid'], None))
-                        for r in values]
-                self._ids_options.update(dict(zip(*zip(*data))))
-                labels = list(list(zip(*data))[0])
-                self._last_values = labels
-                self.log('{} NEW PVR OPTIONS:\n{}'.format(len(labels), labels))
-                self.call_service('input_select/set_options', entity_id=ENTITY,
-                                  options=[DEFAULT_ACTION] + labels)
-                self.set_state(ENTITY,
-                               attributes={"friendly_name": 'TV channels',
-                                           "icon": 'mdi:play-box-outline'})
+                    options = [o for o in options if not o[1][2]]
+            self._set_options(mediatype, options, friendly_name, icon)
 
     # noinspection PyUnusedLocal
     def _change_selected_result(self, entity, attribute, old, new, kwargs):
         if new != old:
             # self.log('SELECTED OPTION: {} (from {})'.format(new, old))
-            selected = self._ids_options[new]
+            selected = self._ids_options.get(new)
             if selected:
                 mediatype, file, _last_played = selected
                 self.log('PLAY MEDIA: {} {} [file={}]'
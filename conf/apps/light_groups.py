@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: grouped & concurrent light control.
+
+Light states are read in one bulk `get_state('light')` (a snapshot of all
+lights), and the light commands are grouped by service and identical
+parameters, so each group is only one HA service call (with a list of
+`entity_id`). The service calls of the different groups run concurrently
+in a small thread pool, and the elapsed time is returned to report it:
+
+```
+    lights = LightGroupController(self)
+    states = lights.snapshot(['light.one', 'light.two'])
+    took = lights.apply([('light/turn_off', 'light.one', {'transition': 2}),
+                         ('light/turn_off', 'light.two', {'transition': 2})])
+    ...
+    lights.shutdown()  # in the `terminate` method of the app
+```
+
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def group_commands(commands):
+    """Group (service, entity_id, params) commands with the same service
+    and params: returns a list of (service, [entity_ids], params)."""
+    groups = OrderedDict()
+    for service, entity_id, params in commands:
+        key = (service, _freeze(params))
+        if key not in groups:
+            groups[key] = (service, [], params)
+        groups[key][1].append(entity_id)
+    return list(groups.values())
+
+
+class LightGroupController(object):
+    """Bulk state snapshots and grouped/concurrent light service calls."""
+
+    def __init__(self, app, max_workers=DEFAULT_MAX_WORKERS):
+        self._app = app
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def snapshot(self, light_ids):
+        """States of the lights (attributes + 'state'), in one bulk read."""
+        all_lights = self._app.get_state('light') or {}
+        states = {}
+        for light_id in light_ids:
+            st = all_lights.get(light_id)
+            if st is None:
+                states[light_id] = {}
+                continue
+            attrs = dict(st.get('attributes', {}))
+            attrs['state'] = st.get('state')
+            states[light_id] = attrs
+        return states
+
+    def _call(self, service, entity_ids, params):
+        self._app.call_service(service, entity_id=','.join(entity_ids),
+                               **params)
+
+    def apply(self, commands):
+        """Run the commands (grouped & concurrently). Returns the secs."""
+        tic = time()
+        futures = [self._executor.submit(self._call, *group)
+                   for group in group_commands(commands)]
+        for f in futures:
+            f.result()
+        return time() - tic
+
+    def shutdown(self):
+        """Stop the thread pool."""
+        self._executor.shutdown(wait=False)
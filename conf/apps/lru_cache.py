@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: bounded in-memory LRU cache.
+
+A thread-safe LRU mapping over an `OrderedDict`, bounded by the number of
+items and/or by the total size of the values (with a `sizeof` function),
+with an optional TTL for the entries, and an optional `on_evict(key, value)`
+callback for the evicted entries (to remove files associated to them):
+
+```
+    self._cache = LRUCache(max_items=50, max_bytes=5e6,
+                           sizeof=lambda info: len(info['poster'] or b''))
+    info = self._cache.get(key)
+    if info is None:
+        info = self._cache.set(key, make_info(item))
+```
+
+"""
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+
+class LRUCache(object):
+    """Size-bounded LRU cache, with optional TTL."""
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None,
+                 ttl=None, clock=time, on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof or (lambda value: 0)
+        self._clock = clock
+        self._on_evict = on_evict
+        self._lock = RLock()
+        self._data = OrderedDict()  # key -> (value, size, ts)
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    @property
+    def size_bytes(self):
+        """Total size of the cached values (with `sizeof`)."""
+        return self._bytes
+
+    def _get_entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and self.ttl is not None \
+                and self._clock() - entry[2] > self.ttl:
+            self._remove(key)
+            entry = None
+        return entry
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        """Cached value (marked as recently used), or `default`."""
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Cache a value, evicting the least recently used ones if needed.
+
+        Returns the value."""
+        size = self._sizeof(value)
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, self._clock())
+            self._bytes += size
+            while len(self._data) > 1 and (
+                    (self.max_items is not None
+                     and len(self._data) > self.max_items)
+                    or (self.max_bytes is not None
+                        and self._bytes > self.max_bytes)):
+                old_key = next(iter(self._data))
+                evicted.append((old_key, self._data[old_key][0]))
+                self._remove(old_key)
+                self.evictions += 1
+        if self._on_evict is not None:
+            for old_key, old_value in evicted:
+                self._on_evict(old_key, old_value)
+        return value
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value (or `default`)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def keys(self):
+        """Cached keys, from least to most recently used."""
+        with self._lock:
+            return list(self._data.keys())
+
+    def values(self):
+        """Cached values, from least to most recently used."""
+        with self._lock:
+            return [v for v, _, _ in self._data.values()]
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __repr__(self):
+        return ('<LRUCache: {} items, {} bytes, {} hits, {} misses, '
+                '{} evictions>'.format(len(self), self._bytes, self.hits,
+                                       self.misses, self.evictions))
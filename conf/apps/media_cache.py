@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: local disk cache of media files.
+
+Downloads run in a background thread (not in the AppDaemon worker pool),
+are resumable (partial `.part` files continue with HTTP `Range` requests),
+and the disk usage of the cache dir is capped, evicting the least recently
+used files (by mtime, which is touched on each use). Partial downloads not
+resumed in `partial_max_age` seconds are removed too:
+
+```
+    self._media = MediaDiskCache(os.path.join(path_base_data, 'lacafetera'))
+    ...
+    self._media.download_async(ep_id, url)  # when a new episode is published
+    ...
+    path = self._media.get(ep_id)  # local file or None
+```
+
+"""
+import os
+from threading import Lock, Thread
+from time import time
+
+import requests
+
+
+DEFAULT_MAX_SIZE_MB = 500
+DEFAULT_TIMEOUT = 10  # secs
+CHUNK_SIZE = 256 * 1024
+PARTIAL_EXT = '.part'
+DEFAULT_PARTIAL_MAX_AGE = 6 * 3600  # secs
+
+
+class MediaDiskCache(object):
+    """LRU-capped directory of downloaded media files."""
+
+    def __init__(self, path, max_size_mb=DEFAULT_MAX_SIZE_MB, ext='.mp3',
+                 timeout=DEFAULT_TIMEOUT, session=None, logger=None,
+                 partial_max_age=DEFAULT_PARTIAL_MAX_AGE):
+        self.path = path
+        self.partial_max_age = partial_max_age
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.ext = ext
+        self.timeout = timeout
+        self._session = session or requests.Session()
+        self._logger = logger
+        self._lock = Lock()
+        self._downloading = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _log(self, msg, level='INFO'):
+        if self._logger is not None:
+            self._logger(msg, level)
+
+    def file_path(self, key):
+        """Path of the (complete) local file of `key`."""
+        return os.path.join(self.path, '{}{}'.format(key, self.ext))
+
+    def get(self, key):
+        """Path of the local file of `key` (marked as used), or None."""
+        path = self.file_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return path
+
+    def is_downloading(self, key):
+        """True if `key` is being downloaded."""
+        with self._lock:
+            return key in self._downloading
+
+    def download_async(self, key, url):
+        """Download `url` as `key` in a background thread (if not cached).
+
+        Returns True if a new download has been started."""
+        if os.path.exists(self.file_path(key)):
+            return False
+        with self._lock:
+            if key in self._downloading:
+                return False
+            th = Thread(target=self.download, args=(key, url),
+                        name='download_{}'.format(key), daemon=True)
+            self._downloading[key] = th
+        th.start()
+        return True
+
+    def download(self, key, url):
+        """Download (or resume) `url` as `key`. Returns the local path."""
+        path = self.file_path(key)
+        path_part = path + PARTIAL_EXT
+        try:
+            offset = (os.path.getsize(path_part)
+                      if os.path.exists(path_part) else 0)
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            with self._session.get(url, headers=headers, stream=True,
+                                   timeout=self.timeout) as r:
+                if r.status_code == 416:  # already complete
+                    pass
+                elif not r.ok:
+                    self._log('DOWNLOAD ERROR {} ({}): HTTP {}'.format(
+                        key, url, r.status_code), 'WARNING')
+                    return None
+                else:
+                    if r.status_code != 206:  # no resume support
+                        offset = 0
+                    total = int(r.headers.get('Content-Length', 0)) + offset
+                    self._evict(total - offset)
+                    with open(path_part, 'ab' if offset else 'wb') as f:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+            os.rename(path_part, path)
+            self._log('DOWNLOADED {} ({:.1f} MB{})'.format(
+                key, os.path.getsize(path) / 1048576.,
+                ', resumed at {:.1f} MB'.format(offset / 1048576.)
+                if offset else ''))
+            self._evict(0, keep=path)
+            return path
+        except (requests.RequestException, OSError) as exc:
+            # The partial file remains, to resume it later
+            self._log('DOWNLOAD ERROR {}: {}'.format(key, exc), 'WARNING')
+            return None
+        finally:
+            with self._lock:
+                self._downloading.pop(key, None)
+
+    def size(self):
+        """Bytes used in the cache dir."""
+        return sum(os.path.getsize(os.path.join(self.path, f))
+                   for f in os.listdir(self.path))
+
+    def _evict(self, needed, keep=None):
+        """Remove the least recently used files until `needed` bytes fit."""
+        files = []
+        with self._lock:
+            downloading = set(self.file_path(k) + PARTIAL_EXT
+                              for k in self._downloading)
+        ts_stale = time() - self.partial_max_age
+        for f in os.listdir(self.path):
+            p = os.path.join(self.path, f)
+            st = os.stat(p)
+            if (p.endswith(PARTIAL_EXT) and p not in downloading
+                    and st.st_mtime < ts_stale):
+                # Stale partial download (interrupted and never resumed)
+                os.remove(p)
+                self._log('REMOVED STALE PARTIAL DOWNLOAD {} ({:.1f} MB)'
+                          .format(p, st.st_size / 1048576.))
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        used = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if used + needed <= self.max_bytes:
+                break
+            if p == keep or p.endswith(PARTIAL_EXT):
+                continue
+            os.remove(p)
+            used -= size
+            self._log('EVICTED {} ({:.1f} MB)'.format(p, size / 1048576.))
+
+    def __repr__(self):
+        return '<MediaDiskCache: {}, {:.1f} of {:.0f} MB>'.format(
+            self.path, self.size() / 1048576., self.max_bytes / 1048576.)
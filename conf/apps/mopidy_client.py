@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: JSON-RPC client for Mopidy.
+
+Uses a persistent HTTP session (keep-alive) with request timeouts, and
+supports JSON-RPC batch requests, so a sequence of commands (like
+clear + add + volume + play) is only one round-trip. The latency of each
+call is measured and accumulated per method:
+
+```
+    mopidy = MopidyClient('192.168.1.10', 6680)
+    results = mopidy.batch([('core.tracklist.clear', None),
+                            ('core.tracklist.add', {'uris': [url]}),
+                            ('core.playback.play', None)])
+    mopidy.call('core.mixer.set_volume', volume=10)
+```
+
+"""
+from itertools import count
+from threading import Lock
+from time import time
+
+import requests
+
+
+DEFAULT_TIMEOUT = 5  # secs
+
+
+class MopidyError(Exception):
+    """Error response from the Mopidy JSON-RPC API."""
+
+    def __init__(self, method, error):
+        self.method = method
+        self.error = error
+        super(MopidyError, self).__init__('{}: {}'.format(method, error))
+
+
+class MopidyClient(object):
+    """Mopidy JSON-RPC client (pooled session, batching, latency stats)."""
+
+    def __init__(self, host, port=6680, timeout=DEFAULT_TIMEOUT,
+                 session=None):
+        self.url = 'http://{}:{}/mopidy/rpc'.format(host, port)
+        self.timeout = timeout
+        self._session = session or requests.Session()
+        self._session.headers.update({'Content-Type': 'application/json'})
+        self._ids = count(1)
+        self._lock = Lock()
+        # method -> [num calls, total secs, max secs]
+        self._latency = {}
+
+    def _payload(self, method, params):
+        payload = {"method": method, "jsonrpc": "2.0", "id": next(self._ids)}
+        if params is not None:
+            payload.update(params=params)
+        return payload
+
+    def _post(self, payload, methods):
+        tic = time()
+        try:
+            r = self._session.post(self.url, json=payload,
+                                   timeout=self.timeout)
+        finally:
+            took = time() - tic
+            with self._lock:
+                for m in methods:
+                    stats = self._latency.setdefault(m, [0, 0., 0.])
+                    stats[0] += 1
+                    stats[1] += took
+                    stats[2] = max(stats[2], took)
+        r.raise_for_status()
+        return r.json()
+
+    def request(self, method, params=None):
+        """Raw JSON-RPC response (dict) of one call."""
+        return self._post(self._payload(method, params), [method])
+
+    def call(self, method, **params):
+        """Result of one call. Raises `MopidyError` with error responses."""
+        res = self.request(method, params or None)
+        if 'error' in res:
+            raise MopidyError(method, res['error'])
+        return res.get('result')
+
+    def batch(self, commands):
+        """Run a list of (method, params) in one JSON-RPC batch request.
+
+        Returns the list of raw responses (dicts), in the same order.
+        Raises `ValueError` if the whole batch is rejected (one error
+        response instead of the list)."""
+        payload = [self._payload(method, params)
+                   for method, params in commands]
+        methods = [method for method, _ in commands]
+        responses = self._post(payload, methods)
+        if not isinstance(responses, list):
+            raise ValueError('Mopidy batch rejected: {}'.format(
+                responses.get('error', responses)
+                if isinstance(responses, dict) else responses))
+        by_id = {res.get('id'): res for res in responses}
+        return [by_id.get(p['id'], {'error': 'no response'})
+                for p in payload]
+
+    def latency_stats(self):
+        """Dict of method -> (num calls, mean secs, max secs)."""
+        with self._lock:
+            return {m: (n, total / n, max_took)
+                    for m, (n, total, max_took) in self._latency.items()}
+
+    def __repr__(self):
+        return '<MopidyClient: {}, {} methods called>'.format(
+            self.url, len(self._latency))
@@ -13,16 +13,35 @@ For doing that, it talks directly with Kodi (or Mopidy, without any add-on)
 through its JSONRPC API, which has to run a specific Kodi Add-On:
     `plugin.audio.lacafetera`
 
+The info of the last episode is cached in memory and prefetched in the
+background before the alarm time, so the alarm sequence never waits on the
+Spreaker API (with a network failure, the last known episode is used).
+When waiting for the start of the broadcast, an adaptive poller (tighter
+around the usual emission time) detects the new episode, fires the
+`lacafetera_new_episode` event and starts the alarm playback.
+
+With `path_base_data` defined, the last recorded episode is downloaded in
+background (capped disk cache, with LRU eviction). With `mopidy_media_uri`
+defined too, Mopidy plays the local file when available, instead of the
+remote stream. It is the URI of the cache dir as seen by Mopidy (which may
+run in another host): a `file:///...` path of a shared mount included in
+the `media_dirs` of the Mopidy `file` backend. Without it, Mopidy always
+plays the stream URL.
+
 """
 import appdaemon.appapi as appapi
 import appdaemon.conf as conf
 import datetime as dt
 from dateutil.parser import parse
 from functools import reduce
-import json
-import pytz
+import os
 import requests
 
+from media_cache import MediaDiskCache
+from mopidy_client import MopidyClient
+from timeline import Timeline, EASING_CURVES
+from spreaker import (EpisodeCache, EpisodePoller, episodes_url,
+                      parse_episode, DEFAULT_TIMEOUT)
 
 LOG_LEVEL = 'INFO'
 
@@ -30,6 +49,8 @@ LOG_LEVEL = 'INFO'
 MIN_VOLUME = 1
 DEFAULT_MAX_VOLUME_MOPIDY = 60
 DEFAULT_DURATION_VOLUME_RAMP = 120
+DEFAULT_VOLUME_EASING = 'linear'
+DEFAULT_TIMELINE_STEP = 5  # secs
 DEFAULT_DURATION = 1.2  # h
 DEFAULT_EMISION_TIME = "08:30:00"
 DEFAULT_MIN_POSPONER = 9
@@ -37,6 +58,10 @@ MAX_WAIT_TIME = dt.timedelta(minutes=10)
 STEP_RETRYING_SEC = 20
 WARM_UP_TIME_DELTA = dt.timedelta(seconds=25)
 MIN_INTERVAL_BETWEEN_EPS = dt.timedelta(hours=8)
+EVENT_NEW_EPISODE = 'lacafetera_new_episode'
+PREFETCH_TIME_DELTA = dt.timedelta(minutes=3)
+DIR_EPISODES = 'lacafetera'
+DEFAULT_EPISODES_CACHE_MB = 500
 MASK_URL_STREAM_MOPIDY = "http://api.spreaker.com/listen/episode/{}/http"
 # TELEGRAM_KEYBOARD_ALARMCLOCK = ['/ducha', '/posponer',
 #                                 '/despertadoroff', '/hasswiz, /init']
@@ -60,40 +85,38 @@ SUNRISE_PHASES = [
 def get_info_last_ep(tz, limit=1):
     """Extrae la información del último (o 'n-último')
     episodio disponible de La Cafetera de Radiocable.com"""
-    base_url_v2 = 'https://api.spreaker.com/v2/'
-    cafetera_showid = 1060718
-    duration = None
-    mask_url = base_url_v2 + 'shows/' + str(cafetera_showid) \
-        + '/episodes?limit=' + str(limit)
-    r = requests.get(mask_url)
+    try:
+        r = requests.get(episodes_url(limit=limit), timeout=DEFAULT_TIMEOUT)
+    except requests.RequestException:
+        return False, None
     if r.ok:
         data = r.json()
         if ('response' in data) and ('items' in data['response']):
-            episode = data['response']['items'][-1]
-            published = parse(episode['published_at']).replace(
-                tzinfo=pytz.UTC).astimezone(tz).replace(tzinfo=None)
-            is_live = episode['type'] == 'LIVE'
-            if not is_live:
-                duration = dt.timedelta(seconds=episode['duration'] / 1000)
-            return True, {'published': published,
-                          'is_live': is_live,
-                          'duration': duration,
-                          'episode': episode}
+            return True, parse_episode(data['response']['items'][-1], tz)
         return False, data
     return False, None
 
 
-def is_last_episode_ready_for_play(now, tz):
+def estimated_emision_time(now):
+    """Hora estimada de comienzo de La Cafetera para el día de `now`."""
+    return dt.datetime.combine(now.date(),
+                               parse(DEFAULT_EMISION_TIME).time())
+
+
+def is_last_episode_ready_for_play(now, tz, episodes=None):
     """Comprueba si hay un nuevo episodio disponible de La Cafetera.
 
     :param now: appdaemon datetime.now()
     :param tz: timezone, para corregir las fechas en UTC a local
+    :param episodes: EpisodeCache (lectura en memoria, sin red)
     :return: (play_now, info_last_episode)
     :rtype: tuple(bool, dict)
     """
-    est_today = dt.datetime.combine(now.date(),
-                                    parse(DEFAULT_EMISION_TIME).time())
-    ok, info = get_info_last_ep(tz)
+    est_today = estimated_emision_time(now)
+    if episodes is not None:
+        ok, info = episodes.get()
+    else:
+        ok, info = get_info_last_ep(tz)
     if ok:
         if (info['is_live'] or
                 (now - info['published'] < MIN_INTERVAL_BETWEEN_EPS) or
@@ -164,6 +187,8 @@ class AlarmClock(appapi.AppDaemon):
     _delta_time_postponer_sec = None
     _max_volume = None
     _volume_ramp_sec = None
+    _volume_easing = None
+    _timeline = None
     _weekdays_alarm = None
     _notifier = None
     _transit_time = None
@@ -180,9 +205,18 @@ class AlarmClock(appapi.AppDaemon):
     _media_player_mopidy = None
     _mopidy_ip = None
     _mopidy_port = None
+    _mopidy = None
+    _mopidy_media_uri = None
+
+    _episodes = None
+    _media = None
+    _poller = None
+    _waiting_episode = False
+    _handle_wait = None
 
     _next_alarm = None
     _handle_alarm = None
+    _handle_prefetch = None
     _last_trigger = None
     _in_alarm_mode = False
     _handler_turnoff = None
@@ -199,6 +233,15 @@ class AlarmClock(appapi.AppDaemon):
         self._volume_ramp_sec = int(
             self.args.get('duration_volume_ramp_sec',
                           DEFAULT_DURATION_VOLUME_RAMP))
+        self._volume_easing = self.args.get(
+            'volume_easing', DEFAULT_VOLUME_EASING)
+        if self._volume_easing not in EASING_CURVES:
+            self.log('Unknown volume_easing "{}" (options: {})'.format(
+                self._volume_easing, ', '.join(EASING_CURVES)), 'WARNING')
+            self._volume_easing = DEFAULT_VOLUME_EASING
+        # Timeline for the sunrise phases & volume ramp (one timer)
+        self._timeline = Timeline(self, step=int(self.args.get(
+            'timeline_step_sec', DEFAULT_TIMELINE_STEP)))
         self._weekdays_alarm = [_weekday(d) for d in self.args.get(
             'alarmdays', 'mon,tue,wed,thu,fri').split(',') if _weekday(d) >= 0]
         self.listen_state(self.alarm_time_change, self._alarm_time_sensor)
@@ -214,6 +257,8 @@ class AlarmClock(appapi.AppDaemon):
         self._media_player_mopidy = conf_data.get('media_player_mopidy')
         self._mopidy_ip = conf_data.get('mopidy_ip')
         self._mopidy_port = int(conf_data.get('mopidy_port'))
+        self._mopidy = MopidyClient(self._mopidy_ip, self._mopidy_port)
+        self._mopidy_media_uri = self.args.get('mopidy_media_uri', None)
         self._target_sensor = conf_data.get('chatid_sensor')
 
         # Trigger for last episode and boolean for play status
@@ -232,6 +277,21 @@ class AlarmClock(appapi.AppDaemon):
             self._phases_sunrise = SUNRISE_PHASES.copy()
         self._transit_time = total_duration // len(self._phases_sunrise) + 1
 
+        # Episode info cache (Spreaker API)
+        self._episodes = EpisodeCache(self._tz)
+        self._poller = EpisodePoller(self, self._episodes,
+                                     self._new_episode_published,
+                                     stop_after=MAX_WAIT_TIME)
+        path_base_data = self.args.get(
+            'path_base_data', conf_data.get('path_base_data'))
+        if path_base_data is not None:
+            self._media = MediaDiskCache(
+                os.path.join(path_base_data, DIR_EPISODES),
+                max_size_mb=float(self.args.get(
+                    'episodes_cache_max_mb', DEFAULT_EPISODES_CACHE_MB)),
+                logger=self.log)
+        self.run_in(self.prefetch_episodes, 1)
+
         self._set_new_alarm_time()
         self.log('INIT WITH NEXT ALARM IN: {:%d-%m-%Y %H:%M:%S} ({})'
                  .format(self._next_alarm, self._selected_player), LOG_LEVEL)
@@ -256,6 +316,45 @@ class AlarmClock(appapi.AppDaemon):
         self.call_service(self._notifier.replace('.', '/'),
                           **_make_ios_notification_episode(ep_info))
 
+    # noinspection PyUnusedLocal
+    def start_episode_poller(self, kwargs):
+        """Prefetch & poll for the new episode around the emission time."""
+        self._poller.start(estimated_emision_time(self.datetime()))
+
+    def _new_episode_published(self, ep_info):
+        """Callback of the episode poller: new episode (or LIVE) found."""
+        self.log('NEW EPISODE PUBLISHED ({}): {} ({} polls)'.format(
+            'LIVE' if ep_info['is_live'] else 'RECORDED',
+            ep_info['episode']['title'], self._poller.num_polls), LOG_LEVEL)
+        self.fire_event(EVENT_NEW_EPISODE,
+                        episode_id=ep_info['episode']['episode_id'],
+                        title=ep_info['episode']['title'],
+                        is_live=ep_info['is_live'])
+        if self._waiting_episode:
+            self.trigger_service_in_alarm()
+        self.download_last_episode()
+
+    def download_last_episode(self):
+        """Download the last recorded episode to the local media cache."""
+        ok, ep_info = self._episodes.get()
+        if ok and not ep_info['is_live'] and self._media is not None:
+            ep_id = ep_info['episode']['episode_id']
+            if self._media.download_async(
+                    ep_id, MASK_URL_STREAM_MOPIDY.format(ep_id)):
+                self.log('DOWNLOADING EPISODE {} ({})'.format(
+                    ep_id, ep_info['episode']['title']), LOG_LEVEL)
+
+    # noinspection PyUnusedLocal
+    def prefetch_episodes(self, kwargs):
+        """Revalidate the cached episode info (in background)."""
+        if self._episodes.fetch(force=kwargs.get('force', True)):
+            self.log('NEW EPISODE: {}'.format(
+                self._episodes.get()[1]['episode']['title']), LOG_LEVEL)
+        elif self._episodes.last_error is not None:
+            self.log('EPISODES PREFETCH: {} (last error: {})'.format(
+                self._episodes, self._episodes.last_error), 'DEBUG')
+        self.download_last_episode()
+
     # noinspection PyUnusedLocal
     def change_player(self, entity, attribute, old, new, kwargs):
         """Change player."""
@@ -266,6 +365,8 @@ class AlarmClock(appapi.AppDaemon):
     # noinspection PyUnusedLocal
     def turn_off_alarm_clock(self, *args):
         """Stop current play when turning off the input_boolean."""
+        self._cancel_waiting_episode()
+        self._timeline.cancel()
         if self._in_alarm_mode:
             if self.play_in_kodi and (self.get_state(
                     entity_id=self._media_player_kodi) == 'playing'):
@@ -294,6 +395,13 @@ class AlarmClock(appapi.AppDaemon):
         self._in_alarm_mode = False
         self._handler_turnoff = None
 
+    def _cancel_waiting_episode(self):
+        self._waiting_episode = False
+        self._poller.stop()
+        if self._handle_wait is not None:
+            self.cancel_timer(self._handle_wait)
+            self._handle_wait = None
+
     # noinspection PyUnusedLocal
     def manual_triggering(self, entity, attribute, old, new, kwargs):
         """Start reproduction manually."""
@@ -303,8 +411,10 @@ class AlarmClock(appapi.AppDaemon):
         if (new == 'on') and ((self._last_trigger is None)
                               or ((dt.datetime.now() - self._last_trigger)
                                   .total_seconds() > 30)):
+            # (bounded by the API timeout, with fallback to the cached ep)
+            self._episodes.fetch()
             _ready, ep_info = is_last_episode_ready_for_play(
-                self.datetime(), self._tz)
+                self.datetime(), self._tz, self._episodes)
             self.log('TRIGGER_START with ep_ready, ep_info --> {}, {}'
                      .format(_ready, ep_info))
             if self.play_in_kodi:
@@ -334,6 +444,8 @@ class AlarmClock(appapi.AppDaemon):
     def _set_new_alarm_time(self, *args):
         if self._handle_alarm is not None:
             self.cancel_timer(self._handle_alarm)
+        if self._handle_prefetch is not None:
+            self.cancel_timer(self._handle_prefetch)
         str_time_alarm = self.get_state(entity_id=self._alarm_time_sensor)
         if ':' not in str_time_alarm:
             str_time_alarm = DEFAULT_EMISION_TIME
@@ -344,13 +456,16 @@ class AlarmClock(appapi.AppDaemon):
         self._next_alarm = time_alarm - WARM_UP_TIME_DELTA
         self._handle_alarm = self.run_daily(
             self.run_alarm, self._next_alarm.time())
+        self._handle_prefetch = self.run_daily(
+            self.start_episode_poller,
+            (self._next_alarm - PREFETCH_TIME_DELTA).time())
 
-    def _set_sunrise_phase(self, *args_runin):
+    def _set_sunrise_phase(self, **phase):
         self.log('SET_SUNRISE_PHASE: XY={xy_color}, '
                  'BRIGHT={brightness}, TRANSITION={transition}'
-                 .format(**args_runin[0]), 'DEBUG')
+                 .format(**phase), 'DEBUG')
         if self._in_alarm_mode:
-            self.call_service('light/turn_on', **args_runin[0])
+            self.call_service('light/turn_on', **phase)
 
     # noinspection PyUnusedLocal
     def turn_on_lights_as_sunrise(self, *args):
@@ -367,9 +482,10 @@ class AlarmClock(appapi.AppDaemon):
         for phase in self._phases_sunrise:
             # noinspection PyTypeChecker
             xy_color, brightness = phase['xy_color'], phase['brightness']
-            self.run_in(self._set_sunrise_phase, run_in,
-                        entity_id=self._lights_alarm, xy_color=xy_color,
-                        transition=self._transit_time, brightness=brightness)
+            self._timeline.at(run_in, self._set_sunrise_phase,
+                              entity_id=self._lights_alarm, xy_color=xy_color,
+                              transition=self._transit_time,
+                              brightness=brightness)
             run_in += self._transit_time + 1
 
     def run_kodi_addon_lacafetera(self, mode="playlast"):
@@ -387,75 +503,75 @@ class AlarmClock(appapi.AppDaemon):
 
     def run_command_mopidy(self, command='core.tracklist.get_tl_tracks',
                            params=None, check_result=True):
-        """Play stream in mopidy."""
-        url_base = 'http://{}:{}/mopidy/rpc'.format(
-            self._mopidy_ip, self._mopidy_port)
-        headers = {'Content-Type': 'application/json'}
-        payload = {"method": command, "jsonrpc": "2.0", "id": 1}
-        if params is not None:
-            payload.update(params=params)
-        r = requests.post(url_base, headers=headers, data=json.dumps(payload))
-        if r.ok:
-            try:
-                res = json.loads(r.content.decode())
-            except json.decoder.JSONDecodeError:
-                self.log("ERROR PARSING MPD RESULT: {}".format(r.content))
-                return None
-            if check_result and not res['result']:
-                self.error('RUN MOPIDY {} COMMAND BAD RESPONSE? -> {}'
-                           .format(command.upper(), r.content.decode()))
-            return res
-        return None
-
-    # noinspection PyUnusedLocal
-    def increase_volume(self, *args):
-        """Recursive method to increase the playback volume until max."""
-        repeat = True
-        if self._in_alarm_mode and self._last_trigger is not None:
-            delta_sec = (dt.datetime.now()
-                         - self._last_trigger).total_seconds()
-            if delta_sec > self._volume_ramp_sec:
-                volume_set = self._max_volume
-                repeat = False
-            else:
-                volume_set = int(max(MIN_VOLUME,
-                                     (delta_sec / self._volume_ramp_sec)
-                                     * self._max_volume))
+        """Run a JSON-RPC command in mopidy."""
+        try:
+            res = self._mopidy.request(command, params)
+        except ValueError as exc:
+            self.log("ERROR PARSING MPD RESULT: {}".format(exc))
+            return None
+        except requests.RequestException as exc:
+            self.log("ERROR IN MPD REQUEST {}: {}".format(command, exc))
+            return None
+        if check_result and not res.get('result'):
+            self.error('RUN MOPIDY {} COMMAND BAD RESPONSE? -> {}'
+                       .format(command.upper(), res))
+        return res
+
+    def set_volume(self, volume):
+        """Set the playback volume (step of the volume ramp)."""
+        if self._in_alarm_mode:
             self.run_command_mopidy('core.mixer.set_volume',
-                                    params=dict(volume=volume_set))
-        else:
-            repeat = False
-        if repeat:
-            self.run_in(self.increase_volume, 10)
+                                    params=dict(volume=volume))
+
+    def increase_volume(self):
+        """Schedule the volume ramp in the alarm timeline, up to max."""
+        self._timeline.ramp(5, self._volume_ramp_sec,
+                            MIN_VOLUME, self._max_volume, self.set_volume,
+                            easing=self._volume_easing)
 
     def run_mopidy_stream_lacafetera(self, ep_info):
         """Play stream in mopidy."""
         self.log('DEBUG MPD: {}'.format(ep_info))
         self.call_service('switch/turn_on', entity_id="switch.altavoz")
-        self.run_command_mopidy('core.tracklist.clear', check_result=False)
+        ep_id = ep_info['episode']['episode_id']
+        local_file = None
+        if (self._media is not None and self._mopidy_media_uri
+                and not ep_info['is_live']):
+            local_file = self._media.get(ep_id)
+        if local_file is not None:
+            uri = '{}/{}'.format(self._mopidy_media_uri.rstrip('/'),
+                                 os.path.basename(local_file))
+            self.log('PLAYING LOCAL FILE: {} ({})'.format(local_file, uri),
+                     LOG_LEVEL)
+        else:
+            uri = MASK_URL_STREAM_MOPIDY.format(ep_id)
         params = {"tracks": [{"__model__": "Track",
-                              "uri": MASK_URL_STREAM_MOPIDY.format(
-                                  ep_info['episode']['episode_id']),
+                              "uri": uri,
                               "name": ep_info['episode']['title'],
                               # "artist": "Fernando Berlín",
                               # "album": "La Cafetera",
                               "date": "{:%Y-%m-%d}".format(
                                   ep_info['published'])}]}
-        json_res = self.run_command_mopidy('core.tracklist.add', params=params)
+        # Clear + add + volume + play in only one round-trip
+        # (with the cleared tracklist, 'play' starts the added track)
+        try:
+            _res_clear, json_res, _res_vol, res_play = self._mopidy.batch(
+                [('core.tracklist.clear', None),
+                 ('core.tracklist.add', params),
+                 ('core.mixer.set_volume', dict(volume=5)),
+                 ('core.playback.play', None)])
+        except (requests.RequestException, ValueError) as exc:
+            json_res, res_play = None, None
+            self.log('ERROR IN MPD BATCH REQUEST: {}'.format(exc))
+        self.log('MOPIDY LATENCY: {}'.format(self._mopidy.latency_stats()),
+                 'DEBUG')
         if json_res is not None:
             # self.log('Added track OK --> {}'.format(json_res))
-            if ("result" in json_res) and (len(json_res["result"]) > 0):
-                track_info = json_res["result"][0]
-                self.run_command_mopidy(
-                    'core.mixer.set_volume', params=dict(volume=5))
-                res_play = self.run_command_mopidy(
-                    'core.playback.play',
-                    params={"tl_track": track_info}, check_result=False)
-                if res_play is not None:
-                    self._in_alarm_mode = True
-                    self._last_trigger = dt.datetime.now()
-                    self.run_in(self.increase_volume, 5)
-                    return True
+            if json_res.get("result") and 'error' not in res_play:
+                self._in_alarm_mode = True
+                self._last_trigger = dt.datetime.now()
+                self.increase_volume()
+                return True
         self.error('MOPIDY NOT PRESENT??, mopidy json_res={}'
                    .format(json_res), 'ERROR')
         return False
@@ -476,12 +592,19 @@ class AlarmClock(appapi.AppDaemon):
     def trigger_service_in_alarm(self, *args):
         """Launch alarm secuence.
 
-        Launch if ready, or set itself to retry in the short future."""
+        Launch if ready, or wait for the new episode (episode poller),
+        with a last retry after the max waiting time."""
+        if self._handle_wait is not None:
+            self.cancel_timer(self._handle_wait)
+            self._handle_wait = None
+        self._waiting_episode = False
         # Check if alarm is ready to launch
         if not self._in_alarm_mode:
+            now = self.datetime()
             alarm_ready, alarm_info = is_last_episode_ready_for_play(
-                self.datetime(), self._tz)
+                now, self._tz, self._episodes)
             if alarm_ready:
+                self._cancel_waiting_episode()
                 self.turn_on_morning_services(dict(delta_to_repeat=30))
                 if self.play_in_kodi:
                     ok = self.run_kodi_addon_lacafetera()
@@ -502,8 +625,16 @@ class AlarmClock(appapi.AppDaemon):
                         self.turn_off_alarm_clock, self._media_player_mopidy,
                         new="off", duration=20)
             else:
-                self.log('POSTPONE ALARM', LOG_LEVEL)
-                self.run_in(self.trigger_service_in_alarm, STEP_RETRYING_SEC)
+                self.log('POSTPONE ALARM (WAITING FOR NEW EPISODE)',
+                         LOG_LEVEL)
+                est_today = estimated_emision_time(now)
+                self._waiting_episode = True
+                if not self._poller.running:
+                    self._poller.start(est_today)
+                wait = max(STEP_RETRYING_SEC, (est_today + MAX_WAIT_TIME
+                                               - now).total_seconds() + 1)
+                self._handle_wait = self.run_in(
+                    self.trigger_service_in_alarm, int(wait))
 
     # noinspection PyUnusedLocal
     def run_alarm(self, *args):
@@ -35,6 +35,9 @@ son editables en la configuración de la AppDaemon app:
     delta_secs_trigger = 150
     # Número de eventos máx. a incluir por informe en correo electrónico. Se limita eliminando eventos de baja prioridad
     num_max_eventos_por_informe = 10
+    # Umbral de actividad (eventos/min, atributo `events_1min` de los sensores derivados) para disparar con los
+    # sensores extra, en vez de con cada transición a 'on'. Comentar con # para desactivar
+    extra_sensors_min_events_1min = 5
 ```
 
 """
@@ -49,13 +52,14 @@ from functools import reduce
 from itertools import cycle
 from jinja2 import Environment, FileSystemLoader
 import json
-from math import ceil
 import os
 import re
 import requests
 from time import time, sleep
 import yaml
 
+from raw_sensors import RawSensorEngine, LocalStateOutput
+
 
 # LOG_LEVEL = 'DEBUG'
 LOG_LEVEL = 'INFO'
@@ -137,6 +141,7 @@ class MotionAlarm(appapi.AppDaemon):
     _use_cams_movs = None
     _extra_sensors = None
     _use_extra_sensors = None
+    _extra_sensors_min_events = None
     _dict_asign_switchs_inputs = None
 
     _videostreams = {}
@@ -189,10 +194,6 @@ class MotionAlarm(appapi.AppDaemon):
     _known_devices = None
 
     _raw_sensors = None
-    _raw_sensors_sufix = None
-    _raw_sensors_seconds_to_off = None
-    _raw_sensors_last_states = {}
-    _raw_sensors_attributes = {}
 
     def initialize(self):
         """AppDaemon required method for app init."""
@@ -209,7 +210,6 @@ class MotionAlarm(appapi.AppDaemon):
         self._main_switch = self.args.get('main_switch')
 
         # Sensores de movimiento (PIR's, cam_movs, extra)
-        self._raw_sensors = self.args.get('raw_binary_sensors', None)
         self._pirs = self._listconf_param(self.args, 'pirs')
         self._camera_movs = self._listconf_param(self.args, 'camera_movs')
         self._extra_sensors = self._listconf_param(self.args, 'extra_sensors')
@@ -221,6 +221,10 @@ class MotionAlarm(appapi.AppDaemon):
         # self.log('_use_pirs: {}'.format(self._use_pirs))
         # self.log('_use_cams_movs: {}'.format(self._use_cams_movs))
         # self.log('use_extra_sensors: {}'.format(self._use_extra_sensors))
+        # Umbral de actividad (eventos en el último minuto) para los sensores extra
+        self._extra_sensors_min_events = self.args.get('extra_sensors_min_events_1min', None)
+        if self._extra_sensors_min_events is not None:
+            self._extra_sensors_min_events = int(self._extra_sensors_min_events)
 
         # Video streams asociados a sensores para notif
         _streams = self._listconf_param(self.args, 'videostreams')
@@ -272,25 +276,11 @@ class MotionAlarm(appapi.AppDaemon):
         #          .format(self._retry_push_alarm, self._max_time_sirena_on))
 
         # RAW SENSORS:
+        self._raw_sensors = RawSensorEngine.from_args(
+            self, LocalStateOutput(self), default_seconds_to_off=DEFAULT_RAWBS_SECS_OFF)
         if self._raw_sensors is not None:
-            self._raw_sensors = self._raw_sensors.split(',')
-            self._raw_sensors_sufix = self.args.get('raw_binary_sensors_sufijo', '_raw')
-            # Persistencia en segundos de último valor hasta considerarlos 'off'
-            self._raw_sensors_seconds_to_off = int(self.args.get('raw_binary_sensors_time_off', DEFAULT_RAWBS_SECS_OFF))
-
-            # Handlers de cambio en raw binary_sensors:
-            l1, l2 = 'attributes', 'last_changed'
-            for s in self._raw_sensors:
-                self._raw_sensors_attributes[s] = (s.replace(self._raw_sensors_sufix, ''), self.get_state(s, l1))
-                # self._raw_sensors_last_states[s] = [parse(self.get_state(s, l2)).replace(tzinfo=None), False]
-                self._raw_sensors_last_states[s] = [self.datetime(), False]
-                self.listen_state(self._turn_on_raw_sensor_on_change, s)
-            # self.log('seconds_to_off: {}'.format(self._raw_sensors_seconds_to_off))
-            # self.log('attributes_sensors: {}'.format(self._raw_sensors_attributes))
-            # self.log('last_changes: {}'.format(self._raw_sensors_last_states))
-            [self.set_state(dev, state='off', attributes=attrs) for dev, attrs in self._raw_sensors_attributes.values()]
-            next_run = self.datetime() + dt.timedelta(seconds=self._raw_sensors_seconds_to_off)
-            self.run_every(self._turn_off_raw_sensor_if_not_updated, next_run, self._raw_sensors_seconds_to_off)
+            # self.log('raw_sensors: {}'.format(self._raw_sensors))
+            self._raw_sensors.publish_all_off()
 
         self._events_data = []
 
@@ -314,7 +304,10 @@ class MotionAlarm(appapi.AppDaemon):
 
         # Movement detection
         for s_mov in all_sensors:
-            self.listen_state(self._motion_detected, s_mov, new="on", duration=1)
+            if self._extra_sensors_min_events is not None and s_mov in self._extra_sensors:
+                self.listen_state(self._extra_sensor_activity, s_mov, attribute='events_1min')
+            else:
+                self.listen_state(self._motion_detected, s_mov, new="on", duration=1)
 
         # Programación de informe de actividad
         if self._time_report is not None:
@@ -361,25 +354,6 @@ class MotionAlarm(appapi.AppDaemon):
             return [default] * min_len
         return []
 
-    # noinspection PyUnusedLocal
-    def _turn_on_raw_sensor_on_change(self, entity, attribute, old, new, kwargs):
-        _, last_st = self._raw_sensors_last_states[entity]
-        self._raw_sensors_last_states[entity] = [self.datetime(), True]
-        if not last_st:
-            name, attrs = self._raw_sensors_attributes[entity]
-            self.set_state(name, state='on', attributes=attrs)
-            # self.log('TURN ON "{}" (de {} a {} --> {})'.format(entity, old, new, name))
-
-    # noinspection PyUnusedLocal
-    def _turn_off_raw_sensor_if_not_updated(self, *kwargs):
-        now = self.datetime()
-        for s, (ts, st) in self._raw_sensors_last_states.copy().items():
-            if st and ceil((now - ts).total_seconds()) >= self._raw_sensors_seconds_to_off:
-                # self.log('TURN OFF "{}" (last ch: {})'.format(s, ts))
-                name, attrs = self._raw_sensors_attributes[s]
-                self._raw_sensors_last_states[s] = [now, False]
-                self.set_state(name, state='off', attributes=attrs)
-
     def _listen_to_switch(self, identif, entity_switch, func_listen_change):
         if type(entity_switch) is bool:
             # self.log('FIXED BOOL: {} -> {}'
@@ -709,6 +683,17 @@ class MotionAlarm(appapi.AppDaemon):
                 self.call_service('switch/turn_off', entity_id=self._led_act)
             self.log('*PREALARMA DESACTIVADA*')
 
+    # noinspection PyUnusedLocal
+    def _extra_sensor_activity(self, entity, attribute, old, new, kwargs):
+        """Disparo por tasa de eventos (sliding window) en sensores extra (vibración, sonido)."""
+        try:
+            old, new = int(old or 0), int(new or 0)
+        except (TypeError, ValueError):
+            return
+        if old < self._extra_sensors_min_events <= new:
+            self.log('ACTIVIDAD en {}: {} eventos/min'.format(entity, new), LOG_LEVEL)
+            self._motion_detected(entity, attribute, 'off', 'on', kwargs)
+
     # noinspection PyUnusedLocal
     def _motion_detected(self, entity, attribute, old, new, kwargs):
         """Lógica de activación de alarma por detección de movimiento.
@@ -6,183 +6,263 @@ This little app controls some hue lights for turning them ON with motion detecti
 only under some custom circunstances, like the media player is not running,
 or there aren't any more lights in 'on' state in the room.
 
+The lights of the room are tracked with an event-driven model (counts of
+lights ON, fed by their state changes), so the decisions on PIR changes don't
+read any state. An infrequent consistency check (`lights_check_interval`)
+compares the model with the real states. AppDaemon drops all the callbacks
+of the app out of its constraints (time window, `constrain_input_boolean`),
+so the check runs in a repeating minutely timer (never lost), all the
+cached states are read again when the callbacks resume after a gap, and the
+tick polls the expiry timer (a dropped off deadline fires late, not never).
+
+The off timeout adapts to the occupancy of the room: the base timeout
+(`motion_light_timeout`, slider or number) is scaled with the number of PIR
+triggers in the last `occupancy_window` seconds (`occupancy_events` triggers
+for the base timeout). It is a single resettable deadline (PIR off + timeout),
+cancelled on new motion, so re-triggers and slider changes are O(1), without
+re-registering state listeners.
+
+The turn ON decision is a fast path over cached booleans (constraints and
+room model), with a prepared service payload, and the command is sent
+before any logging. The end-to-end latency (from the `last_changed` of the
+PIR state to the light command) is kept in a histogram (p50/p99 in the log
+and with `latency_stats()`).
+
+`MotionLightsRooms` manages N rooms (`rooms` list in the app config, each
+one with the same params of `MotionLights`) in one app instance, with the
+`MotionRoomsEngine`: one state listener per entity (shared by the rooms),
+one expiry timer for the off deadlines of all the rooms and one consistency
+check of the state cache (in the same minutely tick, with the same resync).
+`MotionLights` is the same app for one room, with its params in the args.
+
 """
+import datetime as dt
+from threading import Lock
+from time import time
+
 import appdaemon.appapi as appapi
+from dateutil.parser import parse
+
+from deadline_scheduler import ExpiryTimer
+from motion_rooms import (ARM, CANCEL, DEFAULT_MOTION_LIGHT_TIMEOUT, KEEP_ON,
+                          MANUAL_OFF, MotionRoomsEngine, TURN_OFF, TURN_ON)
+from power_stats import QuantileSketch
+from room_lights import DEFAULT_OCCUPANCY_EVENTS, DEFAULT_OCCUPANCY_WINDOW
 
 
 LOG_LEVEL = 'INFO'
+DEFAULT_LIGHTS_CHECK_INTERVAL = 1800  # secs
+# App args of `MotionLights` for its room (`constrain_input_boolean` is the
+# AppDaemon constraint of the app)
+ROOM_PARAMS = ('name', 'pir', 'motion_light_timeout', 'lights_motion',
+               'lights_check_off', 'constrain_input_boolean_2',
+               'media_player', 'occupancy_window', 'occupancy_events')
+TURN_ON_LIGHT_PARAMS = dict(color_temp=300, brightness=200, transition=0)
+LATENCY_LOG_EVERY = 20  # turn ONs
 
 
-# noinspection PyClassHasNoInit
-class MotionLights(appapi.AppDaemon):
-    """App for control lights with a motion sensor."""
+class PirLatency(object):
+    """Histogram of the latency (ms) from the PIR change to the light
+    command, with the `last_changed` of the PIR state."""
 
-    _pir = None
-    _motion_light_timeout = None
-    _lights_motion = None
-    _lights_check_off = None
-    _media_player = None
-    _extra_constrain_input_boolean = None
+    def __init__(self):
+        self._sketch = QuantileSketch(relative_accuracy=.01)
+        self.max = 0.
 
-    _handle_motion_on = None
-    _handle_motion_off = None
+    def record(self, app, pir):
+        """Add the latency of a light command just sent. Returns it (ms)."""
+        ts_command = dt.datetime.now(dt.timezone.utc)
+        try:
+            ts_pir = parse(app.get_state(pir, attribute='last_changed'))
+            latency = 1000. * (ts_command - ts_pir).total_seconds()
+        except (TypeError, ValueError) as exc:
+            app.log('No PIR last_changed for latency: {}'.format(exc),
+                    'WARNING')
+            return None
+        self._sketch.add(max(0., latency))
+        self.max = max(self.max, latency)
+        if self._sketch.count % LATENCY_LOG_EVERY == 0:
+            app.log('MotionLights latency: {}'.format(self.stats()))
+        return latency
+
+    def stats(self):
+        """Count, p50, p99 & max latency (ms)."""
+        if not self._sketch.count:
+            return dict(count=0)
+        return dict(count=self._sketch.count,
+                    p50=round(self._sketch.quantile(.5), 1),
+                    p99=round(self._sketch.quantile(.99), 1),
+                    max=round(self.max, 1))
+
+
+def _entity_list(entities):
+    if not entities:
+        return []
+    if isinstance(entities, str):
+        entities = entities.split(',')
+    return [e.strip() for e in entities if e.strip()]
+
+
+# noinspection PyClassHasNoInit
+class MotionLightsRooms(appapi.AppDaemon):
+    """App for control the motion lights of N rooms with one engine."""
 
-    _motion_lights_running = False
-    _extra_condition = True
-    _media_player_active = False
-    _lights_motion_active = None
+    _engine = None
+    _expiry = None
+    _latency = None
+    _lock = None
+    _lights_check_interval = None
+    _ticks = 0
 
     def initialize(self):
         """AppDaemon required method for app init."""
         conf_data = dict(self.config['AppDaemon'])
-        pir = self.args.get('pir', None)
-        self._extra_constrain_input_boolean = self.args.get(
-            'constrain_input_boolean_2', None)
-        motion_light_timeout_slider = self.args.get(
-            'motion_light_timeout', None)
-        self._lights_motion = self.args.get('lights_motion', '')
-        self._lights_check_off = [l for l in self.args.get(
-            'lights_check_off', '').split(',') if len(l) > 0]
-        self._media_player = conf_data.get('media_player', None)
-
-        if pir and motion_light_timeout_slider and self._lights_motion:
-            self._pir = pir
-            # Motion Lights States
-            self._lights_motion_active = {}
-            self._read_light_motion_states(set_listen_state=True)
-            self.run_minutely(self._read_light_motion_states, None)
-            # for l in self._lights_motion.split(','):
-            #     self._lights_motion_active[l] = self.get_state(l) == 'on'
-            #     self.listen_state(self._light_motion_state, l)
-            # Light Timeout
-            if motion_light_timeout_slider.startswith('input_number'):
-                self._motion_light_timeout = int(
-                    round(float(self.get_state(motion_light_timeout_slider))))
-                self.listen_state(
-                    self._set_motion_timeout, motion_light_timeout_slider)
-            else:
-                self._motion_light_timeout = int(
-                    round(float(motion_light_timeout_slider)))
-            self._handle_motion_on = self.listen_state(
-                self.turn_on_motion_lights, self._pir, new="on")
-            self._handle_motion_off = self.listen_state(
-                self.turn_off_motion_lights, self._pir,
-                new="off", duration=self._motion_light_timeout)
-            # Media player dependency
-            if self._media_player is not None:
-                self._media_player_active = self.get_state(
-                    self._media_player) == 'playing'
-                self.listen_state(
-                    self._media_player_state_ch, self._media_player)
-                self.log('MotionLightsConstrain media player "{}" (PIR={})'
-                         .format(self._media_player, self._pir))
-
-            # Extra dependency (inverse logic) --> GENERAL ALARM ON
-            if self._extra_constrain_input_boolean is not None:
-                self._extra_condition = self.get_state(
-                    self._extra_constrain_input_boolean) == 'off'
-                self.listen_state(
-                    self._extra_switch_change,
-                    self._extra_constrain_input_boolean)
-                self.log('MotionLightsConstrain extra "{}" (extra_cond now={})'
-                         .format(self._extra_constrain_input_boolean,
-                                 self._extra_condition))
-            self.log('MotionLights [{}] with motion in "{}", '
-                     'with timeout={} s, check_off={}. ---> ACTIVE'
-                     .format(self._lights_motion, self._pir,
-                             self._motion_light_timeout,
-                             self._lights_check_off))
-        else:
-            self.log('No se inicializa MotionLights, '
-                     'faltan parámetros (req: {})'
-                     .format('motion_light_timeout, lights_motion, pir'),
-                     level='ERROR')
+        self._engine = MotionRoomsEngine()
+        self._lock = Lock()
+        self._latency = PirLatency()
+        for i, room_conf in enumerate(self._rooms_conf()):
+            name = room_conf.get('name', 'room_{}'.format(i))
+            pir = room_conf.get('pir', None)
+            timeout = room_conf.get('motion_light_timeout', None)
+            lights_motion = _entity_list(room_conf.get('lights_motion'))
+            if not (pir and timeout and lights_motion):
+                self.log('No se inicializa MotionLights en "{}", '
+                         'faltan parámetros (req: {})'
+                         .format(name, 'motion_light_timeout, '
+                                       'lights_motion, pir'), level='ERROR')
+                continue
+            timeout_entity = None
+            if str(timeout).startswith('input_number'):
+                timeout_entity, timeout = timeout, DEFAULT_MOTION_LIGHT_TIMEOUT
+            self._engine.add_room(
+                name, pir, lights_motion,
+                _entity_list(room_conf.get('lights_check_off')),
+                timeout=int(round(float(timeout))),
+                timeout_entity=timeout_entity,
+                enable=_entity_list(room_conf.get('constrain_input_boolean')),
+                disable=_entity_list(
+                    room_conf.get('constrain_input_boolean_2')),
+                media_players=_entity_list(room_conf.get(
+                    'media_player', conf_data.get('media_player'))),
+                payload=dict(TURN_ON_LIGHT_PARAMS,
+                             entity_id=','.join(lights_motion)),
+                window=int(room_conf.get('occupancy_window',
+                                         DEFAULT_OCCUPANCY_WINDOW)),
+                ref_events=int(room_conf.get('occupancy_events',
+                                             DEFAULT_OCCUPANCY_EVENTS)))
+        if not self._engine.rooms:
+            self.log('No se inicializa {}, sin habitaciones'
+                     .format(self.__class__.__name__), level='ERROR')
+            return
 
-    # noinspection PyUnusedLocal
-    def _media_player_state_ch(self, entity, attribute, old, new, kwargs):
-        self._media_player_active = new == 'playing'
+        self._engine.reset(self._read_states())
+        self._expiry = ExpiryTimer(self, self._room_timeout_expired)
+        for entity in self._engine.entities:
+            self.listen_state(self._state_change, entity)
+        self._lights_check_interval = int(self.args.get(
+            'lights_check_interval', DEFAULT_LIGHTS_CHECK_INTERVAL))
+        self._engine.alive(time())
+        self.run_minutely(self._minutely_tick, None)
+        self.log('{} {} ---> ACTIVE: {}'
+                 .format(self.__class__.__name__, self._engine, ', '.join(
+                     str(room) for room in self._engine.rooms.values())))
 
-    # noinspection PyUnusedLocal
-    def _extra_switch_change(self, entity, attribute, old, new, kwargs):
-        self.log('Extra switch condition change: {} from {} to {}'
-                 .format(entity, old, new))
-        self._extra_condition = new == 'off'
+    def _rooms_conf(self):
+        return self.args.get('rooms', [])
 
-    # noinspection PyUnusedLocal
-    def _set_motion_timeout(self, entity, attribute, old, new, kwargs):
-        new_timeout = int(round(float(new)))
-        if new_timeout != self._motion_light_timeout:
-            self._motion_light_timeout = new_timeout
-            if self._handle_motion_off is not None:
-                self.log('Cancelling {}'.format(self._handle_motion_off))
-                self.cancel_listen_state(self._handle_motion_off)
-            self._handle_motion_off = self.listen_state(
-                self.turn_off_motion_lights, self._pir,
-                new="off", duration=self._motion_light_timeout)
-            self.log('Se establece nuevo timeout para MotionLights: {} segs'
-                     .format(self._motion_light_timeout))
+    def _read_states(self):
+        return {e: self.get_state(e) for e in self._engine.entities}
 
-    # noinspection PyUnusedLocal
-    def _read_light_motion_states(self, set_listen_state=False, **kwargs):
-        bkp = self._lights_motion_active.copy()
-        if not self._motion_lights_running:
-            for l in self._lights_motion.split(','):
-                self._lights_motion_active[l] = self.get_state(l) == 'on'
-                if set_listen_state:
-                    self.listen_state(self._light_motion_state, l)
-        elif any(filter(lambda x: x is False,
-                        self._lights_motion_active.values())):
-            self.log('MOTION LIGHTS OFF (some lights were turn off manually)'
-                     ' --> {}'.format(self._lights_motion_active))
-            self._motion_lights_running = False
-        if set_listen_state or (bkp != self._lights_motion_active):
-            self.log('UPDATE light_motion_states from {} to {}'
-                     .format(bkp, self._lights_motion_active,
-                             set_listen_state))
+    def latency_stats(self):
+        """PIR -> light command latency stats (ms)."""
+        if self._latency is None:
+            return dict(count=0)
+        return self._latency.stats()
+
+    def _check_states(self):
+        """Consistency check of the state cache (infrequent, or after
+        dropped callbacks)."""
+        states = self._read_states()
+        with self._lock:
+            mismatches, actions = self._engine.check(states, time())
+            self._schedule(actions)
+        if mismatches:
+            self.log('FIXED motion rooms state cache: {} --> {}'
+                     .format(mismatches, self._engine), 'WARNING')
+        self._apply_actions(actions)
+
+    def _resync_if_stale(self):
+        with self._lock:
+            alive = self._engine.alive(time())
+        if not alive:
+            self.log('RESYNC of MotionLightsRooms after a gap without '
+                     'callbacks')
+            self._check_states()
 
     # noinspection PyUnusedLocal
-    def _light_motion_state(self, entity, attribute, old, new, kwargs):
-        self._lights_motion_active[entity] = new == 'on'
-
-    def _lights_are_off(self, include_motion_lights=True):
-        other_lights_are_off = ((self._lights_check_off is None)
-                                or all([(self.get_state(l) == 'off')
-                                        or (self.get_state(l) is None)
-                                        for l in self._lights_check_off]))
-        if include_motion_lights:
-            return other_lights_are_off and not any(
-                self._lights_motion_active.values())
-        return other_lights_are_off
+    def _minutely_tick(self, kwargs):
+        self._resync_if_stale()
+        self._ticks += 1
+        if self._ticks % max(1, self._lights_check_interval // 60) == 0:
+            self._check_states()
+        self._expiry.poll()
 
     # noinspection PyUnusedLocal
-    def turn_on_motion_lights(self, entity, attribute, old, new, kwargs):
-        """Method for turning on the motion-controlled lights."""
-        if (not self._motion_lights_running and
-                self._lights_are_off(include_motion_lights=True) and
-                self._extra_condition and not self._media_player_active):
-            self._motion_lights_running = True
-            self.log('TURN_ON MOTION_LIGHTS ({}), with timeout: {} sec. '
-                     'lights_motion: {}'
-                     .format(self._lights_motion, self._motion_light_timeout,
-                             self._lights_motion_active.values()),
+    def _state_change(self, entity, attribute, old, new, kwargs):
+        self._resync_if_stale()
+        with self._lock:
+            actions = self._engine.update(entity, new, time())
+            self._schedule(actions)
+        self._apply_actions(actions)
+
+    def _schedule(self, actions):
+        # (under the lock, so the deadlines of the timer follow the engine)
+        for action, room in actions:
+            if action == ARM:
+                self._expiry.set(room.name, room.deadline)
+            elif action == CANCEL:
+                self._expiry.cancel(room.name)
+
+    def _apply_actions(self, actions):
+        for action, room in actions:
+            if action == TURN_ON:
+                self.call_service("light/turn_on", **room.payload)
+                latency = self._latency.record(self, room.pir)
+                self.log('TURN_ON MOTION_LIGHTS in {} ({}), with timeout: '
+                         '{} sec. lights: {}, latency: {} ms'
+                         .format(room.name, room.payload['entity_id'],
+                                 room.occupancy.timeout(time()),
+                                 room.lights, latency and round(latency)),
+                         LOG_LEVEL)
+            elif action == MANUAL_OFF:
+                self.log('MOTION LIGHTS OFF in {} (some lights were turn off '
+                         'manually) --> {}'.format(room.name, room.lights))
+
+    def _room_timeout_expired(self, name):
+        with self._lock:
+            if name in self._expiry:
+                # (re-scheduled after the expiry, before taking the lock)
+                return
+            action = self._engine.expire(name)
+        room = self._engine.rooms[name]
+        if action == TURN_OFF:
+            self.log('TURNING_OFF MOTION_LIGHTS in {}'.format(name),
                      LOG_LEVEL)
-            self.call_service("light/turn_on", entity_id=self._lights_motion,
-                              color_temp=300, brightness=200, transition=0)
+            self.call_service("light/turn_off",
+                              entity_id=room.payload['entity_id'],
+                              transition=1)
+        elif action == KEEP_ON:
+            self.log('NO TURN_OFF MOTION_LIGHTS in {} '
+                     '(other lights in the room are ON={})'
+                     .format(name, room.lights.others_on()), LOG_LEVEL)
 
-    # noinspection PyUnusedLocal
-    def turn_off_motion_lights(self, entity, attribute, old, new, kwargs):
-        """Method for turning off the motion-controlled lights
-        after some time without any movement."""
-        if self._motion_lights_running and \
-                self._extra_condition and not self._media_player_active:
-            if self._lights_are_off(include_motion_lights=False):
-                self.log('TURNING_OFF MOTION_LIGHTS, id={}, old={}, new={}'
-                         .format(entity, old, new), LOG_LEVEL)
-                self.call_service("light/turn_off",
-                                  entity_id=self._lights_motion, transition=1)
-            else:
-                self.log('NO TURN_OFF MOTION_LIGHTS '
-                         '(other lights in the room are ON={})'
-                         .format([self.get_state(l)
-                                  for l in self._lights_check_off]), LOG_LEVEL)
-            self._motion_lights_running = False
+
+# noinspection PyClassHasNoInit
+class MotionLights(MotionLightsRooms):
+    """App for control lights with a motion sensor (one room, with its
+    params in the app args)."""
+
+    def _rooms_conf(self):
+        room_conf = {k: v for k, v in self.args.items() if k in ROOM_PARAMS}
+        room_conf.setdefault('name', self.name)
+        return [room_conf]
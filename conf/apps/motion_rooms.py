@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: motion lights engine for multiple rooms.
+
+One engine keeps a single cache of the states of all the tracked entities
+(PIRs, lights, constraint switches, media players and timeout sliders), and
+an index of the rooms watching each entity, so one app instance with one
+state listener per entity (shared by the rooms) and one expiry timer can
+manage N rooms. Each room is a compact state object (`__slots__`) with its
+room lights model, its adaptive off timeout, a count of blocking
+constraints (so "can turn on?" is O(1)) and the prepared light payload.
+
+`update` returns the actions to do for a state change, and `expire` the
+action for a room deadline. AppDaemon drops all the callbacks of the app
+out of its constraints, so `alive` detects the gaps without callbacks, and
+`check` resyncs the cache with fresh states (returning the actions to fix
+the rooms, like the deadlines of PIR off events lost in the gap):
+
+```
+    self._engine = MotionRoomsEngine()
+    self._engine.add_room('salon', pir, lights_motion, lights_check_off, ...)
+    self._engine.reset({e: self.get_state(e) for e in self._engine.entities})
+    ...
+    with self._lock:  # (the deadlines of the timer follow the engine)
+        actions = self._engine.update(entity, new, time())
+        for action, room in actions:
+            if action == ARM:
+                self._expiry.set(room.name, room.deadline)
+            ...
+    for action, room in actions:
+        if action == TURN_ON:
+            self.call_service('light/turn_on', **room.payload)
+        ...
+    if not self._engine.alive(time()):  # in a repeating minutely timer
+        mismatches, actions = self._engine.check(fresh_states, time())
+```
+
+Simulation of 50 rooms (one hour of random motion), with the cost per
+state change, and the listeners and timers needed vs one app per room. It
+runs with a fake AppDaemon scheduler (with the `ExpiryTimer`), dropping all
+the callbacks in periods out of the app constraints, and counts the rooms
+left with the lights on (with and without the resync & watchdog):
+
+```
+    python motion_rooms.py --rooms 50 --hours 1
+```
+
+"""
+import argparse
+from itertools import count
+import random
+from time import time
+
+from deadline_scheduler import ExpiryTimer
+from room_lights import (DEFAULT_OCCUPANCY_EVENTS, DEFAULT_OCCUPANCY_WINDOW,
+                         OccupancyTimeout, RoomLightModel)
+
+
+DEFAULT_MOTION_LIGHT_TIMEOUT = 120  # secs
+# Secs without callbacks (dropped by the app constraints) to resync
+DEFAULT_RESYNC_GAP = 90
+# Actions
+TURN_ON, TURN_OFF, KEEP_ON = 'turn_on', 'turn_off', 'keep_on'
+ARM, CANCEL, MANUAL_OFF = 'arm', 'cancel', 'manual_off'
+# Roles of the entities in a room
+PIR, LIGHT, TIMEOUT = 'pir', 'light', 'timeout'
+ENABLE, DISABLE, MEDIA = 'enable', 'disable', 'media'
+
+
+def _blocks(role, state):
+    """True if a constraint entity in this state blocks the motion lights."""
+    if role == ENABLE:
+        return state != 'on'
+    if role == DISABLE:
+        return state == 'on'
+    return state == 'playing'
+
+
+def _timeout_value(state):
+    try:
+        return int(round(float(state)))
+    except (TypeError, ValueError):
+        return None
+
+
+class MotionRoom(object):
+    """Compact state of a room with motion lights."""
+
+    __slots__ = ('name', 'pir', 'lights', 'occupancy', 'payload',
+                 'num_blocking', 'running', 'deadline', 'ts_pir_off')
+
+    def __init__(self, name, pir, lights, occupancy, payload=None):
+        self.name = name
+        self.pir = pir
+        self.lights = lights
+        self.occupancy = occupancy
+        self.payload = payload
+        self.num_blocking = 0
+        self.running = False
+        self.deadline = self.ts_pir_off = None
+
+    @property
+    def can_turn_on(self):
+        """True if no constraint is blocking the motion lights."""
+        return not self.num_blocking
+
+    def __repr__(self):
+        return '<MotionRoom {}: running={}, blocking={}, {}>'.format(
+            self.name, self.running, self.num_blocking, self.lights)
+
+
+class MotionRoomsEngine(object):
+    """Motion lights logic of N rooms, over one shared state cache."""
+
+    def __init__(self, resync_gap=DEFAULT_RESYNC_GAP):
+        self.rooms = {}
+        self.resync_gap = resync_gap
+        self._states = {}
+        self._watchers = {}  # entity -> [(role, room), ...]
+        self._ts_alive = None
+
+    def add_room(self, name, pir, lights_motion, lights_check_off=(),
+                 timeout=DEFAULT_MOTION_LIGHT_TIMEOUT, timeout_entity=None,
+                 enable=(), disable=(), media_players=(), payload=None,
+                 window=DEFAULT_OCCUPANCY_WINDOW,
+                 ref_events=DEFAULT_OCCUPANCY_EVENTS):
+        """Add a room. `enable` entities must be 'on', `disable` ones
+        'off', and `media_players` not 'playing' to turn on the lights."""
+        if name in self.rooms:
+            raise ValueError('Duplicated room name: {}'.format(name))
+        room = MotionRoom(name, pir,
+                          RoomLightModel(lights_motion, lights_check_off),
+                          OccupancyTimeout(timeout, window, ref_events),
+                          payload)
+        self.rooms[name] = room
+        self._watch(pir, PIR, room)
+        for light in room.lights.lights:
+            self._watch(light, LIGHT, room)
+        if timeout_entity is not None:
+            self._watch(timeout_entity, TIMEOUT, room)
+        for role, entities in ((ENABLE, enable), (DISABLE, disable),
+                               (MEDIA, media_players)):
+            for entity in entities:
+                self._watch(entity, role, room)
+        return room
+
+    def _watch(self, entity, role, room):
+        self._watchers.setdefault(entity, []).append((role, room))
+        self._states.setdefault(entity, None)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    @property
+    def entities(self):
+        """All the tracked entities (one listener each)."""
+        return list(self._watchers)
+
+    def state(self, entity):
+        """Cached state of an entity."""
+        return self._states.get(entity)
+
+    def reset(self, states):
+        """Set all the states (`{entity: state}`), recomputing the rooms."""
+        self._states.update({e: states.get(e) for e in self._watchers})
+        for room in self.rooms.values():
+            room.lights.reset(self._states)
+            room.num_blocking = 0
+        for entity, watchers in self._watchers.items():
+            state = self._states[entity]
+            for role, room in watchers:
+                if role in (ENABLE, DISABLE, MEDIA):
+                    room.num_blocking += _blocks(role, state)
+                elif role == TIMEOUT and _timeout_value(state) is not None:
+                    room.occupancy.base = _timeout_value(state)
+
+    def alive(self, now):
+        """Register a callback of the app. Returns False after a gap of
+        more than `resync_gap` secs without callbacks (needs a `check`)."""
+        gap = (self._ts_alive is not None
+               and now - self._ts_alive > self.resync_gap)
+        self._ts_alive = now
+        return not gap
+
+    def check(self, states, now):
+        """Compare the cache with fresh `states`, fixing it.
+
+        Returns the list of (entity, known state, real state) mismatches,
+        and the list of (action, room) to fix the deadlines of the rooms."""
+        mismatches = [(e, self._states[e], states.get(e))
+                      for e in self._watchers
+                      if self._states[e] != states.get(e)]
+        actions = []
+        if not mismatches:
+            return mismatches, actions
+        self.reset(states)
+        for room in self.rooms.values():
+            if room.running and not room.lights.all_motion_on:
+                room.running = False
+            pir_on = self._states[room.pir] == 'on'
+            if room.running and not pir_on and room.deadline is None:
+                # (lost PIR off event)
+                room.ts_pir_off = now
+                room.deadline = now + room.occupancy.timeout(now)
+                actions.append((ARM, room))
+            elif pir_on and room.deadline is not None:
+                room.deadline = None
+                actions.append((CANCEL, room))
+        return mismatches, actions
+
+    def update(self, entity, new, now):
+        """New state of an entity. Returns the list of (action, room)."""
+        old = self._states.get(entity)
+        self._states[entity] = new
+        actions = []
+        for role, room in self._watchers.get(entity, ()):
+            if role == PIR:
+                if new == 'on':
+                    if (not room.num_blocking and not room.running
+                            and room.lights.lights_are_off(True)):
+                        room.running = True
+                        actions.append((TURN_ON, room))
+                    room.occupancy.add(now)
+                    if room.deadline is not None:
+                        room.deadline = None
+                        actions.append((CANCEL, room))
+                elif new == 'off':
+                    room.ts_pir_off = now
+                    room.deadline = now + room.occupancy.timeout(now)
+                    actions.append((ARM, room))
+            elif role == LIGHT:
+                if (room.lights.update(entity, new) and new != 'on'
+                        and room.running
+                        and room.lights.is_motion_light(entity)
+                        and not room.lights.all_motion_on):
+                    room.running = False
+                    actions.append((MANUAL_OFF, room))
+            elif role == TIMEOUT:
+                timeout = _timeout_value(new)
+                if timeout is not None and timeout != room.occupancy.base:
+                    room.occupancy.base = timeout
+                    if room.deadline is not None:
+                        room.deadline = (room.ts_pir_off
+                                         + room.occupancy.timeout(now))
+                        actions.append((ARM, room))
+            else:
+                room.num_blocking += (_blocks(role, new)
+                                      - _blocks(role, old))
+        return actions
+
+    def expire(self, name):
+        """Deadline of a room reached. Returns TURN_OFF, KEEP_ON or None."""
+        room = self.rooms[name]
+        if room.deadline is None:
+            # (cancelled by new motion after the timer fired)
+            return None
+        room.deadline = None
+        if not room.running or room.num_blocking:
+            return None
+        room.running = False
+        if room.lights.lights_are_off(include_motion_lights=False):
+            return TURN_OFF
+        return KEEP_ON
+
+    def __repr__(self):
+        return '<MotionRoomsEngine: {} rooms, {} entities>'.format(
+            len(self.rooms), len(self._watchers))
+
+
+class _SimApp(object):
+    """Fake AppDaemon scheduler, dropping the callbacks when constrained."""
+
+    def __init__(self):
+        self.now = 0.
+        self.constrained = False
+        self.num_dropped = 0
+        self._timers = {}
+        self._handles = count(1)
+
+    def clock(self):
+        """Simulated time."""
+        return self.now
+
+    def run_in(self, callback, delay, **kwargs):
+        """Timer (as AppDaemon)."""
+        handle = next(self._handles)
+        self._timers[handle] = (self.now + delay, callback, kwargs)
+        return handle
+
+    def cancel_timer(self, handle):
+        """Cancel a timer (as AppDaemon)."""
+        self._timers.pop(handle, None)
+
+    def dispatch(self, callback, *args):
+        """Run a callback, unless the app is constrained."""
+        if self.constrained:
+            self.num_dropped += 1
+            return
+        callback(*args)
+
+    def run_until(self, now):
+        """Run the timers due until `now`."""
+        due = sorted((ts, h) for h, (ts, _, _) in self._timers.items()
+                     if ts <= now)
+        for ts, handle in due:
+            _, callback, kwargs = self._timers.pop(handle)
+            self.now = max(self.now, ts)
+            self.dispatch(callback, kwargs)
+        self.now = now
+
+
+def simulate(num_rooms=50, hours=1., seed=42, watchdog=True,
+             closed=(3000, 3600)):
+    """Random motion in `num_rooms` rooms (with lights turned on & off by
+    hand), processed by one engine and one `ExpiryTimer`, with all the
+    callbacks dropped in the `closed` (start, end) secs of each hour
+    (out of the app constraints), and a minutely tick for the resync (and
+    expiry watchdog, if `watchdog`)."""
+    rnd = random.Random(seed)
+    app = _SimApp()
+    engine = MotionRoomsEngine()
+    shared = ['input_boolean.switch_master_alarm', 'media_player.kodi']
+    num_entities_per_room = 0
+    for i in range(num_rooms):
+        room = engine.add_room(
+            'room_{}'.format(i), 'binary_sensor.pir_{}'.format(i),
+            ['light.motion_{}_{}'.format(i, j) for j in range(3)],
+            ['light.other_{}_{}'.format(i, j) for j in range(3)],
+            timeout_entity='input_number.timeout_{}'.format(i),
+            disable=shared[:1], media_players=shared[1:])
+        num_entities_per_room += 1 + len(room.lights.lights) + 1 + 2
+    real = {e: 'off' for e in engine.entities}
+    real.update({'input_number.timeout_{}'.format(i): '120'
+                 for i in range(num_rooms)})
+    real['media_player.kodi'] = 'idle'
+    engine.reset(real)
+    engine.alive(0.)
+
+    # Events: (ts, entity, state) of PIRs & lights, and minutely ticks
+    events, end = [], hours * 3600
+    for i in range(num_rooms):
+        ts = rnd.expovariate(1 / 300.)
+        while ts < end:
+            events.append((ts, 'binary_sensor.pir_{}'.format(i), 'on'))
+            events.append((ts + rnd.uniform(5, 30),
+                           'binary_sensor.pir_{}'.format(i), 'off'))
+            if rnd.random() < .05:
+                events.append((ts + rnd.uniform(0, 600),
+                               'light.other_{}_0'.format(i),
+                               rnd.choice(['on', 'off'])))
+            ts += rnd.expovariate(1 / 300.)
+    # (drain until all the deadlines have passed, with no more motion)
+    end_ticks = end + 3 * DEFAULT_MOTION_LIGHT_TIMEOUT * 3
+    events.extend((60. * k, None, None)
+                  for k in range(1, int(end_ticks // 60) + 2))
+    events.sort(key=lambda x: (x[0], x[1] is None))
+    counter, owned = {}, set()  # (rooms with the lights ON by the app)
+
+    def _set_lights(lights, state):
+        for light in lights:
+            real[light] = state
+            app.dispatch(_state_change, light, state)
+
+    def _apply(actions):
+        for action, room in actions:
+            counter[action] = counter.get(action, 0) + 1
+            if action == TURN_ON:
+                owned.add(room.name)
+                _set_lights(room.lights.motion_lights, 'on')
+            elif action == MANUAL_OFF:
+                owned.discard(room.name)
+            elif action == ARM:
+                expiry.set(room.name, room.deadline)
+            elif action == CANCEL:
+                expiry.cancel(room.name)
+
+    def _state_change(entity, state):
+        if not engine.alive(app.now) and watchdog:
+            _apply(engine.check(real, app.now)[1])
+        _apply(engine.update(entity, state, app.now))
+
+    def _expired(name):
+        action = engine.expire(name)
+        counter[action] = counter.get(action, 0) + 1
+        if action in (TURN_OFF, KEEP_ON):
+            owned.discard(name)
+        if action == TURN_OFF:
+            _set_lights(engine.rooms[name].lights.motion_lights, 'off')
+
+    def _tick(kwargs):
+        if not engine.alive(app.now) and watchdog:
+            _apply(engine.check(real, app.now)[1])
+        if watchdog:
+            expiry.poll()
+
+    expiry = ExpiryTimer(app, _expired, clock=app.clock)
+    tic = time()
+    for ts, entity, state in events:
+        app.run_until(ts)
+        app.constrained = (ts < end
+                           and closed[0] <= ts % 3600 < closed[1])
+        if entity is None:
+            app.dispatch(_tick, {})
+        else:
+            real[entity] = state
+            app.dispatch(_state_change, entity, state)
+    took = time() - tic
+    stuck = sum(any(real[l] == 'on'
+                    for l in engine.rooms[name].lights.motion_lights)
+                for name in owned)
+    return dict(rooms=num_rooms, events=len(events), took=took,
+                us_per_event=1e6 * took / max(1, len(events)),
+                listeners=len(engine.entities),
+                listeners_per_app=num_entities_per_room, timers=2,
+                timers_per_app=2 * num_rooms, actions=counter,
+                dropped=app.num_dropped, stuck=stuck)
+
+
+def main():
+    """CLI for the multi-room simulation."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--hours', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    for watchdog in (True, False):
+        results = simulate(args.rooms, args.hours, args.seed, watchdog)
+        print('{rooms} rooms, {events} events in {took:.3f} s '
+              '({us_per_event:.2f} µs/event); {listeners} state listeners '
+              '(vs {listeners_per_app} with one app per room), {timers} '
+              'timers (vs {timers_per_app}): {actions}; {dropped} dropped '
+              'callbacks, {stuck} rooms left ON'.format(**results)
+              + ('' if watchdog else ' (without resync & watchdog)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: PNG charts of the local power history.
+
+Charts are rendered in-process with the matplotlib Agg backend (OO API, no
+pyplot global state, so it can run in the AppDaemon worker threads), from
+the downsampled data of a `PowerHistory` (the energy bars are integrated
+with the same method of its kWh summaries). Rendered images are cached by
+(chart, window, resolution), and only re-rendered when the history has
+new samples:
+
+```
+    self._charts = PowerChartRenderer(path_charts)
+    ...
+    history = self.get_app('EnerpiPeakNotifier').history
+    file_png = self._charts.power_chart(history, window=86400)
+    self.call_service('telegram_bot/send_photo', file=file_png, ...)
+```
+
+"""
+import datetime as dt
+import os
+from threading import Lock
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+import numpy as np
+
+from lru_cache import LRUCache
+
+
+DEFAULT_WINDOW = 24 * 3600
+DEFAULT_POWER_RESOLUTION = 288  # 5 min buckets in 24h
+DEFAULT_ENERGY_RESOLUTION = 24  # 1 hour bars in 24h
+DEFAULT_FIGSIZE = (8, 4)
+DEFAULT_DPI = 100
+DEFAULT_KWH_PRICE = .13  # €/kWh
+MAX_CACHED_CHARTS = 16
+COLOR_POWER = '#8C27D3'
+COLOR_ENERGY = '#1F77B4'
+
+
+def _dates(timestamps):
+    return [dt.datetime.fromtimestamp(ts) for ts in timestamps]
+
+
+class PowerChartRenderer(object):
+    """Cached PNG renderer of power & energy charts."""
+
+    def __init__(self, path, figsize=DEFAULT_FIGSIZE, dpi=DEFAULT_DPI,
+                 kwh_price=DEFAULT_KWH_PRICE):
+        self.path = path
+        self.figsize = figsize
+        self.dpi = dpi
+        self.kwh_price = kwh_price
+        # (chart, window, resolution) -> (last sample ts, file path)
+        self._cache = LRUCache(max_items=MAX_CACHED_CHARTS)
+        self._lock = Lock()
+        self.num_renders = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _cached(self, chart, history, window, resolution, render):
+        last = history.last
+        if last is None:
+            return None
+        key = (chart, window, resolution)
+        with self._lock:
+            cached = self._cache.get(key)
+            if (cached is not None and cached[0] == last[0]
+                    and os.path.exists(cached[1])):
+                return cached[1]
+            file_path = os.path.join(self.path, 'enerpi_{}_{}_{}.png'
+                                     .format(chart, window, resolution))
+            fig = Figure(figsize=self.figsize, dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(111)
+            now = last[0]
+            render(ax, now - window, now)
+            ax.xaxis.set_major_formatter(DateFormatter('%H:%M'))
+            ax.grid(True, alpha=.3)
+            fig.autofmt_xdate()
+            fig.tight_layout()
+            fig.savefig(file_path, format='png')
+            self._cache.set(key, (last[0], file_path))
+            self.num_renders += 1
+            return file_path
+
+    def power_chart(self, history, window=DEFAULT_WINDOW,
+                    resolution=DEFAULT_POWER_RESOLUTION):
+        """Power (W) chart: mean line, over the min-max band of each bucket.
+
+        Returns the PNG path (None without data)."""
+
+        def _render(ax, since, until):
+            ts, mins, maxs, means = history.downsample(since, until,
+                                                       resolution)
+            dates = _dates(ts)
+            ax.fill_between(dates, mins, maxs, color=COLOR_POWER, alpha=.25,
+                            linewidth=0)
+            ax.plot(dates, means, color=COLOR_POWER, linewidth=1.2)
+            ax.set_ylim(bottom=0)
+            ax.set_ylabel('W')
+            if not np.all(np.isnan(maxs)):
+                ax.set_title('Potencia eléctrica (máx. {:.0f} W)'
+                             .format(np.nanmax(maxs)))
+
+        return self._cached('power', history, window, resolution, _render)
+
+    def energy_chart(self, history, window=DEFAULT_WINDOW,
+                     resolution=DEFAULT_ENERGY_RESOLUTION):
+        """Energy (kWh) bars per bucket, with the total cost in the title.
+
+        Returns the PNG path (None without data)."""
+        bucket_hours = window / 3600. / resolution
+
+        def _render(ax, since, until):
+            ts, kwh = history.energy_buckets(since, until, resolution)
+            ax.bar(_dates(ts), kwh, width=bucket_hours / 24., align='edge',
+                   color=COLOR_ENERGY)
+            ax.set_ylabel('kWh')
+            total = kwh.sum()
+            ax.set_title('Consumo: {:.2f} kWh, {:.2f} €'
+                         .format(total, total * self.kwh_price))
+
+        return self._cached('kwh', history, window, resolution, _render)
+
+    def __repr__(self):
+        return '<PowerChartRenderer: {} renders, {} in {}>'.format(
+            self.num_renders, self._cache, self.path)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: high resolution history of a power signal.
+
+A ring buffer of (timestamp, watts) samples over preallocated NumPy arrays
+(~1 MB for 24h at 1 Hz), so memory is bounded and adding a sample is O(1).
+Queries are vectorized over the buffer: time windows, min/max/mean
+downsampling in buckets (for charts), peak & energy summaries.
+
+With a `path`, the buffer is mirrored in a memory-mapped file: `snapshot`
+only copies the samples added since the last one, and the history is
+restored from it at startup (crash recovery):
+
+```
+    self._history = PowerHistory(capacity=86400, path='/data/enerpi.mmap')
+    ...
+    self._history.add(time(), watts)
+    summary = self._history.summary(since=time() - 3600)
+    ts, mins, maxs, means = self._history.downsample(now - 86400, now, 288)
+    ts, kwh = self._history.energy_buckets(now - 86400, now, 24)
+    ...
+    self._history.snapshot()  # periodically
+```
+
+"""
+import os
+from threading import Lock
+
+import numpy as np
+
+
+DEFAULT_CAPACITY = 24 * 3600  # 24h at 1 Hz
+# Max. gap (s) between samples to integrate energy (longer gaps are ignored)
+MAX_GAP_INTEGRATION = 600
+
+
+class PowerHistory(object):
+    """Bounded ring buffer of power samples, with a memmap snapshot."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, path=None):
+        self.capacity = int(capacity)
+        self.path = path
+        self._ts = np.zeros(self.capacity, dtype=np.float64)
+        self._values = np.zeros(self.capacity, dtype=np.float32)
+        self._head = 0  # next position to write
+        self._count = 0
+        self._num_added = 0
+        self._num_saved = 0
+        self._mmap = None
+        self._lock = Lock()
+        if path is not None:
+            self._open_snapshot()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def last(self):
+        """Last (ts, watts) sample, or None if empty."""
+        if not self._count:
+            return None
+        idx = (self._head - 1) % self.capacity
+        return float(self._ts[idx]), float(self._values[idx])
+
+    def add(self, ts, watts):
+        """Add a sample (timestamps in increasing order). O(1)."""
+        with self._lock:
+            if self._count and ts < self._ts[(self._head - 1)
+                                             % self.capacity]:
+                return False
+            self._ts[self._head] = ts
+            self._values[self._head] = watts
+            self._head = (self._head + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+            self._num_added += 1
+            return True
+
+    def _ordered(self):
+        """Copies of the (ts, values) arrays, from the oldest sample."""
+        start = (self._head - self._count) % self.capacity
+        if start + self._count <= self.capacity:
+            sl = slice(start, start + self._count)
+            return self._ts[sl].copy(), self._values[sl].copy()
+        return (np.concatenate((self._ts[start:], self._ts[:self._head])),
+                np.concatenate((self._values[start:],
+                                self._values[:self._head])))
+
+    def window(self, since=None, until=None):
+        """Samples (ts, watts arrays) in [since, until]."""
+        with self._lock:
+            ts, values = self._ordered()
+        i0 = 0 if since is None else np.searchsorted(ts, since, 'left')
+        i1 = len(ts) if until is None else np.searchsorted(ts, until, 'right')
+        return ts[i0:i1], values[i0:i1]
+
+    def downsample(self, since, until, num_buckets):
+        """Min, max & mean of the samples in `num_buckets` equal buckets
+        between `since` and `until`.
+
+        Returns (bucket_ts, mins, maxs, means), with NaN in empty buckets."""
+        ts, values = self.window(since, until)
+        width = (until - since) / float(num_buckets)
+        bucket_ts = since + width * np.arange(num_buckets)
+        mins = np.full(num_buckets, np.nan)
+        maxs = np.full(num_buckets, np.nan)
+        means = np.full(num_buckets, np.nan)
+        if not len(ts):
+            return bucket_ts, mins, maxs, means
+        idx = np.minimum(((ts - since) / width).astype(np.int64),
+                         num_buckets - 1)
+        # Samples are sorted, so each bucket is a contiguous slice
+        starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+        buckets = idx[starts]
+        mins[buckets] = np.minimum.reduceat(values, starts)
+        maxs[buckets] = np.maximum.reduceat(values, starts)
+        sums = np.add.reduceat(values.astype(np.float64), starts)
+        means[buckets] = sums / np.diff(np.r_[starts, len(idx)])
+        return bucket_ts, mins, maxs, means
+
+    def _energy_intervals(self, since, until):
+        # kWh of each interval between samples (ignoring long gaps)
+        ts, values = self.window(since, until)
+        if len(ts) < 2:
+            return ts[:0], np.zeros(0)
+        deltas = np.diff(ts)
+        deltas[deltas > MAX_GAP_INTEGRATION] = 0
+        return ts[:-1], values[:-1] * deltas / 3600000.
+
+    def energy_kwh(self, since=None, until=None):
+        """Energy (kWh) in the window, as a left Riemann sum."""
+        return float(self._energy_intervals(since, until)[1].sum())
+
+    def energy_buckets(self, since, until, num_buckets):
+        """Energy (kWh) in `num_buckets` equal buckets between `since` and
+        `until` (each interval between samples in the bucket of its start),
+        adding up to `energy_kwh(since, until)`.
+
+        Returns (bucket_ts, kwh)."""
+        width = (until - since) / float(num_buckets)
+        bucket_ts = since + width * np.arange(num_buckets)
+        ts, kwh = self._energy_intervals(since, until)
+        idx = np.minimum(((ts - since) / width).astype(np.int64),
+                         num_buckets - 1)
+        return bucket_ts, np.bincount(idx, weights=kwh,
+                                      minlength=num_buckets)
+
+    def summary(self, since=None, until=None):
+        """Stats of the window: samples, mean, max (& ts), min, kWh.
+
+        Returns None if there are no samples."""
+        ts, values = self.window(since, until)
+        if not len(ts):
+            return None
+        i_max = int(np.argmax(values))
+        return {'num_samples': len(ts),
+                'ts_first': float(ts[0]), 'ts_last': float(ts[-1]),
+                'mean': float(values.mean()),
+                'max': float(values[i_max]), 'ts_max': float(ts[i_max]),
+                'min': float(values.min()),
+                'kwh': self.energy_kwh(since, until)}
+
+    def _open_snapshot(self):
+        """Open (or create) the memmap file, restoring the saved history.
+
+        Layout: (capacity + 1) rows of (ts, watts) float64, with
+        (head, count) in the first row."""
+        shape = (self.capacity + 1, 2)
+        if os.path.exists(self.path) and (os.path.getsize(self.path)
+                                          == shape[0] * shape[1] * 8):
+            self._mmap = np.memmap(self.path, dtype=np.float64, mode='r+',
+                                   shape=shape)
+            head, count = self._mmap[0]
+            self._head = int(head) % self.capacity
+            self._count = min(int(count), self.capacity)
+            self._ts[:] = self._mmap[1:, 0]
+            self._values[:] = self._mmap[1:, 1]
+        else:
+            dir_path = os.path.dirname(self.path)
+            if dir_path and not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+            self._mmap = np.memmap(self.path, dtype=np.float64, mode='w+',
+                                   shape=shape)
+
+    def snapshot(self):
+        """Copy the new samples to the memmap file and flush it.
+
+        Returns the number of samples written."""
+        if self._mmap is None:
+            return 0
+        with self._lock:
+            num_new = min(self._num_added - self._num_saved, self.capacity)
+            if not num_new:
+                return 0
+            idx = (self._head - num_new + np.arange(num_new)) % self.capacity
+            self._mmap[idx + 1, 0] = self._ts[idx]
+            self._mmap[idx + 1, 1] = self._values[idx]
+            self._mmap[0] = (self._head, self._count)
+            self._num_saved = self._num_added
+        self._mmap.flush()
+        return num_new
+
+    def __repr__(self):
+        return '<PowerHistory: {} of {} samples{}>'.format(
+            self._count, self.capacity,
+            ', in {}'.format(self.path) if self.path else '')
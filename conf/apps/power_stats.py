@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: streaming statistics of a power signal.
+
+All the estimators are updated in O(1) (amortized) per sample, without
+keeping the full history:
+
+- `Ewma`: exponentially weighted moving average with a time constant, for
+  irregular step-held samples (like HA state changes, where the previous
+  value holds until the next change),
+- `RollingWindow`: mean, max & min of the last `window` seconds (running sum
+  and monotonic deques),
+- `QuantileSketch`: percentiles with relative accuracy, over log-spaced
+  buckets (a few hundred counters for the full range of power values),
+- `PowerStats`: all of them for one sensor, plus the kWh integration,
+  with the values as HA attributes (`ewma_10s`, `mean_5min`, `p90`, ...).
+
+"""
+from collections import deque
+from math import ceil, exp, log
+from time import localtime, time
+
+
+DEFAULT_EWMA_TAUS = (10, 60)
+# Nominal period (s) of a new sample, for its weight in the EWMA
+EWMA_SAMPLE_PERIOD = 1.
+DEFAULT_WINDOWS = (60, 300, 900)
+DEFAULT_QUANTILES = (.5, .9, .99)
+# Max. gap (s) between samples to integrate energy (longer gaps are ignored)
+MAX_GAP_INTEGRATION = 600
+
+
+def _label(secs):
+    if secs % 60 == 0:
+        return '{}min'.format(secs // 60)
+    return '{}s'.format(secs)
+
+
+class Ewma(object):
+    """EWMA with time constant `tau` (s), for irregular step-held samples.
+
+    Over the gap since the last sample, the average decays toward the held
+    last value, and then the new sample enters with the weight of one
+    `sample_period`, so a single spike after a long gap is still smoothed."""
+
+    __slots__ = ('tau', 'value', 'last_ts', 'last_value', '_alpha_sample')
+
+    def __init__(self, tau, sample_period=EWMA_SAMPLE_PERIOD):
+        self.tau = tau
+        self.value = self.last_value = None
+        self.last_ts = None
+        self._alpha_sample = 1. - exp(-sample_period / tau)
+
+    def add(self, ts, value):
+        """Update with a new sample. Returns the smoothed value."""
+        value = float(value)
+        if self.value is None:
+            self.value = value
+        else:
+            decay = exp(-max(0., ts - self.last_ts) / self.tau)
+            self.value = self.last_value + decay * (self.value
+                                                    - self.last_value)
+            self.value += self._alpha_sample * (value - self.value)
+        self.last_ts = ts
+        self.last_value = value
+        return self.value
+
+
+class RollingWindow(object):
+    """Mean, max & min of the samples in the last `window` seconds."""
+
+    __slots__ = ('window', '_samples', '_sum', '_max', '_min')
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = deque()
+        self._sum = 0.
+        self._max = deque()  # decreasing values
+        self._min = deque()  # increasing values
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, ts, value):
+        """Add a sample (timestamps in increasing order)."""
+        self._samples.append((ts, value))
+        self._sum += value
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((ts, value))
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((ts, value))
+        self.expire(ts)
+
+    def expire(self, now):
+        """Remove the samples older than the window."""
+        limit = now - self.window
+        samples = self._samples
+        while samples and samples[0][0] < limit:
+            self._sum -= samples.popleft()[1]
+        while self._max and self._max[0][0] < limit:
+            self._max.popleft()
+        while self._min and self._min[0][0] < limit:
+            self._min.popleft()
+
+    @property
+    def mean(self):
+        """Mean value in the window (None if empty)."""
+        return self._sum / len(self._samples) if self._samples else None
+
+    @property
+    def max(self):
+        """Max value in the window (None if empty)."""
+        return self._max[0][1] if self._max else None
+
+    @property
+    def min(self):
+        """Min value in the window (None if empty)."""
+        return self._min[0][1] if self._min else None
+
+
+class QuantileSketch(object):
+    """Quantiles with `relative_accuracy`, with log-spaced buckets."""
+
+    def __init__(self, relative_accuracy=.02):
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = log(self._gamma)
+        self._buckets = {}
+        self._zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        """Add a (non negative) value."""
+        self.count += 1
+        if value <= 0:
+            self._zeros += 1
+            return
+        idx = int(ceil(log(value) / self._log_gamma))
+        self._buckets[idx] = self._buckets.get(idx, 0) + 1
+
+    def quantile(self, q):
+        """Estimated `q`-quantile (0 <= q <= 1), or None if empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        cum = self._zeros
+        if rank < cum:
+            return 0.
+        for idx in sorted(self._buckets):
+            cum += self._buckets[idx]
+            if cum > rank:
+                return 2 * self._gamma ** idx / (self._gamma + 1)
+        return 2 * self._gamma ** max(self._buckets) / (self._gamma + 1)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class PowerStats(object):
+    """Streaming statistics (EWMA, rolling windows, kWh, percentiles)."""
+
+    def __init__(self, ewma_taus=DEFAULT_EWMA_TAUS, windows=DEFAULT_WINDOWS,
+                 quantiles=DEFAULT_QUANTILES, relative_accuracy=.02):
+        self.ewmas = [Ewma(tau) for tau in ewma_taus]
+        self.windows = [RollingWindow(w) for w in windows]
+        self.quantiles = quantiles
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.last_ts = None
+        self.last_value = None
+        self.kwh_total = 0.
+        self.kwh_today = 0.
+        self._day = None
+        self.num_samples = 0
+
+    def add(self, ts, watts):
+        """Add a power sample (W) at `ts` (s)."""
+        if self.last_ts is not None:
+            delta = ts - self.last_ts
+            if delta < 0:
+                return
+            if delta <= MAX_GAP_INTEGRATION:
+                # Left Riemann sum: power is a step function in HA
+                kwh = self.last_value * delta / 3600000.
+                self.kwh_total += kwh
+                self.kwh_today += kwh
+        day = localtime(ts).tm_yday
+        if day != self._day:
+            self._day = day
+            self.kwh_today = 0.
+        for e in self.ewmas:
+            e.add(ts, watts)
+        for w in self.windows:
+            w.add(ts, watts)
+        self.sketch.add(watts)
+        self.last_ts = ts
+        self.last_value = watts
+        self.num_samples += 1
+
+    def ewma(self, idx=0):
+        """Smoothed value (EWMA) with the `idx` time constant."""
+        return self.ewmas[idx].value
+
+    def attributes(self, now=None):
+        """Stats as HA attributes."""
+        if now is None:
+            now = time()
+        attrs = {}
+        for e in self.ewmas:
+            if e.value is not None:
+                attrs['ewma_{}'.format(_label(e.tau))] = round(e.value, 1)
+        for w in self.windows:
+            w.expire(now)
+            if len(w):
+                label = _label(w.window)
+                attrs['mean_' + label] = round(w.mean, 1)
+                attrs['max_' + label] = round(w.max, 1)
+                attrs['min_' + label] = round(w.min, 1)
+        for q in self.quantiles:
+            value = self.sketch.quantile(q)
+            if value is not None:
+                attrs['p{}'.format(int(q * 100))] = round(value, 1)
+        attrs.update(kwh_total=round(self.kwh_total, 3),
+                     kwh_today=round(self.kwh_today, 3),
+                     num_samples=self.num_samples)
+        return attrs
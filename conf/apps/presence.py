@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: incremental presence model of people at home.
+
+Each person has one or more tracked devices (device trackers, groups, or
+`input_boolean` extra trackers), and is at home when any of them is at
+home. The model keeps the count of present devices per person and the set
+of people at home, so each device change is O(1), and it reports only the
+real person transitions (arrival / departure):
+
+```
+    self._presence = PresenceModel()
+    self._presence.add('group.eugenio', 'Eugenio', 'home')
+    self._presence.add('input_boolean.eu_presence', 'Eugenio', 'off')
+    ...
+    person, event = self._presence.update(entity, new_state, now)
+    if event is not None:  # ARRIVAL / DEPARTURE
+        target = select_target(self._presence.people_home, targets, default)
+```
+
+Simulation with a month of tracker changes, checking the incremental model
+against the full recomputation:
+
+```
+    python presence.py --people 4 --devices 2 --days 30
+```
+
+"""
+import argparse
+import random
+from time import time
+
+
+ARRIVAL, DEPARTURE = 'arrival', 'departure'
+HOME_STATES = ('home', 'on')
+
+
+def is_home(state):
+    """Device state at home."""
+    return state in HOME_STATES
+
+
+def select_target(people_home, targets, default, last_person=None):
+    """Telegram target for the people at home: the person alone at home,
+    the last one exiting (with `last_person`, when nobody is at home),
+    or the default (home group) target."""
+    if len(people_home) == 1:
+        return targets.get(next(iter(people_home)))
+    if not people_home and last_person is not None:
+        return targets.get(last_person)
+    return default
+
+
+class _Device(object):
+    """Tracked device record."""
+
+    __slots__ = ('person', 'state', 'at_home', 'last_changed')
+
+    def __init__(self, person, state, last_changed):
+        self.person = person
+        self.state = state
+        self.at_home = is_home(state)
+        self.last_changed = last_changed
+
+
+class PresenceModel(object):
+    """People at home from counts of present devices, with O(1) updates."""
+
+    def __init__(self):
+        self._devices = {}
+        self._count = {}
+        self.people_home = set()
+        self.last_arrival = self.last_departure = None  # (person, ts)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, device):
+        return device in self._devices
+
+    @property
+    def anybody_home(self):
+        """True if any person is at home."""
+        return bool(self.people_home)
+
+    @property
+    def people(self):
+        """Tracked people."""
+        return list(self._count)
+
+    def device(self, device):
+        """(state, last_changed) of a tracked device."""
+        dev = self._devices[device]
+        return dev.state, dev.last_changed
+
+    def add(self, device, person, state, last_changed=None):
+        """Track a device of a person."""
+        dev = _Device(person, state, last_changed)
+        self._devices[device] = dev
+        self._count[person] = self._count.get(person, 0) + dev.at_home
+        if self._count[person]:
+            self.people_home.add(person)
+
+    def update(self, device, state, ts=None):
+        """New device state. Returns (person, ARRIVAL | DEPARTURE | None)."""
+        dev = self._devices[device]
+        at_home = is_home(state)
+        dev.state = state
+        dev.last_changed = ts
+        if at_home == dev.at_home:
+            return dev.person, None
+        dev.at_home = at_home
+        person = dev.person
+        count = self._count[person] + (1 if at_home else -1)
+        self._count[person] = count
+        if at_home and count == 1:
+            self.people_home.add(person)
+            self.last_arrival = person, ts
+            return person, ARRIVAL
+        if not at_home and count == 0:
+            self.people_home.discard(person)
+            self.last_departure = person, ts
+            return person, DEPARTURE
+        return person, None
+
+    def recompute_people_home(self):
+        """People at home, recomputed from all the devices (O(devices))."""
+        return set(dev.person for dev in self._devices.values()
+                   if dev.at_home)
+
+    def __repr__(self):
+        return '<PresenceModel: {} devices, {} people, at home: {}>'.format(
+            len(self._devices), len(self._count),
+            ', '.join(sorted(self.people_home)) or '-')
+
+
+def generate_month(num_people=4, devices_per_person=2, days=30, seed=42):
+    """Synthetic tracker changes (ts, device, state) of `days` days: daily
+    routines with jitter, weekend outings, and zone changes out of home."""
+    rnd = random.Random(seed)
+    devices = {'person_{}'.format(p): ['device_tracker.person_{}_{}'
+                                       .format(p, d)
+                                       for d in range(devices_per_person)]
+               for p in range(num_people)}
+    events = []
+    for person, devs in devices.items():
+        for day in range(days):
+            t0 = day * 86400
+            outings = ([(8, 10), (18, 2)] if day % 7 < 5
+                       else [(11, 3)] * rnd.randint(0, 2) + [(19, 4)])
+            for hour, duration in outings:
+                if rnd.random() < .1:
+                    continue
+                leave = t0 + 3600 * (hour + rnd.gauss(0, .5))
+                back = leave + 3600 * max(.5, duration + rnd.gauss(0, 1))
+                for dev in devs:
+                    delay = abs(rnd.gauss(0, 120))
+                    events.append((leave + delay, dev, 'not_home'))
+                    for _ in range(rnd.randint(0, 3)):  # zone changes
+                        events.append((rnd.uniform(leave + delay, back), dev,
+                                       rnd.choice(['work', 'not_home'])))
+                    events.append((back + abs(rnd.gauss(0, 300)), dev,
+                                   'home'))
+    events.sort()
+    return devices, events
+
+
+def simulate(num_people=4, devices_per_person=2, days=30, seed=42):
+    """Replay a month of changes in the incremental model, verifying it
+    against the full recomputation, and counting the service calls."""
+    devices, events = generate_month(num_people, devices_per_person, days,
+                                     seed)
+    model = PresenceModel()
+    for person, devs in devices.items():
+        for dev in devs:
+            model.add(dev, person, 'home')
+    targets = {person: i for i, person in enumerate(devices)}
+    target = select_target(model.people_home, targets, -1)
+    num_transitions = num_calls = num_errors = 0
+    tic = time()
+    for ts, dev, state in events:
+        _, event = model.update(dev, state, ts)
+        if event is None:
+            continue
+        num_transitions += 1
+        new_target = select_target(model.people_home, targets, -1)
+        if new_target != target:
+            target = new_target
+            num_calls += 1
+    took = time() - tic
+    # Verification (and cost) of the full recomputation on each change
+    check = PresenceModel()
+    for person, devs in devices.items():
+        for dev in devs:
+            check.add(dev, person, 'home')
+    tic = time()
+    for ts, dev, state in events:
+        check.update(dev, state, ts)
+        if check.recompute_people_home() != check.people_home:
+            num_errors += 1
+    took_naive = time() - tic
+    return dict(people=num_people, devices=len(model), days=days,
+                events=len(events), transitions=num_transitions,
+                calls=num_calls, errors=num_errors,
+                us_per_event=1e6 * took / max(1, len(events)),
+                us_per_event_naive=1e6 * took_naive / max(1, len(events)))
+
+
+def main():
+    """CLI for the month replay simulation."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--people', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    results = simulate(args.people, args.devices, args.days, args.seed)
+    print('{people} people, {devices} devices, {days} days: {events} '
+          'changes, {transitions} person transitions, {calls} target '
+          'changes (service calls), {errors} errors; {us_per_event:.2f} '
+          'µs/change (with full recomputation: {us_per_event_naive:.2f} '
+          'µs/change)'.format(**results))
+    if results['errors']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: presence transitions history & prediction.
+
+`PresenceHistory` is a compact on-disk time series of person transitions
+(arrival / departure), as fixed 7-byte binary records (uint32 timestamp,
+uint16 person index, uint8 event), with the person names in a `.json`
+sidecar. New transitions are buffered and appended in batches (`flush`).
+Without `path` it is a memory-only history of the last `max_memory`
+transitions (never a full batch to flush).
+
+`PresencePredictor` keeps, for each person & event, a histogram of the
+transitions by weekday and time of day (15 min bins), with the number of
+observed days of each weekday, and precomputed cumulative sums, so queries
+like "probability that someone arrives in the next 30 min" or "likely
+arrival time" are a few array lookups (microseconds):
+
+```
+    self._history = PresenceHistory(os.path.join(path_base_data, 'presence'))
+    self._predictor = PresencePredictor.from_history(self._history, tz)
+    ...
+    self._history.append(person, ARRIVAL, ts)
+    self._predictor.add(person, ARRIVAL, ts)
+    ...
+    p = self._predictor.probability_any(people_away, ARRIVAL, now, 30 * 60)
+    ts_arrival = self._predictor.expected_time(person, ARRIVAL, now)
+```
+
+"""
+from collections import deque
+import datetime as dt
+import json
+import os
+from threading import Lock
+
+import numpy as np
+
+from presence import ARRIVAL, DEPARTURE
+
+
+EVENTS = (ARRIVAL, DEPARTURE)
+RECORD_DTYPE = np.dtype([('ts', '<u4'), ('person', '<u2'), ('event', 'u1')])
+DEFAULT_BIN_MINUTES = 15
+DEFAULT_BATCH_SIZE = 20
+# Transitions kept by a memory-only history (without path)
+DEFAULT_MAX_MEMORY = 10000
+
+
+class PresenceHistory(object):
+    """Append-only binary file of presence transitions, written in batches."""
+
+    def __init__(self, path=None, batch_size=DEFAULT_BATCH_SIZE,
+                 max_memory=DEFAULT_MAX_MEMORY):
+        self.path = path
+        self.batch_size = batch_size
+        self._people = []
+        self._buffer = deque(maxlen=max_memory if path is None else None)
+        self._lock = Lock()
+        if path is not None:
+            dir_path = os.path.dirname(path)
+            if dir_path and not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+            if os.path.exists(path + '.json'):
+                with open(path + '.json') as f:
+                    self._people = json.load(f)
+
+    @property
+    def num_pending(self):
+        """Transitions waiting to be written."""
+        return len(self._buffer)
+
+    def _person_index(self, person):
+        if person not in self._people:
+            self._people.append(person)
+            if self.path is not None:
+                with open(self.path + '.json', 'w') as f:
+                    json.dump(self._people, f)
+        return self._people.index(person)
+
+    def append(self, person, event, ts):
+        """Buffer a transition. Returns True when the batch is full
+        (never in memory-only mode)."""
+        with self._lock:
+            self._buffer.append((int(ts), self._person_index(person),
+                                 EVENTS.index(event)))
+            return (self.path is not None
+                    and len(self._buffer) >= self.batch_size)
+
+    def flush(self):
+        """Write the buffered transitions. Returns the number written."""
+        with self._lock:
+            if not self._buffer or self.path is None:
+                return 0
+            records = np.array(list(self._buffer), dtype=RECORD_DTYPE)
+            with open(self.path, 'ab') as f:
+                records.tofile(f)
+            self._buffer.clear()
+            return len(records)
+
+    def read(self):
+        """All the transitions (saved & buffered), as (ts, person, event)."""
+        records = []
+        if self.path is not None and os.path.exists(self.path):
+            records = np.fromfile(self.path, dtype=RECORD_DTYPE).tolist()
+        with self._lock:
+            records = records + list(self._buffer)
+        return [(ts, self._people[p], EVENTS[e]) for ts, p, e in records]
+
+    def __len__(self):
+        saved = 0
+        if self.path is not None and os.path.exists(self.path):
+            saved = os.path.getsize(self.path) // RECORD_DTYPE.itemsize
+        return saved + len(self._buffer)
+
+    def __repr__(self):
+        return '<PresenceHistory: {} transitions of {} people{}>'.format(
+            len(self), len(self._people),
+            ', in {}'.format(self.path) if self.path else '')
+
+
+class PresencePredictor(object):
+    """Weekday & time of day histograms of the presence transitions."""
+
+    def __init__(self, tz=None, bin_minutes=DEFAULT_BIN_MINUTES):
+        self.tz = tz
+        self.bin_secs = bin_minutes * 60
+        self.num_bins = 86400 // self.bin_secs
+        self._counts = {}  # (person, event) -> [7, num_bins] counts
+        self._cumsum = {}  # (person, event) -> [7, 2 * num_bins + 1]
+        self._first_day = self._last_day = None
+        self._days_weekday = np.zeros(7)
+
+    @classmethod
+    def from_history(cls, history, tz=None, bin_minutes=DEFAULT_BIN_MINUTES):
+        """Predictor trained with all the transitions of a history."""
+        predictor = cls(tz, bin_minutes)
+        for ts, person, event in history.read():
+            predictor.add(person, event, ts, update=False)
+        for key in predictor._counts:
+            predictor._update_cumsum(key)
+        return predictor
+
+    def _locate(self, ts):
+        local = dt.datetime.fromtimestamp(ts, self.tz)
+        secs = local.hour * 3600 + local.minute * 60 + local.second
+        return local.date(), local.weekday(), secs // self.bin_secs
+
+    def _update_cumsum(self, key):
+        # Two days in a row (next day of the week), so any horizon
+        # until 24h is a difference of two cumulative sums
+        counts = self._counts[key]
+        two_days = np.hstack((counts, np.roll(counts, -1, axis=0)))
+        self._cumsum[key] = np.hstack((np.zeros((7, 1)),
+                                       np.cumsum(two_days, axis=1)))
+
+    def _update_days(self, day):
+        # Observed days of each weekday, from the first to the last day
+        if self._first_day is not None and (
+                self._first_day <= day <= self._last_day):
+            return
+        self._first_day = min(day, self._first_day or day)
+        self._last_day = max(day, self._last_day or day)
+        num_days = (self._last_day - self._first_day).days + 1
+        first_weekday = self._first_day.weekday()
+        self._days_weekday = np.array(
+            [len(range((w - first_weekday) % 7, num_days, 7))
+             for w in range(7)], dtype=float)
+
+    def add(self, person, event, ts, update=True):
+        """Learn a transition."""
+        day, weekday, bin_idx = self._locate(ts)
+        self._update_days(day)
+        key = (person, event)
+        if key not in self._counts:
+            self._counts[key] = np.zeros((7, self.num_bins))
+        self._counts[key][weekday, bin_idx] += 1
+        if update:
+            self._update_cumsum(key)
+
+    @property
+    def num_days(self):
+        """Observed days."""
+        return int(self._days_weekday.sum())
+
+    def probability(self, person, event, now, horizon):
+        """Probability of a transition of `person` in the next `horizon`
+        seconds (mean number of events in that window of the day, <= 1)."""
+        return self.probability_any([person], event, now, horizon)
+
+    def probability_any(self, people, event, now, horizon):
+        """Probability of a transition of any of `people` (independent)."""
+        _, weekday, bin_idx = self._locate(now)
+        days = self._days_weekday[weekday]
+        if not days:
+            return 0.
+        end = bin_idx + 1 + min(int(horizon // self.bin_secs), self.num_bins)
+        p_none = 1.
+        for person in people:
+            cumsum = self._cumsum.get((person, event))
+            if cumsum is not None:
+                p_none *= 1. - min(1., (cumsum[weekday, end]
+                                        - cumsum[weekday, bin_idx]) / days)
+        return 1. - float(p_none)
+
+    def expected_time(self, person, event, now, min_prob=.5):
+        """Timestamp of the most likely next transition of `person` in the
+        next 24h (when the cumulative probability reaches `min_prob`), or
+        None without enough data."""
+        cumsum = self._cumsum.get((person, event))
+        if cumsum is None:
+            return None
+        _, weekday, bin_idx = self._locate(now)
+        days = self._days_weekday[weekday]
+        if not days:
+            return None
+        row = cumsum[weekday, bin_idx:bin_idx + self.num_bins + 1]
+        probs = (row - row[0]) / days
+        reached = np.flatnonzero(probs >= min_prob)
+        if not len(reached):
+            return None
+        start_bin = now - now % self.bin_secs
+        return start_bin + int(reached[0]) * self.bin_secs
+
+    def __repr__(self):
+        return '<PresencePredictor: {} days, {} histograms, bins of {} min>' \
+            .format(self.num_days, len(self._counts), self.bin_secs // 60)
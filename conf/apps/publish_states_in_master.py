@@ -15,17 +15,102 @@ master state updates in the slave instance, so it's a one-way information
 pipe, **only from slave to master**, and it's better (=quicker response) than
 the REST sensors because it doesn't depend of scan intervals.
 
+The replicated entities can be filtered by domain, with include / exclude
+lists of glob patterns (or regular expressions, with the `re:` prefix), and
+the attributes sent for each entity can be reduced to an allow-list:
+
+```yaml
+SlavePublisher:
+  class: SlavePublisher
+  module: publish_states_in_master
+  master_ha_url: 192.168.1.10
+  filters:
+    sensor:
+      include: sensor.cpu_*,sensor.ram_*,re:sensor\.disk_use_\w+
+    binary_sensor:
+      exclude: binary_sensor.*_online
+  attributes:
+    sensor.cpu_*: friendly_name,unit_of_measurement
+    '*': friendly_name,device_class,unit_of_measurement,icon
+```
+
 """
 import appdaemon.appapi as appapi
 import homeassistant.remote as remote
-import datetime as dt
-from dateutil.parser import parse
-from math import ceil
+from fnmatch import translate
+import json
+import re
+
+from raw_sensors import RawSensorEngine, RemoteStateOutput
 
 
 LOG_LEVEL = 'INFO'
 DEFAULT_SUFFIX = '_slave'
 DEFAULT_RAWBS_SECS_OFF = 10
+REPLICATED_DOMAINS = ['sensor', 'binary_sensor']
+PREFIX_REGEX = 're:'
+
+
+def _compile_patterns(patterns):
+    """Compile a list of globs / regexs (`re:` prefix) in only one regex."""
+    if isinstance(patterns, str):
+        patterns = patterns.split(',')
+    regexs = [p.strip()[len(PREFIX_REGEX):] if p.strip().startswith(PREFIX_REGEX)
+              else translate(p.strip()) for p in patterns or [] if p.strip()]
+    if not regexs:
+        return None
+    return re.compile('|'.join('(?:{})'.format(r) for r in regexs))
+
+
+class EntityFilter(object):
+    """Include / exclude filters per domain and attribute projection.
+
+    Patterns are compiled once, and the decisions for each entity_id are
+    memoized, so the per-update cost is a couple of dict lookups."""
+
+    def __init__(self, filters=None, attributes=None):
+        self._filters = {}
+        for domain, conf_domain in (filters or {}).items():
+            conf_domain = conf_domain or {}
+            self._filters[domain] = (
+                _compile_patterns(conf_domain.get('include')),
+                _compile_patterns(conf_domain.get('exclude')))
+        self._attributes = []
+        for pattern, allowed in (attributes or {}).items():
+            if isinstance(allowed, str):
+                allowed = allowed.split(',')
+            self._attributes.append((_compile_patterns([pattern]),
+                                     tuple(a.strip() for a in allowed)))
+        self._accepted = {}
+        self._projections = {}
+
+    def accept(self, entity_id):
+        """Return True if the entity has to be replicated."""
+        try:
+            return self._accepted[entity_id]
+        except KeyError:
+            pass
+        ok = True
+        include, exclude = self._filters.get(
+            entity_id.split('.')[0], (None, None))
+        if include is not None and not include.match(entity_id):
+            ok = False
+        elif exclude is not None and exclude.match(entity_id):
+            ok = False
+        self._accepted[entity_id] = ok
+        return ok
+
+    def project(self, entity_id, attributes):
+        """Reduce the attributes of an entity to its allow-list, if any."""
+        try:
+            allowed = self._projections[entity_id]
+        except KeyError:
+            allowed = next((attrs for regex, attrs in self._attributes
+                            if regex.match(entity_id)), None)
+            self._projections[entity_id] = allowed
+        if allowed is None or attributes is None:
+            return attributes
+        return {k: attributes[k] for k in allowed if k in attributes}
 
 
 # noinspection PyClassHasNoInit
@@ -43,12 +128,10 @@ class SlavePublisher(appapi.AppDaemon):
 
     _sufix = None
     _sensor_updates = None
+    _filter = None
+    _payload_stats = None
 
     _raw_sensors = None
-    _raw_sensors_sufix = None
-    _raw_sensors_seconds_to_off = None
-    _raw_sensors_last_states = {}
-    _raw_sensors_attributes = {}
 
     def initialize(self):
         """AppDaemon required method for app init."""
@@ -60,95 +143,86 @@ class SlavePublisher(appapi.AppDaemon):
         self._master_ha_api = remote.API(
             self._hass_master_url, self._hass_master_key,
             port=self._hass_master_port)
+        self._filter = EntityFilter(self.args.get('filters'),
+                                    self.args.get('attributes'))
+        # [num updates, bytes sent, bytes without attributes projection]
+        self._payload_stats = [0, 0, 0]
 
         # Raw binary sensors
-        self._raw_sensors = self.args.get('raw_binary_sensors', None)
+        self._raw_sensors = RawSensorEngine.from_args(
+            self, RemoteStateOutput(self._master_ha_api, self._sufix),
+            default_seconds_to_off=DEFAULT_RAWBS_SECS_OFF)
         if self._raw_sensors is not None:
-            self._raw_sensors = self._raw_sensors.split(',')
-            self._raw_sensors_sufix = self.args.get('raw_binary_sensors_sufijo', '_raw')
-            # Persistencia en segundos de último valor hasta considerarlos 'off'
-            self._raw_sensors_seconds_to_off = int(self.args.get('raw_binary_sensors_time_off', DEFAULT_RAWBS_SECS_OFF))
-
-            # Handlers de cambio en raw binary_sensors:
-            l1, l2 = 'attributes', 'last_changed'
-            for s in self._raw_sensors:
-                self._raw_sensors_attributes[s] = (s.replace(self._raw_sensors_sufix, ''), self.get_state(s, l1))
-                self._raw_sensors_last_states[s] = [parse(self.get_state(s, l2)).replace(tzinfo=None), False]
-                self.listen_state(self._turn_on_raw_sensor_on_change, s)
-            self.log('seconds_to_off: {}'.format(self._raw_sensors_seconds_to_off))
-            self.log('attributes_sensors: {}'.format(self._raw_sensors_attributes))
-            self.log('last_changes: {}'.format(self._raw_sensors_last_states))
-            # [self.set_state(dev, state='off', attributes=attrs) for dev, attrs in .._raw_sensors_attributes.values()]
-            [remote.set_state(self._master_ha_api, dev + self._sufix, 'off', attributes=attrs)
-             for dev, attrs in self._raw_sensors_attributes.values()]
-            next_run = self.datetime() + dt.timedelta(seconds=self._raw_sensors_seconds_to_off)
-            self.run_every(self._turn_off_raw_sensor_if_not_updated, next_run, self._raw_sensors_seconds_to_off)
+            self.log('raw_sensors: {}'.format(self._raw_sensors))
+            self._raw_sensors.publish_all_off()
 
         # Publish slave states in master
-        bs_states = self.get_state('binary_sensor')
-        if self._raw_sensors is not None:
-            [bs_states.pop(raw) for raw in self._raw_sensors]
-
-        s_states = self.get_state('sensor')
-        sensors = dict(**s_states)
-        sensors.update(bs_states)
         now = self.datetime()
         sensor_updates = {}
-        for entity_id, state_atts in sensors.items():
-            self.log('SENSOR: {}, ATTRS={}'.format(entity_id, state_atts))
-            remote.set_state(self._master_ha_api, entity_id + self._sufix,
-                             state_atts['state'],
-                             attributes=state_atts['attributes'])
-            self.listen_state(self._ch_state, entity_id,
-                              attributes=state_atts['attributes'])
+        for entity_id, state_atts in self._replicated_states().items():
+            attributes = self._filter.project(
+                entity_id, state_atts['attributes'])
+            self.log('SENSOR: {}, ATTRS={}'.format(entity_id, attributes))
+            self._publish(entity_id + self._sufix, state_atts['state'],
+                          state_atts['attributes'], attributes)
+            self.listen_state(self._ch_state, entity_id)
             sensor_updates.update({entity_id + self._sufix: now})
         self._sensor_updates = sensor_updates
         self.run_minutely(self._update_states, None)
         self.log('Transfer states from slave to master in {} COMPLETE'
                  .format(self._master_ha_api))
 
+    def _replicated_states(self):
+        """Sensors & binary_sensors which pass the entity filters."""
+        sensors = {}
+        for domain in REPLICATED_DOMAINS:
+            sensors.update(self.get_state(domain))
+        if self._raw_sensors is not None:
+            [sensors.pop(raw, None) for raw in self._raw_sensors.raw_sensors]
+        return {entity_id: state_atts
+                for entity_id, state_atts in sensors.items()
+                if self._filter.accept(entity_id)}
+
+    def _publish(self, entity_id, state, attributes, projected=None):
+        """Set the state in master, accounting the payload size."""
+        if projected is None:
+            projected = attributes
+        size = len(json.dumps({'state': state, 'attributes': projected}))
+        stats = self._payload_stats
+        stats[0] += 1
+        stats[1] += size
+        if projected is attributes:
+            stats[2] += size
+        else:
+            stats[2] += len(json.dumps({'state': state,
+                                        'attributes': attributes}))
+        remote.set_state(self._master_ha_api, entity_id, state,
+                         attributes=projected)
+
     # noinspection PyUnusedLocal
     def _update_states(self, kwargs):
         """Update states in master if they are not changed."""
         now = self.datetime()
-        s_states = self.get_state('sensor')
-        bs_states = self.get_state('binary_sensor')
-        sensors = dict(**s_states)
-        sensors.update(bs_states)
-        for entity_id, state_atts in sensors.items():
+        for entity_id, state_atts in self._replicated_states().items():
             key = entity_id + self._sufix
             if key not in self._sensor_updates \
                     or (now - self._sensor_updates[key]).total_seconds() > 60:
-                remote.set_state(
-                    self._master_ha_api, key, state_atts['state'],
-                    attributes=state_atts['attributes'])
+                self._publish(
+                    key, state_atts['state'], state_atts['attributes'],
+                    self._filter.project(entity_id, state_atts['attributes']))
                 self._sensor_updates[key] = now
+        num_updates, bytes_sent, bytes_full = self._payload_stats
+        if num_updates:
+            self.log('PAYLOAD: {} updates, {:.1f} bytes/update '
+                     '({:.1f} bytes/update without filtering)'
+                     .format(num_updates, bytes_sent / num_updates,
+                             bytes_full / num_updates), 'DEBUG')
 
     # noinspection PyUnusedLocal
     def _ch_state(self, entity, attribute, old, new, kwargs):
-        remote.set_state(
-            self._master_ha_api, entity + self._sufix, new, **kwargs)
+        # (current attributes, not a snapshot of the init)
+        attributes = (self.get_state(entity, attribute='all')
+                      or {}).get('attributes')
+        self._publish(entity + self._sufix, new, attributes,
+                      self._filter.project(entity, attributes))
         self._sensor_updates[entity + self._sufix] = self.datetime()
-
-    # noinspection PyUnusedLocal
-    def _turn_on_raw_sensor_on_change(self, entity, attribute,
-                                      old, new, kwargs):
-        _, last_st = self._raw_sensors_last_states[entity]
-        self._raw_sensors_last_states[entity] = [self.datetime(), True]
-        if not last_st:
-            name, attrs = self._raw_sensors_attributes[entity]
-            remote.set_state(
-                self._master_ha_api, name + self._sufix, 'on',
-                attributes=attrs)
-
-    # noinspection PyUnusedLocal
-    def _turn_off_raw_sensor_if_not_updated(self, *kwargs):
-        now = self.datetime()
-        for s, (ts, st) in self._raw_sensors_last_states.copy().items():
-            if st and ceil((now - ts).total_seconds()
-                           ) >= self._raw_sensors_seconds_to_off:
-                name, attrs = self._raw_sensors_attributes[s]
-                self._raw_sensors_last_states[s] = [now, False]
-                remote.set_state(
-                    self._master_ha_api, name + self._sufix, 'off',
-                    attributes=attrs)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Shared engine for 'raw' -> 'derived' binary sensors.
+
+The derived binary sensors are ON when the raw sensor has changed in the
+last X seconds, OFF if the last change is older, and are named removing a
+suffix from the raw entity id:
+
+    "binary_sensor.my_sensor_raw" + sufijo "_raw" ---> "binary_sensor.my_sensor"
+
+The state of each raw sensor lives in the engine instance (`__slots__`
+records), the raw changes pass through a `DebounceFilter`, the turn-off is
+scheduled with an `ExpiryTimer`, and the derived states are published with
+a pluggable output (local `set_state` or a remote (master) HA instance).
+
+The activity of each raw sensor (events in the last 10 s, 1 min and 5 min,
+and the peak in 10 s) is counted with sliding windows and exposed as
+attributes of the derived sensor (`events_10s`, `events_1min`,
+`events_5min`, `peak_events_10s`), refreshed while it is ON every
+`raw_binary_sensors_publish_interval` seconds.
+
+App config (common to all apps using the engine):
+
+```yaml
+  raw_binary_sensors: binary_sensor.vibration_sensor_raw,binary_sensor.sound_sensor_raw
+  raw_binary_sensors_sufijo: _raw
+  raw_binary_sensors_time_off: 2
+  # raw_binary_sensors_min_on: 5
+  # raw_binary_sensors_min_off: 1
+  # raw_binary_sensors_max_rate: 2
+  # raw_binary_sensors_publish_interval: 10
+```
+
+Benchmark, with a replay file (lines of `timestamp,raw_entity_id`) or
+with thousands of virtual raw sensors:
+
+```
+    python raw_sensors.py [replay.csv] --sensors 5000 --events 500000
+```
+
+"""
+import argparse
+import random
+from threading import Lock
+from time import time
+
+from debounce import DebounceFilter, EVENT_ON
+from deadline_scheduler import ExpiryTimer
+from sliding_window import ActivityCounters
+
+
+DEFAULT_SUFFIX = '_raw'
+DEFAULT_RAWBS_SECS_OFF = 10
+DEFAULT_PUBLISH_INTERVAL = 10
+
+
+class _RawSensor(object):
+    """Derived sensor of a raw binary sensor."""
+
+    __slots__ = ('name', 'attributes', 'activity', 'last_publish')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.activity = ActivityCounters()
+        self.last_publish = 0.
+
+
+class LocalStateOutput(object):
+    """Publish the derived states in the local HA instance."""
+
+    def __init__(self, app):
+        self._app = app
+
+    def __call__(self, name, state, attributes):
+        self._app.set_state(name, state=state, attributes=attributes)
+
+
+class RemoteStateOutput(object):
+    """Publish the derived states in a remote (master) HA instance."""
+
+    def __init__(self, api, suffix=''):
+        import homeassistant.remote as remote
+
+        self._set_state = remote.set_state
+        self._api = api
+        self._suffix = suffix
+
+    def __call__(self, name, state, attributes):
+        self._set_state(self._api, name + self._suffix, state,
+                        attributes=attributes)
+
+
+class RawSensorEngine(object):
+    """Raw -> derived binary sensors state machine."""
+
+    def __init__(self, app, output, seconds_to_off,
+                 suffix=DEFAULT_SUFFIX, min_on=0, min_off=0, max_rate=None,
+                 publish_interval=DEFAULT_PUBLISH_INTERVAL,
+                 logger=None, clock=time):
+        self.seconds_to_off = seconds_to_off
+        self.suffix = suffix
+        self.publish_interval = publish_interval
+        self._output = output
+        self._logger = logger
+        self._clock = clock
+        self._sensors = {}
+        self._lock = Lock()
+        self._filter = DebounceFilter(min_on=min_on, min_off=min_off,
+                                      max_rate=max_rate, clock=clock)
+        self._expiry = ExpiryTimer(app, self._turn_off, clock=clock)
+
+    @classmethod
+    def from_args(cls, app, output,
+                  default_seconds_to_off=DEFAULT_RAWBS_SECS_OFF, **kwargs):
+        """Make the engine from the app args, or None if not configured."""
+        raw_sensors = app.args.get('raw_binary_sensors', None)
+        if raw_sensors is None:
+            return None
+        # Persistencia en segundos de último valor hasta considerarlos 'off'
+        seconds_to_off = int(app.args.get('raw_binary_sensors_time_off',
+                                          default_seconds_to_off))
+        engine = cls(
+            app, output, seconds_to_off,
+            suffix=app.args.get('raw_binary_sensors_sufijo', DEFAULT_SUFFIX),
+            min_on=app.args.get('raw_binary_sensors_min_on', 0),
+            min_off=app.args.get('raw_binary_sensors_min_off', 0),
+            max_rate=app.args.get('raw_binary_sensors_max_rate', None),
+            publish_interval=float(app.args.get(
+                'raw_binary_sensors_publish_interval',
+                DEFAULT_PUBLISH_INTERVAL)),
+            **kwargs)
+        # Handlers de cambio en raw binary_sensors:
+        for s in raw_sensors.split(','):
+            engine.add(s, app.get_state(s, 'attributes'))
+            app.listen_state(engine.state_change, s)
+        return engine
+
+    def __contains__(self, entity):
+        return entity in self._sensors
+
+    def __len__(self):
+        return len(self._sensors)
+
+    @property
+    def raw_sensors(self):
+        """Entity ids of the raw sensors."""
+        return list(self._sensors.keys())
+
+    def add(self, entity, attributes=None, name=None):
+        """Register a raw sensor."""
+        if name is None:
+            name = entity.replace(self.suffix, '')
+        self._sensors[entity] = _RawSensor(name, attributes or {})
+        self._filter.add(entity)
+
+    def publish_all_off(self):
+        """Set all derived sensors to 'off'."""
+        for s in self._sensors.values():
+            self._output(s.name, 'off', s.attributes)
+
+    def _attributes(self, entity, sensor, now):
+        attrs = self._filter.attributes(entity, sensor.attributes)
+        attrs.update(sensor.activity.attributes(now))
+        sensor.last_publish = now
+        return attrs
+
+    def activity(self, entity, now=None):
+        """Number of raw events of a sensor for each window (s)."""
+        return self._sensors[entity].activity.counts(
+            self._clock() if now is None else now)
+
+    def on_change(self, entity):
+        """Process a raw change (turns on the derived sensor if needed)."""
+        now = self._clock()
+        sensor = self._sensors[entity]
+        with self._lock:
+            sensor.activity.add(now)
+            event = self._filter.event(entity, now)
+            if event is None:  # debounced
+                return None
+            self._expiry.set(entity, self._filter.deadline(
+                entity, self.seconds_to_off))
+            publish = (event == EVENT_ON
+                       or now - sensor.last_publish >= self.publish_interval)
+            if publish:
+                attrs = self._attributes(entity, sensor, now)
+        if publish:
+            self._output(sensor.name, 'on', attrs)
+            if event == EVENT_ON and self._logger is not None:
+                self._logger('TURN ON "{}" --> {}'.format(entity, sensor.name))
+        return event
+
+    # noinspection PyUnusedLocal
+    def state_change(self, entity, attribute, old, new, kwargs):
+        """AppDaemon `listen_state` callback."""
+        self.on_change(entity)
+
+    def _turn_off(self, entity):
+        with self._lock:
+            self._filter.turn_off(entity)
+            sensor = self._sensors[entity]
+            attrs = self._attributes(entity, sensor, self._clock())
+        self._output(sensor.name, 'off', attrs)
+        if self._logger is not None:
+            self._logger('TURN OFF "{}" --> {}'.format(entity, sensor.name))
+
+    def cancel(self):
+        """Cancel the scheduled turn-offs."""
+        self._expiry.cancel_all()
+
+    def __repr__(self):
+        return ('<RawSensorEngine: {} sensors, seconds_to_off={}, min_on={}, '
+                'min_off={}, max_rate={}>'
+                .format(len(self), self.seconds_to_off, self._filter.min_on,
+                        self._filter.min_off, self._filter.max_rate))
+
+
+# ------------------------------------------------------
+# Benchmark harness (replay of raw changes, without AppDaemon)
+# ------------------------------------------------------
+class VirtualScheduler(object):
+    """Minimal AppDaemon-like scheduler (`run_in`, `cancel_timer`)
+    running on a virtual clock."""
+
+    def __init__(self, now=0.):
+        self.now = now
+        self.num_timers = 0
+        self._timers = {}
+
+    def clock(self):
+        """Virtual time (s)."""
+        return self.now
+
+    def run_in(self, callback, seconds, **kwargs):
+        """Schedule a callback in the virtual time."""
+        self.num_timers += 1
+        self._timers[self.num_timers] = (self.now + seconds, callback, kwargs)
+        return self.num_timers
+
+    def cancel_timer(self, handle):
+        """Cancel a scheduled callback."""
+        self._timers.pop(handle, None)
+
+    def advance(self, now):
+        """Move the virtual clock, running the due callbacks."""
+        while self._timers:
+            handle, (when, callback, kwargs) = min(
+                self._timers.items(), key=lambda x: x[1][0])
+            if when > now:
+                break
+            del self._timers[handle]
+            self.now = max(self.now, when)
+            callback(kwargs)
+        self.now = now
+
+
+class CountingOutput(object):
+    """Output which only counts the published states."""
+
+    def __init__(self):
+        self.num_on = self.num_off = 0
+
+    def __call__(self, name, state, attributes):
+        if state == 'on':
+            self.num_on += 1
+        else:
+            self.num_off += 1
+
+
+def generate_replay(path, num_sensors=1000, num_events=100000,
+                    mean_interval=.01, prefix='binary_sensor.virtual_{}_raw'):
+    """Write a synthetic replay file with bursts of raw changes."""
+    rnd = random.Random(42)
+    sensors = [prefix.format(i) for i in range(num_sensors)]
+    ts = 0.
+    with open(path, 'w') as f:
+        for _ in range(num_events):
+            ts += rnd.expovariate(1. / mean_interval)
+            f.write('{:.4f},{}\n'.format(ts, rnd.choice(sensors)))
+
+
+def read_replay(path):
+    """Read a replay file: lines of `timestamp,raw_entity_id`."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                ts, entity = line.split(',')[:2]
+                events.append((float(ts), entity.strip()))
+    return events
+
+
+def benchmark(events, seconds_to_off=2, **kwargs_engine):
+    """Replay raw changes through an engine, returning some stats."""
+    scheduler = VirtualScheduler(events[0][0] if events else 0.)
+    output = CountingOutput()
+    engine = RawSensorEngine(scheduler, output, seconds_to_off,
+                             clock=scheduler.clock, **kwargs_engine)
+    for entity in set(e for _, e in events):
+        engine.add(entity)
+    tic = time()
+    for ts, entity in events:
+        scheduler.advance(ts)
+        engine.on_change(entity)
+    if events:
+        scheduler.advance(events[-1][0] + seconds_to_off
+                          + kwargs_engine.get('min_on', 0) + 1)
+    took = time() - tic
+    return dict(sensors=len(engine), events=len(events), took=took,
+                events_per_sec=len(events) / took if took else None,
+                num_on=output.num_on, num_off=output.num_off,
+                timers=scheduler.num_timers)
+
+
+def main():
+    """CLI for the benchmark harness."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('replay', nargs='?', help='replay file (ts,entity_id)')
+    parser.add_argument('--sensors', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--min-on', type=float, default=0)
+    parser.add_argument('--min-off', type=float, default=0)
+    parser.add_argument('--max-rate', type=float, default=None)
+    args = parser.parse_args()
+    path = args.replay
+    if path is None:
+        path = 'raw_sensors_replay.csv'
+        generate_replay(path, args.sensors, args.events)
+    results = benchmark(read_replay(path), args.timeout, min_on=args.min_on,
+                        min_off=args.min_off, max_rate=args.max_rate)
+    print('{sensors} sensors, {events} events in {took:.3f} s '
+          '({events_per_sec:.0f} events/s): {num_on} ON, {num_off} OFF, '
+          '{timers} timers'.format(**results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: event-driven model of the lights of a room.
+
+The model keeps the state of the motion-controlled lights and of the other
+lights of the room, with the counts of lights ON, so the decisions of a
+motion-lights automation ("are all the lights off?") are O(1), without
+reading any state. It is fed by the `listen_state` callbacks of the lights,
+and a (infrequent) consistency check compares it with a fresh read:
+
+```
+    self._room = RoomLightModel(lights_motion, lights_check_off)
+    self._room.reset({l: self.get_state(l) for l in self._room.lights})
+    for light in self._room.lights:
+        self.listen_state(self._light_state, light)
+    ...
+    self._room.update(entity, new)  # in the light state callback
+    ...
+    if self._room.lights_are_off(include_motion_lights=True):
+        ...
+```
+
+`OccupancyTimeout` adapts the off timeout of the motion lights to the
+density of recent PIR activity (a sliding-window counter): a busy room
+keeps the lights on longer, a single pass shortens it:
+
+```
+    self._occupancy = OccupancyTimeout(base_timeout, window=600)
+    self._occupancy.add(now)  # on each PIR trigger
+    deadline = now + self._occupancy.timeout(now)  # on PIR off
+```
+
+Benchmark of the PIR -> light command latency (p50/p99) of the
+`MotionLights` app and of its old turn ON decision (reading the states of
+the lights on each PIR trigger), over a stub AppDaemon API with latency in
+`get_state` and `call_service`, in a pool of worker threads (like the
+AppDaemon one) loaded with callbacks of other apps:
+
+```
+    python room_lights.py --events 1000 --load .5 --state-ms 1 --service-ms 5
+```
+
+"""
+import argparse
+import datetime as dt
+from queue import Queue
+import random
+from threading import local, Thread
+from time import perf_counter, sleep
+
+from power_stats import QuantileSketch
+from sliding_window import SlidingWindowCounter
+
+
+DEFAULT_OCCUPANCY_WINDOW = 600  # secs
+DEFAULT_OCCUPANCY_EVENTS = 4  # PIR triggers in the window for the base timeout
+MIN_TIMEOUT_FACTOR = .5
+MAX_TIMEOUT_FACTOR = 3.
+
+
+def _motion_light_on(state):
+    return state == 'on'
+
+
+def _other_light_on(state):
+    # Other lights are 'off' when off or not available (None)
+    return state not in ('off', None)
+
+
+class RoomLightModel(object):
+    """States & counts of lights ON of the motion lights and other lights."""
+
+    __slots__ = ('motion_lights', 'other_lights', '_states', '_is_motion',
+                 'num_motion_on', 'num_others_on')
+
+    def __init__(self, motion_lights, other_lights=()):
+        self.motion_lights = list(motion_lights)
+        self.other_lights = [l for l in other_lights
+                             if l not in self.motion_lights]
+        self._is_motion = {l: True for l in self.motion_lights}
+        self._is_motion.update({l: False for l in self.other_lights})
+        self._states = {l: None for l in self._is_motion}
+        self.num_motion_on = self.num_others_on = 0
+
+    @property
+    def lights(self):
+        """All the lights of the room."""
+        return self.motion_lights + self.other_lights
+
+    def __contains__(self, entity):
+        return entity in self._is_motion
+
+    def is_motion_light(self, entity):
+        """True for a motion-controlled light."""
+        return self._is_motion[entity]
+
+    def state(self, entity):
+        """Last known state of a light."""
+        return self._states[entity]
+
+    def reset(self, states):
+        """Set all the states (`{entity: state}`), recomputing the counts."""
+        self._states.update({l: states.get(l) for l in self._is_motion})
+        self.num_motion_on = sum(_motion_light_on(self._states[l])
+                                 for l in self.motion_lights)
+        self.num_others_on = sum(_other_light_on(self._states[l])
+                                 for l in self.other_lights)
+
+    def update(self, entity, state):
+        """New state of a light. Returns True if its ON/OFF changed."""
+        old = self._states[entity]
+        self._states[entity] = state
+        if self._is_motion[entity]:
+            was_on, is_on = _motion_light_on(old), _motion_light_on(state)
+            if was_on != is_on:
+                self.num_motion_on += 1 if is_on else -1
+                return True
+        else:
+            was_on, is_on = _other_light_on(old), _other_light_on(state)
+            if was_on != is_on:
+                self.num_others_on += 1 if is_on else -1
+                return True
+        return False
+
+    @property
+    def all_motion_on(self):
+        """True if all the motion lights are ON."""
+        return self.num_motion_on == len(self.motion_lights)
+
+    def lights_are_off(self, include_motion_lights=True):
+        """True if the other lights (and the motion lights) are OFF."""
+        if include_motion_lights:
+            return not self.num_others_on and not self.num_motion_on
+        return not self.num_others_on
+
+    def others_on(self):
+        """Other lights which are ON (for logging)."""
+        return [l for l in self.other_lights
+                if _other_light_on(self._states[l])]
+
+    def check(self, states):
+        """Compare with fresh `states`, fixing the model.
+
+        Returns the list of (entity, known state, real state) mismatches."""
+        mismatches = [(l, self._states[l], states.get(l))
+                      for l in self._is_motion
+                      if self._states[l] != states.get(l)]
+        if mismatches:
+            self.reset(states)
+        return mismatches
+
+    def __repr__(self):
+        return '<RoomLightModel: {}/{} motion lights ON, {}/{} others ON>' \
+            .format(self.num_motion_on, len(self.motion_lights),
+                    self.num_others_on, len(self.other_lights))
+
+
+class OccupancyTimeout(object):
+    """Off timeout from the PIR activity density in a sliding window.
+
+    The timeout is `base` with `ref_events` triggers in the window, and it
+    scales with the number of triggers, between `min_factor * base` and
+    `max_factor * base`. All the operations are O(1)."""
+
+    __slots__ = ('base', 'ref_events', 'min_factor', 'max_factor', '_counter')
+
+    def __init__(self, base, window=DEFAULT_OCCUPANCY_WINDOW,
+                 ref_events=DEFAULT_OCCUPANCY_EVENTS,
+                 min_factor=MIN_TIMEOUT_FACTOR, max_factor=MAX_TIMEOUT_FACTOR):
+        self.base = base
+        self.ref_events = ref_events
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self._counter = SlidingWindowCounter(window)
+
+    def add(self, now):
+        """Register a PIR trigger."""
+        return self._counter.add(now)
+
+    def count(self, now):
+        """PIR triggers in the window."""
+        return self._counter.count(now)
+
+    def timeout(self, now):
+        """Current off timeout (s)."""
+        factor = self._counter.count(now) / float(self.ref_events)
+        factor = min(self.max_factor, max(self.min_factor, factor))
+        return int(round(self.base * factor))
+
+    def __repr__(self):
+        return '<OccupancyTimeout: base={} s, window={} s>'.format(
+            self.base, self._counter.window)
+
+
+class _StubApp(object):
+    """AppDaemon API for the benchmark apps: states in a dict, with a fixed
+    latency of `get_state` & `call_service`, and the latency (ms) from the
+    PIR event to the light command in `latencies`."""
+
+    current = local()  # (timestamp of the PIR event in process)
+
+    def __init__(self, name, args, states, latencies, state_ms, service_ms):
+        self.name = name
+        self.args = args
+        self.config = {'AppDaemon': {}}
+        self._states = states
+        self._latencies = latencies
+        self._state_secs = state_ms / 1000.
+        self._service_secs = service_ms / 1000.
+
+    def get_state(self, entity, attribute=None):
+        """State (or `last_changed`) of an entity, with latency."""
+        sleep(self._state_secs)
+        if attribute == 'last_changed':
+            return dt.datetime.now(dt.timezone.utc).isoformat()
+        return self._states.get(entity)
+
+    def call_service(self, service, **kwargs):
+        """Service call, with latency."""
+        if service == 'light/turn_on':
+            self._latencies.add(
+                1000. * (perf_counter() - self.current.ts_event))
+        sleep(self._service_secs)
+
+    def log(self, *args, **kwargs):
+        """No logging."""
+        pass
+
+    def listen_state(self, *args, **kwargs):
+        """Callbacks are run by the benchmark."""
+        pass
+
+    run_minutely = listen_state
+
+    def run_in(self, *args, **kwargs):
+        """Timers are not run by the benchmark."""
+        return object()
+
+    def cancel_timer(self, handle):
+        """Timers are not run by the benchmark."""
+        pass
+
+
+class _LegacyMotionLights(_StubApp):
+    """Turn ON decision of `MotionLights` before the room model (reading
+    the states of the other lights on each PIR trigger), for reference."""
+
+    def __init__(self, *args):
+        super(_LegacyMotionLights, self).__init__(*args)
+        self._pir = self.args['pir']
+        self._lights_motion = self.args['lights_motion']
+        self._lights_check_off = self.args['lights_check_off'].split(',')
+        self._lights_motion_active = {
+            l: False for l in self._lights_motion.split(',')}
+        self._motion_lights_running = False
+        self._extra_condition = self.get_state(
+            self.args['constrain_input_boolean_2']) == 'off'
+        self._media_player_active = False
+
+    def _lights_are_off(self, include_motion_lights=True):
+        other_lights_are_off = ((self._lights_check_off is None)
+                                or all([(self.get_state(l) == 'off')
+                                        or (self.get_state(l) is None)
+                                        for l in self._lights_check_off]))
+        if include_motion_lights:
+            return other_lights_are_off and not any(
+                self._lights_motion_active.values())
+        return other_lights_are_off
+
+    def motion_cycle(self):
+        """PIR on (turn ON), and turn OFF after the timeout."""
+        if (not self._motion_lights_running and
+                self._lights_are_off(include_motion_lights=True) and
+                self._extra_condition and not self._media_player_active):
+            self._motion_lights_running = True
+            self.log('TURN_ON MOTION_LIGHTS ({}), with timeout: {} sec. '
+                     'lights_motion: {}'
+                     .format(self._lights_motion, 120,
+                             self._lights_motion_active.values()))
+            self.call_service("light/turn_on", entity_id=self._lights_motion,
+                              color_temp=300, brightness=200, transition=0)
+        if self._motion_lights_running and \
+                self._extra_condition and not self._media_player_active:
+            if self._lights_are_off(include_motion_lights=False):
+                self.call_service("light/turn_off",
+                                  entity_id=self._lights_motion, transition=1)
+            self._motion_lights_running = False
+
+
+def _motion_lights_app(*args):
+    """`MotionLights` app over the benchmark stub API."""
+    # (app module, needs AppDaemon)
+    from motion_lights import MotionLights
+
+    class _BenchMotionLights(_StubApp, MotionLights):
+        def motion_cycle(self):
+            """PIR on (turn ON) & off, and the motion lights turned ON & OFF
+            (fed back to the room model)."""
+            for state in ('on', 'off'):
+                self._state_change(self.args['pir'], 'state', None, state, {})
+            for state in ('on', 'off'):
+                for light in self.args['lights_motion'].split(','):
+                    self._state_change(light, 'state', None, state, {})
+
+    app = _BenchMotionLights(*args)
+    app.initialize()
+    return app
+
+
+def benchmark(num_events=1000, interval=.005, num_workers=10, load=.5,
+              load_ms=2., state_ms=1., service_ms=5., num_rooms=20,
+              legacy=False, seed=42):
+    """PIR events of `num_rooms` `MotionLights` apps (or the `legacy` turn
+    ON decision), over a stub API with `state_ms` latency of `get_state`
+    and `service_ms` of `call_service`, in a loaded worker pool.
+
+    `load` is the fraction of time the workers spend in callbacks of
+    other apps (CPU bound, of `load_ms` each). Returns the latencies (ms)
+    from the PIR event to the light command."""
+    rnd = random.Random(seed)
+    latencies = QuantileSketch(.01)
+    apps = []
+    for i in range(num_rooms):
+        args = dict(pir='binary_sensor.pir_{}'.format(i),
+                    motion_light_timeout=120,
+                    lights_motion=','.join('light.motion_{}_{}'.format(i, j)
+                                           for j in range(3)),
+                    lights_check_off=','.join('light.other_{}_{}'.format(i, j)
+                                              for j in range(4)),
+                    constrain_input_boolean_2='input_boolean.alarm')
+        states = {'input_boolean.alarm': 'off'}
+        states.update({l: 'off' for l in
+                       (args['lights_motion'] + ',' +
+                        args['lights_check_off']).split(',')})
+        factory = _LegacyMotionLights if legacy else _motion_lights_app
+        apps.append(factory('room_{}'.format(i), args, states, latencies,
+                            state_ms, service_ms))
+    queue = Queue()
+
+    def _other_app_callback(ms):
+        end = perf_counter() + ms / 1000.
+        while perf_counter() < end:
+            pass
+
+    def _pir_callback(item):
+        app, ts_event = item
+        _StubApp.current.ts_event = ts_event
+        app.motion_cycle()
+
+    def _worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            item[0](item[1])
+
+    workers = [Thread(target=_worker, daemon=True)
+               for _ in range(num_workers)]
+    for th in workers:
+        th.start()
+    load_per_event = load * interval * 1000. / load_ms
+    for k in range(num_events):
+        num_load = int(load_per_event) + (
+            rnd.random() < load_per_event - int(load_per_event))
+        for _ in range(num_load):
+            queue.put((_other_app_callback, load_ms))
+        queue.put((_pir_callback, (apps[k % num_rooms], perf_counter())))
+        sleep(rnd.expovariate(1. / interval))
+    for _ in workers:
+        queue.put(None)
+    for th in workers:
+        th.join()
+    return dict(path='legacy' if legacy else 'MotionLights',
+                events=num_events, commands=latencies.count, load=load,
+                workers=num_workers, p50=latencies.quantile(.5),
+                p90=latencies.quantile(.9), p99=latencies.quantile(.99))
+
+
+def main():
+    """CLI for the latency benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--load', type=float, default=.5)
+    parser.add_argument('--load-ms', type=float, default=2.)
+    parser.add_argument('--state-ms', type=float, default=1.,
+                        help='latency of get_state')
+    parser.add_argument('--service-ms', type=float, default=5.,
+                        help='latency of call_service')
+    parser.add_argument('--rooms', type=int, default=20)
+    args = parser.parse_args()
+    for load in sorted(set([0., args.load])):
+        for legacy in (True, False):
+            results = benchmark(args.events, num_workers=args.workers,
+                                load=load, load_ms=args.load_ms,
+                                state_ms=args.state_ms,
+                                service_ms=args.service_ms,
+                                num_rooms=args.rooms, legacy=legacy)
+            print('{path:>12}: {events} PIR events ({commands} light '
+                  'commands), {workers} workers, load={load:.0%}: '
+                  'p50={p50:.3f} ms, p90={p90:.3f} ms, p99={p99:.3f} ms'
+                  .format(**results))
+
+
+if __name__ == '__main__':
+    main()
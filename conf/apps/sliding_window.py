@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: sliding-window event counters.
+
+Each counter is a ring of time buckets (no timestamps stored), so `add` and
+`count` are O(1) (amortized over the elapsed buckets, with a maximum of
+`num_buckets` per call). The window covered is between
+`window * (num_buckets - 1) / num_buckets` and `window` seconds.
+
+"""
+from time import time
+
+
+DEFAULT_WINDOWS = (10, 60, 300)
+DEFAULT_NUM_BUCKETS = 10
+
+
+class SlidingWindowCounter(object):
+    """Number of events in the last `window` seconds, with ring buckets."""
+
+    __slots__ = ('window', '_width', '_buckets', '_head', '_total')
+
+    def __init__(self, window, num_buckets=DEFAULT_NUM_BUCKETS):
+        self.window = window
+        self._width = float(window) / num_buckets
+        self._buckets = [0] * num_buckets
+        self._head = None
+        self._total = 0
+
+    def _advance(self, now):
+        idx = int(now // self._width)
+        if self._head is None or idx - self._head >= len(self._buckets):
+            self._buckets = [0] * len(self._buckets)
+            self._total = 0
+        elif idx > self._head:
+            buckets, num_buckets = self._buckets, len(self._buckets)
+            for i in range(self._head + 1, idx + 1):
+                pos = i % num_buckets
+                self._total -= buckets[pos]
+                buckets[pos] = 0
+        else:
+            return self._head
+        self._head = idx
+        return idx
+
+    def add(self, now, n=1):
+        """Add `n` events at time `now` (s)."""
+        idx = self._advance(now)
+        self._buckets[idx % len(self._buckets)] += n
+        self._total += n
+        return self._total
+
+    def count(self, now):
+        """Number of events in the window ending at `now`."""
+        self._advance(now)
+        return self._total
+
+    def rate(self, now):
+        """Mean rate of events (events/s) in the window."""
+        return self.count(now) / self.window
+
+
+class ActivityCounters(object):
+    """Event counters for multiple windows, plus the peak in the shortest."""
+
+    __slots__ = ('_counters', 'peak')
+
+    def __init__(self, windows=DEFAULT_WINDOWS, num_buckets=DEFAULT_NUM_BUCKETS):
+        self._counters = [SlidingWindowCounter(w, num_buckets)
+                          for w in sorted(windows)]
+        self.peak = 0
+
+    @staticmethod
+    def _label(window):
+        if window % 60 == 0:
+            return 'events_{}min'.format(window // 60)
+        return 'events_{}s'.format(window)
+
+    def add(self, now=None, n=1):
+        """Register `n` events."""
+        if now is None:
+            now = time()
+        counters = self._counters
+        count_min = counters[0].add(now, n)
+        for c in counters[1:]:
+            c.add(now, n)
+        if count_min > self.peak:
+            self.peak = count_min
+
+    def counts(self, now=None):
+        """Dict of window (s) -> number of events."""
+        if now is None:
+            now = time()
+        return {c.window: c.count(now) for c in self._counters}
+
+    def attributes(self, now=None):
+        """Counters as HA attributes (`events_10s`, `events_1min`, ...)."""
+        if now is None:
+            now = time()
+        attrs = {self._label(c.window): c.count(now) for c in self._counters}
+        attrs['peak_' + self._label(self._counters[0].window)] = self.peak
+        return attrs
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: cached episode metadata from the Spreaker API.
+
+The last episode info of a show is kept in memory, with a TTL, and it is
+revalidated with conditional requests (`ETag` / `Last-Modified`), over a
+persistent HTTP session and with a strict timeout. On any network error,
+the last known episode is kept, so the readers (like the alarm clock) only
+read memory and never wait on the network:
+
+```
+    self._episodes = EpisodeCache(self._tz)
+    ...
+    self._episodes.fetch()  # in a background callback (prefetch)
+    ...
+    ok, ep_info = self._episodes.get()  # in the alarm path
+```
+
+To detect the publication of a new episode without a fixed-step polling,
+an `EpisodePoller` polls with conditional requests at intervals which
+tighten around the expected publication time and back off far from it
+(or with network errors), calling back when a new (or LIVE) episode shows up.
+
+"""
+import datetime as dt
+from dateutil.parser import parse
+from threading import Lock
+from time import time
+
+import pytz
+import requests
+
+
+BASE_URL_API_V2 = 'https://api.spreaker.com/v2/'
+CAFETERA_SHOW_ID = 1060718
+DEFAULT_TTL = 15  # secs
+DEFAULT_TIMEOUT = 5  # secs
+DEFAULT_MIN_POLL_INTERVAL = 5  # secs
+DEFAULT_MAX_POLL_INTERVAL = 600  # secs
+
+
+def episodes_url(show_id=CAFETERA_SHOW_ID, limit=1):
+    """URL of the last `limit` episodes of a show."""
+    return '{}shows/{}/episodes?limit={}'.format(
+        BASE_URL_API_V2, show_id, limit)
+
+
+def parse_episode(episode, tz):
+    """Info of an episode (item of the Spreaker API response).
+
+    Dates in UTC are converted to local (naive) datetimes."""
+    duration = None
+    published = parse(episode['published_at']).replace(
+        tzinfo=pytz.UTC).astimezone(tz).replace(tzinfo=None)
+    is_live = episode['type'] == 'LIVE'
+    if not is_live:
+        duration = dt.timedelta(seconds=episode['duration'] / 1000)
+    return {'published': published,
+            'is_live': is_live,
+            'duration': duration,
+            'episode': episode}
+
+
+def episode_key(info):
+    """Identity of an episode: (id, type), so LIVE -> RECORDED is a change."""
+    return info['episode'].get('episode_id'), info['episode'].get('type')
+
+
+class EpisodeCache(object):
+    """Last episode info of a Spreaker show, cached in memory."""
+
+    def __init__(self, tz, show_id=CAFETERA_SHOW_ID, limit=1,
+                 ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT,
+                 session=None, clock=time):
+        self.url = episodes_url(show_id, limit)
+        self.ttl = ttl
+        self.timeout = timeout
+        self._tz = tz
+        self._session = session or requests.Session()
+        self._clock = clock
+        self._lock = Lock()
+        self._info = None
+        self._etag = None
+        self._last_modified = None
+        self._ts_update = None
+        # Stats: requests, not modified (304), errors
+        self.num_requests = self.num_not_modified = self.num_errors = 0
+        self.last_error = None
+
+    @property
+    def age(self):
+        """Seconds since the last successful validation (None if never)."""
+        if self._ts_update is None:
+            return None
+        return self._clock() - self._ts_update
+
+    @property
+    def is_stale(self):
+        """True if the cached info is older than the TTL (or missing)."""
+        age = self.age
+        return age is None or age > self.ttl
+
+    def get(self):
+        """Cached episode info, without any network access.
+
+        :return: (ok, info_last_episode)
+        :rtype: tuple(bool, dict)
+        """
+        info = self._info
+        return info is not None, info
+
+    def _headers(self):
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+        return headers
+
+    def fetch(self, force=False):
+        """Revalidate the cached info if it is stale (or `force`).
+
+        Returns True if a new (different) episode has been received.
+        On any error the last known episode is kept."""
+        if not (force or self.is_stale):
+            return False
+        with self._lock:
+            self.num_requests += 1
+            try:
+                r = self._session.get(self.url, headers=self._headers(),
+                                      timeout=self.timeout)
+            except requests.RequestException as exc:
+                self.num_errors += 1
+                self.last_error = exc
+                return False
+            if r.status_code == 304:
+                self.num_not_modified += 1
+                self._ts_update = self._clock()
+                return False
+            if not r.ok:
+                self.num_errors += 1
+                self.last_error = 'HTTP {}'.format(r.status_code)
+                return False
+            try:
+                data = r.json()
+                info = parse_episode(data['response']['items'][-1], self._tz)
+            except (ValueError, KeyError, IndexError) as exc:
+                self.num_errors += 1
+                self.last_error = exc
+                return False
+            self._etag = r.headers.get('ETag')
+            self._last_modified = r.headers.get('Last-Modified')
+            self._ts_update = self._clock()
+            changed = (self._info is None
+                       or episode_key(self._info) != episode_key(info))
+            self._info = info
+            return changed
+
+    def __repr__(self):
+        return ('<EpisodeCache: {} requests ({} not modified, {} errors), '
+                'age={}>'.format(self.num_requests, self.num_not_modified,
+                                 self.num_errors, self.age))
+
+
+def poll_interval(now, expected, min_interval=DEFAULT_MIN_POLL_INTERVAL,
+                  max_interval=DEFAULT_MAX_POLL_INTERVAL, num_errors=0):
+    """Seconds to the next poll: tight around the expected publication
+    time, relaxed far from it, and with exponential backoff on errors."""
+    delta = abs((expected - now).total_seconds())
+    interval = min(max_interval, max(min_interval, delta / 4))
+    if num_errors:
+        interval = min(max_interval, interval * 2 ** min(num_errors, 6))
+    return int(interval)
+
+
+class EpisodePoller(object):
+    """Adaptive polling of an `EpisodeCache` around an expected time.
+
+    Uses the AppDaemon scheduler of `app` (one `run_in` armed at a time),
+    and calls `callback(info)` when a new episode (or a LIVE one) appears.
+    Polling stops with the new episode, or after `expected + stop_after`."""
+
+    def __init__(self, app, episodes, callback,
+                 min_interval=DEFAULT_MIN_POLL_INTERVAL,
+                 max_interval=DEFAULT_MAX_POLL_INTERVAL,
+                 stop_after=dt.timedelta(minutes=10)):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stop_after = stop_after
+        self._app = app
+        self._episodes = episodes
+        self._callback = callback
+        self._lock = Lock()
+        self._handle = None
+        self._expected = None
+        self._num_errors = 0
+        self.num_polls = 0
+
+    @property
+    def running(self):
+        """True while polling."""
+        return self._expected is not None
+
+    def start(self, expected):
+        """Start (or re-start) polling for a new episode around `expected`."""
+        with self._lock:
+            self._cancel_handle()
+            self._expected = expected
+            self._num_errors = 0
+            self._handle = self._app.run_in(self._poll, 0)
+
+    def stop(self):
+        """Stop polling."""
+        with self._lock:
+            self._cancel_handle()
+            self._expected = None
+
+    def _cancel_handle(self):
+        if self._handle is not None:
+            self._app.cancel_timer(self._handle)
+            self._handle = None
+
+    # noinspection PyUnusedLocal
+    def _poll(self, kwargs):
+        with self._lock:
+            self._handle = None
+            expected = self._expected
+            if expected is None:
+                return
+            had_info = self._episodes.get()[0]
+            num_errors = self._episodes.num_errors
+            changed = self._episodes.fetch(force=True)
+            self.num_polls += 1
+            if self._episodes.num_errors > num_errors:
+                self._num_errors += 1
+            else:
+                self._num_errors = 0
+            now = self._app.datetime()
+            if changed and had_info:
+                self._expected = None
+            elif now > expected + self.stop_after:
+                self._expected = None
+                changed = False
+            else:
+                changed = False
+                self._handle = self._app.run_in(self._poll, poll_interval(
+                    now, expected, self.min_interval, self.max_interval,
+                    self._num_errors))
+        if changed:
+            self._callback(self._episodes.get()[1])
+
+    def __repr__(self):
+        return '<EpisodePoller: {} polls, expected={}>'.format(
+            self.num_polls, self._expected)
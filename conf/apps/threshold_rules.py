@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Rules engine for threshold alarms over numeric sensors (power peaks...).
+
+Each rule is a small state machine (IDLE -> PENDING -> ACTIVE -> IDLE)
+with hysteresis, min durations and a cool-down:
+
+- PENDING when the value goes `above` the upper limit,
+- ACTIVE (`trigger` event) if it is above again after `duration` seconds,
+  and before `reset_duration` seconds without triggering (the peak event
+  is forgotten, `cancel` event),
+- IDLE (`reset` event) when the value is `below` the lower limit for
+  `reset_duration` seconds, and no new trigger until `cooldown` seconds.
+
+The rules are compiled by sensor, so evaluating a new sample costs
+O(rules of that sensor). Config (`rules` in the app args):
+
+```yaml
+  rules:
+    sensor.enerpi_power:
+      - name: max_power
+        above: input_number.enerpi_max_power  # or a number
+        below: input_number.enerpi_max_power_reset
+        scale: 1000  # kW -> W
+        duration: 15
+        reset_duration: 60
+      - name: very_high_power
+        above: 5500
+        below: 4000
+        duration: 2
+        reset_duration: 30
+        cooldown: 600
+```
+
+Benchmark of the evaluation cost at 100 Hz per sensor:
+
+```
+    python threshold_rules.py --sensors 10 --rules 5 --hz 100 --secs 600
+```
+
+"""
+import argparse
+import random
+from time import time
+
+
+IDLE, PENDING, ACTIVE = 'idle', 'pending', 'active'
+START, CANCEL, TRIGGER, RESET = 'start', 'cancel', 'trigger', 'reset'
+
+
+class ThresholdRule(object):
+    """Hysteresis state machine for one threshold alarm on one sensor."""
+
+    __slots__ = ('name', 'entity', 'above', 'below', 'duration',
+                 'reset_duration', 'cooldown', 'options', 'state',
+                 'ts_start', 'ts_trigger', 'ts_last_high', 'ts_cooldown',
+                 'peak')
+
+    def __init__(self, name, entity, above, below=None, duration=0,
+                 reset_duration=0, cooldown=0, **options):
+        self.name = name
+        self.entity = entity
+        self.above = above
+        self.below = above if below is None else below
+        self.duration = duration
+        self.reset_duration = reset_duration
+        self.cooldown = cooldown
+        self.options = options
+        self.state = IDLE
+        self.ts_start = self.ts_trigger = self.ts_last_high = None
+        self.ts_cooldown = None
+        self.peak = None
+
+    @property
+    def active(self):
+        """True while the alarm is triggered."""
+        return self.state == ACTIVE
+
+    def update(self, ts, value, raw=None):
+        """Evaluate a new sample. Returns the event (or None)."""
+        raw = value if raw is None else raw
+        state = self.state
+        if state == ACTIVE:
+            if raw > self.peak:
+                self.peak = raw
+            if value >= self.below:
+                self.ts_last_high = ts
+            elif ts - self.ts_last_high > self.reset_duration:
+                self.state = IDLE
+                self.ts_cooldown = ts + self.cooldown
+                return RESET
+            return None
+        if value > self.above:
+            if self.ts_cooldown is not None and ts < self.ts_cooldown:
+                return None
+            if state == IDLE:
+                self.state = PENDING
+                self.ts_start = self.ts_last_high = ts
+                self.peak = raw
+                return START
+            if raw > self.peak:
+                self.peak = raw
+            self.ts_last_high = ts
+            if ts - self.ts_start > self.duration:
+                self.state = ACTIVE
+                self.ts_trigger = ts
+                return TRIGGER
+        elif state == PENDING:
+            if raw > self.peak:
+                self.peak = raw
+            if ts - self.ts_start > self.reset_duration:
+                self.state = IDLE
+                return CANCEL
+        return None
+
+    def __repr__(self):
+        return '<ThresholdRule {} on {}: {} (>{}, <{})>'.format(
+            self.name, self.entity, self.state, self.above, self.below)
+
+
+class RulesEngine(object):
+    """Threshold rules compiled by sensor."""
+
+    def __init__(self, rules=()):
+        self._by_entity = {}
+        self._by_name = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_config(cls, config, resolve=None):
+        """Compile `{entity: [rule params, ...]}`.
+
+        `resolve(entity)` converts the non-numeric limits (like
+        `input_number` entities) into numbers; limits are multiplied
+        by `scale`."""
+        engine = cls()
+        for entity, rules in config.items():
+            for i, params in enumerate(rules):
+                params = dict(params)
+                name = params.pop('name', '{}_{}'.format(entity, i))
+                scale = float(params.pop('scale', 1))
+                for key in ('above', 'below'):
+                    value = params.get(key)
+                    if value is None:
+                        continue
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        if resolve is None:
+                            raise
+                        value = resolve(value)
+                    params[key] = value * scale
+                engine.add(ThresholdRule(name, entity, **params))
+        return engine
+
+    def add(self, rule):
+        """Add a rule (names are unique)."""
+        if rule.name in self._by_name:
+            raise ValueError('Duplicated rule name: {}'.format(rule.name))
+        self._by_name[rule.name] = rule
+        rules = self._by_entity.get(rule.entity, ())
+        self._by_entity[rule.entity] = rules + (rule,)
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, entity):
+        return entity in self._by_entity
+
+    @property
+    def entities(self):
+        """Sensors with rules."""
+        return list(self._by_entity)
+
+    def get(self, name):
+        """Rule by name (or None)."""
+        return self._by_name.get(name)
+
+    def rules(self, entity=None):
+        """Rules of a sensor (all rules without `entity`)."""
+        if entity is None:
+            return list(self._by_name.values())
+        return list(self._by_entity.get(entity, ()))
+
+    def evaluate(self, entity, ts, value, raw=None):
+        """Evaluate a sample of `entity`. Returns a list of (event, rule)."""
+        events = []
+        for rule in self._by_entity.get(entity, ()):
+            event = rule.update(ts, value, raw)
+            if event is not None:
+                events.append((event, rule))
+        return events
+
+
+def benchmark(num_sensors=10, num_rules=5, hz=100, secs=600, seed=42):
+    """Evaluate random walk power signals, returning some stats."""
+    rnd = random.Random(seed)
+    config = {'sensor.power_{}'.format(i): [
+        dict(name='rule_{}_{}'.format(i, j), above=1000 + 500 * j,
+             below=800 + 500 * j, duration=5, reset_duration=20,
+             cooldown=60 * (j % 2))
+        for j in range(num_rules)] for i in range(num_sensors)}
+    engine = RulesEngine.from_config(config)
+    sensors = engine.entities
+    values = {entity: 500. for entity in sensors}
+    num_samples = int(secs * hz)
+    counter = {}
+    tic = time()
+    for k in range(num_samples):
+        ts = k / float(hz)
+        for entity in sensors:
+            value = max(0., values[entity] + rnd.gauss(0, 40))
+            values[entity] = value
+            for event, _ in engine.evaluate(entity, ts, value):
+                counter[event] = counter.get(event, 0) + 1
+    took = time() - tic
+    total = num_samples * num_sensors
+    return dict(sensors=num_sensors, rules=len(engine), samples=total,
+                took=took, us_per_sample=1e6 * took / total,
+                budget_pct=100. * took / secs, events=counter)
+
+
+def main():
+    """CLI for the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sensors', type=int, default=10)
+    parser.add_argument('--rules', type=int, default=5)
+    parser.add_argument('--hz', type=float, default=100)
+    parser.add_argument('--secs', type=float, default=600)
+    args = parser.parse_args()
+    results = benchmark(args.sensors, args.rules, args.hz, args.secs)
+    print('{sensors} sensors, {rules} rules, {samples} samples in {took:.3f} '
+          's ({us_per_sample:.2f} µs/sample, {budget_pct:.2f} % of real '
+          'time): {events}'.format(**results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for AppDaemon apps: single-timer timeline sequencer.
+
+One timeline drives a sequence of timed actions (`at`) and value ramps with
+easing curves (`ramp`), like the sunrise light phases and the volume ramp of
+an alarm clock, with only one AppDaemon timer (`run_in`) armed at any time.
+Cancelling the timeline (`cancel`) removes everything, so no orphan
+callbacks keep firing:
+
+```
+    self._timeline = Timeline(self, step=2)
+    ...
+    self._timeline.at(2, self._set_sunrise_phase, brightness=30, ...)
+    self._timeline.ramp(5, 300, 1, 25, self._set_volume, easing='ease_in')
+    ...
+    self._timeline.cancel()
+```
+
+"""
+from itertools import count
+from math import ceil
+from threading import Lock
+from time import time
+
+
+DEFAULT_STEP = 2  # secs
+# AppDaemon scheduler runs with 1 second resolution
+DEFAULT_TOLERANCE = .5
+
+EASING_CURVES = {
+    'linear': lambda t: t,
+    'ease_in': lambda t: t * t,
+    'ease_out': lambda t: t * (2 - t),
+    'ease_in_out': lambda t: t * t * (3 - 2 * t),
+    'cubic': lambda t: t * t * t,
+}
+
+
+class _Ramp(object):
+    """Value ramp between two instants (`clock` time)."""
+
+    __slots__ = ('start', 'duration', 'v_start', 'v_end', 'callback',
+                 'easing', 'as_int', 'last_value')
+
+    def __init__(self, start, duration, v_start, v_end, callback,
+                 easing, as_int):
+        self.start = start
+        self.duration = max(duration, 1e-6)
+        self.v_start = v_start
+        self.v_end = v_end
+        self.callback = callback
+        self.easing = easing
+        self.as_int = as_int
+        self.last_value = None
+
+    def value(self, now):
+        """Eased value at `now`."""
+        t = min(1., max(0., (now - self.start) / self.duration))
+        value = self.v_start + (self.v_end - self.v_start) * self.easing(t)
+        return int(round(value)) if self.as_int else value
+
+    def finished(self, now):
+        """True when the ramp has reached its end value."""
+        return now >= self.start + self.duration
+
+
+class Timeline(object):
+    """Sequencer of timed actions and eased ramps over one AppDaemon timer."""
+
+    def __init__(self, app, step=DEFAULT_STEP, clock=time):
+        self.step = step
+        self._app = app
+        self._clock = clock
+        self._lock = Lock()
+        self._events = []  # sorted list of (when, seq, callback, kwargs)
+        self._ramps = []
+        self._seq = count()
+        self._handle = None
+        self._armed_at = None
+
+    @property
+    def running(self):
+        """True while there are pending actions or active ramps."""
+        return bool(self._events or self._ramps)
+
+    def at(self, delay, callback, **kwargs):
+        """Run `callback(**kwargs)` in `delay` seconds."""
+        with self._lock:
+            self._events.append((self._clock() + delay, next(self._seq),
+                                 callback, kwargs))
+            self._events.sort(key=lambda x: x[:2])
+            self._arm()
+
+    def ramp(self, delay, duration, v_start, v_end, callback,
+             easing='linear', as_int=True):
+        """Call `callback(value)` every `step` seconds (only with changes),
+        from `v_start` to `v_end`, during `duration` seconds."""
+        if not callable(easing):
+            easing = EASING_CURVES[easing]
+        with self._lock:
+            self._ramps.append(_Ramp(self._clock() + delay, duration,
+                                     v_start, v_end, callback,
+                                     easing, as_int))
+            self._arm()
+
+    def cancel(self):
+        """Cancel all the pending actions and ramps (and the timer)."""
+        with self._lock:
+            self._events = []
+            self._ramps = []
+            self._cancel_handle()
+
+    def _cancel_handle(self):
+        if self._handle is not None:
+            self._app.cancel_timer(self._handle)
+        self._handle = self._armed_at = None
+
+    def _next_tick(self, now):
+        next_tick = None
+        if self._events:
+            next_tick = self._events[0][0]
+        if self._ramps:
+            first_ramp = min(r.start if r.start > now else now + self.step
+                             for r in self._ramps)
+            next_tick = (first_ramp if next_tick is None
+                         else min(next_tick, first_ramp))
+        return next_tick
+
+    def _arm(self):
+        now = self._clock()
+        next_tick = self._next_tick(now)
+        if next_tick is None or next_tick == self._armed_at:
+            return
+        if self._armed_at is not None and self._armed_at <= next_tick:
+            return
+        self._cancel_handle()
+        self._handle = self._app.run_in(
+            self._tick, max(0, int(ceil(next_tick - now))))
+        self._armed_at = next_tick
+
+    # noinspection PyUnusedLocal
+    def _tick(self, kwargs):
+        calls = []
+        with self._lock:
+            self._handle = self._armed_at = None
+            now = self._clock()
+            while (self._events and
+                   self._events[0][0] <= now + DEFAULT_TOLERANCE):
+                _, _, callback, kw = self._events.pop(0)
+                calls.append((callback, (), kw))
+            active = []
+            for r in self._ramps:
+                if r.start <= now + DEFAULT_TOLERANCE:
+                    value = r.value(now)
+                    if value != r.last_value:
+                        r.last_value = value
+                        calls.append((r.callback, (value,), {}))
+                if not r.finished(now):
+                    active.append(r)
+            self._ramps = active
+            self._arm()
+        for callback, args, kw in calls:
+            callback(*args, **kw)
+
+    def __repr__(self):
+        return '<Timeline: {} pending actions, {} ramps, step={}>'.format(
+            len(self._events), len(self._ramps), self.step)
@@ -14,20 +14,52 @@ ytb_search:
   input_text: input_text.q_youtube
   media_player: media_player.kodi
   youtube_key: 123456789012345678901234567890123456789
+  # debounce_sec: 2
 ```
+
+The queries are debounced (only the last text after `debounce_sec` seconds
+without changes is searched), run in a background thread, and the results
+are cached (LRU + TTL) by normalized query and search options.
+
+Each query is a paginated session: the next page of results is prefetched
+in background and appended to the options selecting the "more results"
+option. A local index (title -> video id) resolves the selections, and the
+`youtube_play_next` event plays the next video of the current results,
+without new API calls.
 """
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import appdaemon.appapi as appapi
 import requests
 
+from lru_cache import LRUCache
+
 
 URL_BASE = 'https://www.googleapis.com/youtube/v3/search'
 KODI_YOUTUBE_PLUGIN_MASK = "plugin://plugin.video.youtube/play/?video_id={}"
 DEFAULT_ACTION = 'No video'
+MORE_RESULTS = 'More results...'
+EVENT_PLAY_NEXT = 'youtube_play_next'
+RESULTS_PER_PAGE = 20
+MAX_PAGES = 10
+DEFAULT_DEBOUNCE_SEC = 2
+DEFAULT_TIMEOUT = 10  # secs
+QUERY_CACHE_SIZE = 50
+QUERY_CACHE_TTL = 3600  # secs
+MAX_OPTIONS_MEMORY = 200
+
+
+def normalize_query(str_query):
+    """Normalized query text (lowercase, single spaces) for the cache."""
+    return ' '.join(str_query.lower().split())
 
 
-def query_youtube_videos(str_query, max_results=20, is_normal_query=True,
-                         order_by_date=False, youtube_key=None):
+def query_youtube_page(str_query, max_results=RESULTS_PER_PAGE,
+                       is_normal_query=True, order_by_date=False,
+                       youtube_key=None, page_token=None,
+                       timeout=DEFAULT_TIMEOUT, session=None):
+    """One page of results: ([(video_id, title), ...], next_page_token)."""
     params = dict(order='date' if order_by_date else 'relevance',
                   part='snippet', key=youtube_key, maxResults=max_results)
     if is_normal_query:
@@ -35,13 +67,58 @@ def query_youtube_videos(str_query, max_results=20, is_normal_query=True,
     else:
         params.update({str_query.split('=')[0].strip():
                        str_query.split('=')[1].strip()})
+    if page_token is not None:
+        params.update({'pageToken': page_token})
 
-    data = requests.get(URL_BASE, params=params).json()
+    data = (session or requests).get(URL_BASE, params=params,
+                                     timeout=timeout).json()
     found = []
     for item in data['items']:
         if item['id']['kind'] == 'youtube#video':
             found.append((item['id']['videoId'], item['snippet']['title']))
-    return found
+    return found, data.get('nextPageToken')
+
+
+def query_youtube_videos(str_query, max_results=RESULTS_PER_PAGE,
+                         is_normal_query=True, order_by_date=False,
+                         youtube_key=None, timeout=DEFAULT_TIMEOUT,
+                         session=None):
+    return query_youtube_page(
+        str_query, max_results=max_results, is_normal_query=is_normal_query,
+        order_by_date=order_by_date, youtube_key=youtube_key,
+        timeout=timeout, session=session)[0]
+
+
+class SearchSession(object):
+    """Paginated results of a query (with `nextPageToken`)."""
+
+    def __init__(self, query, **kwargs_query):
+        self.query = query
+        self._kwargs_query = kwargs_query
+        self._lock = Lock()
+        self.results = []
+        self.num_pages = 0
+        self.next_token = None
+
+    @property
+    def has_more(self):
+        """True if there are more pages to load."""
+        return (self.num_pages == 0 or self.next_token is not None) \
+            and self.num_pages < MAX_PAGES
+
+    def load_next(self, min_results=None, **kwargs):
+        """Load the next page of results (if there are no more than
+        `min_results` results loaded yet). Returns the new results."""
+        with self._lock:
+            if not self.has_more or (min_results is not None
+                                     and len(self.results) >= min_results):
+                return []
+            found, self.next_token = query_youtube_page(
+                self.query, page_token=self.next_token,
+                **dict(self._kwargs_query, **kwargs))
+            self.num_pages += 1
+            self.results.extend(found)
+            return found
 
 
 # noinspection PyClassHasNoInit
@@ -50,6 +127,17 @@ class YoutubeSearch(appapi.AppDaemon):
 
     _ids_options = None
     _youtube_key = None
+    _debounce_sec = None
+    _handle_query = None
+    _query_cache = None
+    _query_seq = None
+    _executor = None
+    _session = None
+    _lock = None
+
+    _search_session = None
+    _num_shown = 0
+    _last_played = None
 
     _input_select = None
     _input_text = None
@@ -61,43 +149,194 @@ class YoutubeSearch(appapi.AppDaemon):
         self._input_text = self.args.get('input_text')
         self._media_player = self.args.get('media_player', 'media_player.kodi')
         self._youtube_key = self.args.get('youtube_key')
+        self._debounce_sec = int(self.args.get('debounce_sec',
+                                               DEFAULT_DEBOUNCE_SEC))
+        self._query_cache = LRUCache(max_items=QUERY_CACHE_SIZE,
+                                     ttl=QUERY_CACHE_TTL)
+        self._query_seq = 0
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._lock = Lock()
+        self._session = requests.Session()
         self.listen_state(self.new_youtube_query, self._input_text)
         self.listen_state(self.video_selection, self._input_select)
-        self._ids_options = {DEFAULT_ACTION: None}
+        self.listen_event(self.play_next_video, EVENT_PLAY_NEXT)
+        # Local index: title -> video id
+        self._ids_options = LRUCache(max_items=MAX_OPTIONS_MEMORY)
+
+    def terminate(self):
+        """AppDaemon method called on app reload."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._session is not None:
+            self._session.close()
 
     # noinspection PyUnusedLocal
     def new_youtube_query(self, entity, attribute, old, new, kwargs):
-        """Query videos with input_text."""
-        self.log('New youtube query with "{}"'.format(new))
-        found = query_youtube_videos(new,
-                                     max_results=20,
-                                     is_normal_query=True,
-                                     order_by_date=False,
-                                     youtube_key=self._youtube_key)
-        self.log('YOUTUBE QUERY FOUND:\n{}'.format(found))
-
-        # Update input_select values:
-        self._ids_options.update({name: v_id for v_id, name in found})
-        labels = [f[1] for f in found]
+        """Query videos with input_text (debounced)."""
+        if self._handle_query is not None:
+            self.cancel_timer(self._handle_query)
+        self._handle_query = self.run_in(
+            self._launch_query, self._debounce_sec, query=new)
+
+    def _launch_query(self, kwargs):
+        self._handle_query = None
+        query = kwargs['query']
+        if not query or not query.strip():
+            return
+        self.log('New youtube query with "{}"'.format(query))
+        with self._lock:
+            self._query_seq += 1
+            seq = self._query_seq
+        self._submit(self._search, query, seq)
+
+    def _submit(self, func, *args):
+        """Run in the background threads, logging any error."""
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._log_future_error)
+        return future
+
+    def _log_future_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.log('YOUTUBE WORKER ERROR: {!r}'.format(future.exception()),
+                     'ERROR')
+
+    def _get_search_session(self, query, **kwargs_query):
+        key = (normalize_query(query), tuple(sorted(kwargs_query.items())))
+        search = self._query_cache.get(key)
+        if search is None:
+            search = self._query_cache.set(
+                key, SearchSession(query, **kwargs_query))
+        else:
+            self.log('YOUTUBE QUERY FROM CACHE: "{}" ({} results, {})'
+                     .format(query, len(search.results), self._query_cache),
+                     'DEBUG')
+        return search
+
+    def _load_page(self, search, min_results=None):
+        found = search.load_next(min_results=min_results,
+                                 youtube_key=self._youtube_key,
+                                 session=self._session)
+        for v_id, name in found:
+            self._ids_options.set(name, v_id)
+        return found
+
+    def _prefetch_next_page(self, search):
+        """Load the next page in background (while browsing the current)."""
+        def _prefetch():
+            with self._lock:
+                min_results = self._num_shown + 1
+            try:
+                found = self._load_page(search, min_results)
+                self.log('PREFETCHED {} MORE RESULTS FOR "{}"'
+                         .format(len(found), search.query), 'DEBUG')
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self.log('YOUTUBE PREFETCH ERROR with "{}": {}'
+                         .format(search.query, e), 'WARNING')
+
+        with self._lock:
+            num_shown = self._num_shown
+        if search.has_more and len(search.results) <= num_shown:
+            self._submit(_prefetch)
+
+    def _search(self, query, seq):
+        """Run the query in the background thread."""
+        search = self._get_search_session(query, max_results=RESULTS_PER_PAGE,
+                                          is_normal_query=True,
+                                          order_by_date=False)
+        try:
+            self._load_page(search, 1)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.error('YOUTUBE QUERY ERROR with "{}": {}'
+                       .format(query, e), 'WARNING')
+            return
+        with self._lock:
+            if seq != self._query_seq:
+                # A newer query has been launched
+                return
+            self._search_session = search
+            self._num_shown = 0
+        self.log('YOUTUBE QUERY FOUND:\n{}'.format(search.results))
+        self._show_results(RESULTS_PER_PAGE)
+
+    def _show_results(self, num_more):
+        """Update input_select values, with the next page prefetched."""
+        with self._lock:
+            search = self._search_session
+            self._num_shown = min(len(search.results),
+                                  self._num_shown + num_more)
+            shown = search.results[:self._num_shown]
+            more = search.has_more or len(search.results) > self._num_shown
+        labels = [f[1] for f in shown]
+        for v_id, name in shown:
+            self._ids_options.set(name, v_id)
+        options = [DEFAULT_ACTION] + labels
+        if more:
+            options.append(MORE_RESULTS)
         self.log('NEW OPTIONS:\n{}'.format(labels))
         self.call_service('input_select/set_options',
-                          entity_id=self._input_select,
-                          options=[DEFAULT_ACTION] + labels)
+                          entity_id=self._input_select, options=options)
+        self._prefetch_next_page(search)
+
+    def _more_results(self):
+        with self._lock:
+            search = self._search_session
+            num_shown = self._num_shown
+        if search is None:
+            return
+        if len(search.results) <= num_shown:
+            # Not prefetched yet
+            try:
+                self._load_page(search, num_shown + 1)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self.error('YOUTUBE QUERY ERROR with "{}": {}'
+                           .format(search.query, e), 'WARNING')
+                return
+        self._show_results(RESULTS_PER_PAGE)
+
+    def _play_video(self, title, video_id):
+        self.log('PLAY MEDIA: {} [id={}]'.format(title, video_id))
+        self._last_played = video_id
+        self.call_service(
+            'media_player/play_media', entity_id=self._media_player,
+            media_content_type="video",
+            media_content_id=KODI_YOUTUBE_PLUGIN_MASK.format(video_id))
 
     # noinspection PyUnusedLocal
     def video_selection(self, entity, attribute, old, new, kwargs):
         """Play the selected video from a previous query."""
         self.log('SELECTED OPTION: {} (from {})'.format(new, old))
-        try:
-            selected = self._ids_options[new]
-        except KeyError:
+        if new == DEFAULT_ACTION:
+            return
+        if new == MORE_RESULTS:
+            self._submit(self._more_results)
+            return
+        selected = self._ids_options.get(new, False)
+        if selected is False:
             self.error('Selection "{}" not in memory (doing nothing)'
                        .format(new), 'WARNING')
             return
 
         if selected:
-            self.log('PLAY MEDIA: {} [id={}]'.format(new, selected))
-            self.call_service(
-                'media_player/play_media', entity_id=self._media_player,
-                media_content_type="video",
-                media_content_id=KODI_YOUTUBE_PLUGIN_MASK.format(selected))
+            self._play_video(new, selected)
+
+    # noinspection PyUnusedLocal
+    def play_next_video(self, event_id, payload_event, *args):
+        """Play the next video of the current results (local index)."""
+        with self._lock:
+            search = self._search_session
+            num_shown = self._num_shown
+        if search is None or not search.results:
+            self.log('No youtube results to play next')
+            return
+        ids = [v_id for v_id, _ in search.results]
+        try:
+            idx = ids.index(self._last_played) + 1
+        except ValueError:
+            idx = 0
+        if idx >= len(ids):
+            self.log('No more youtube results to play next')
+            return
+        v_id, title = search.results[idx]
+        self._play_video(title, v_id)
+        if idx + 1 >= num_shown:
+            self._submit(self._more_results)